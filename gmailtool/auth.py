@@ -4,34 +4,227 @@
 
 from gmailtool import config
 
+import datetime
+import fcntl
+import httplib2
 import json
 import logging
 import oauth2client
+import oauth2client.client
 import oauth2client.file
 import oauth2client.tools
 import os
 import tempfile
+import threading
 
 
 logger = logging.getLogger('gmailtool.auth')
 
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+class NotAuthenticatedError(Exception):
+    """Raised when there are no valid saved credentials"""
+
+
+class LockedFileStorage(oauth2client.file.Storage):
+    """Credential storage which holds an exclusive lock on a lock file while it is in use
+
+    oauth2client re-reads the storage while holding its lock before refreshing an access token
+    and uses a token another process has already refreshed, so with a file lock parallel
+    processes refresh the token one at a time instead of all at once.
+    """
+
+    def __init__(self, filename):
+        super(LockedFileStorage, self).__init__(filename)
+        self._lock_path = filename + '.lock'
+        self._lock_file = None
+
+    def acquire_lock(self):
+        super(LockedFileStorage, self).acquire_lock()
+        self._lock_file = open(self._lock_path, 'a')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+
+    def release_lock(self):
+        fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        self._lock_file.close()
+        self._lock_file = None
+        super(LockedFileStorage, self).release_lock()
+
+
+def get_credential_manager(profile_dir):
+    """Get the credential manager of a profile, shared by everything in the process using the profile
+
+    Args:
+        profile_dir (str): The profile directory holding the saved credentials
+
+    Returns:
+        CredentialManager: The credential manager
+    """
+    storage_path = os.path.abspath(os.path.join(os.path.expanduser(profile_dir),
+                                                config.oauth_credentials_storage_filename))
+    with _managers_lock:
+        if storage_path not in _managers:
+            _managers[storage_path] = CredentialManager(storage_path)
+        return _managers[storage_path]
+
+
+class CredentialManager(object):
+    """Load credentials once per process and refresh their access token before it expires
+
+    All http objects authorized by a manager share one credentials object, so a token refreshed
+    for one stream is used by every stream.
+    """
+
+    def __init__(self, storage_path, refresh_margin=300, utcnow=datetime.datetime.utcnow):
+        """Initialize a credential manager
+
+        Args:
+            storage_path (str): The file the credentials are saved in
+            refresh_margin (float): The number of seconds before expiry the access token is refreshed
+            utcnow (callable): Returns the current utc time as a naive datetime
+        """
+        self._storage_path = storage_path
+        self._storage = LockedFileStorage(storage_path)
+        self._refresh_margin = refresh_margin
+        self._utcnow = utcnow
+        self._credentials = None
+        self._lock = threading.Lock()
+        self._refresher = None
+        self._stop = threading.Event()
+
+    @property
+    def storage(self):
+        """LockedFileStorage: The storage the credentials are saved in"""
+        return self._storage
+
+    @property
+    def credentials(self):
+        """Credentials: The saved credentials, loaded from storage the first time they are used
+
+        Raises:
+            NotAuthenticatedError: The auth command has not been run or the saved credentials are invalid
+        """
+        with self._lock:
+            if self._credentials is None or self._credentials.invalid:
+                credentials = self._storage.get()
+                if credentials is None or credentials.invalid:
+                    raise NotAuthenticatedError('No valid credentials in ' + self._storage_path +
+                                                ', run the auth command first')
+                self._credentials = credentials
+            return self._credentials
+
+    def authorize(self, http=None):
+        """Authorize an http object with the shared credentials
+
+        Args:
+            http (http): The http object to authorize. Defaults to a new httplib2.Http
+
+        Returns:
+            http: The authorized http object
+        """
+        return self.credentials.authorize(http or httplib2.Http())
+
+    def seconds_until_refresh(self):
+        """float: The number of seconds until the access token should be refreshed, 0 if it is due,
+        None if the access token does not expire"""
+        token_expiry = self.credentials.token_expiry
+        if token_expiry is None:
+            return None
+        seconds = (token_expiry - self._utcnow()).total_seconds() - self._refresh_margin
+        return max(seconds, 0.0)
+
+    def refresh_if_expiring(self, http=None):
+        """Refresh the access token if it expires within the refresh margin
+
+        Args:
+            http (http): The http object the refresh request is made with. Defaults to a new httplib2.Http
+
+        Returns:
+            bool: True if a refresh was due
+        """
+        seconds = self.seconds_until_refresh()
+        if seconds is None or seconds > 0:
+            return False
+        logger.debug('Refreshing access token')
+        self.credentials.refresh(http or httplib2.Http())
+        return True
+
+    def start(self, retry_interval=60):
+        """Start refreshing the access token ahead of its expiry in a background thread
+
+        Args:
+            retry_interval (float): The number of seconds to wait before retrying a failed refresh
+        """
+        with self._lock:
+            if self._refresher is not None:
+                return
+            self._stop.clear()
+            self._refresher = threading.Thread(target=self._refresh_loop,
+                                               args=(retry_interval,),
+                                               name='gmailtool-credentials-refresh')
+            self._refresher.daemon = True
+            self._refresher.start()
+
+    def stop(self):
+        """Stop the background refresh thread"""
+        with self._lock:
+            refresher = self._refresher
+            self._refresher = None
+        if refresher is not None:
+            self._stop.set()
+            refresher.join()
+
+    def _refresh_loop(self, retry_interval):
+        """Background thread main loop refreshing the access token when it is due"""
+        while not self._stop.is_set():
+            try:
+                self.refresh_if_expiring()
+                seconds = self.seconds_until_refresh()
+                wait = retry_interval if seconds is None else max(seconds, 1.0)
+            except (oauth2client.client.Error, httplib2.HttpLib2Error, IOError, NotAuthenticatedError) as error:
+                logger.warning('Could not refresh access token: ' + str(error))
+                wait = retry_interval
+            self._stop.wait(wait)
+
+
+def load_credentials(profile_dir):
+    """Load the credentials saved by the auth command
+
+    Args:
+        profile_dir (str): The profile directory holding the saved credentials
+
+    Returns:
+        Credentials: The saved oauth credentials, shared with the rest of the process
+
+    Raises:
+        NotAuthenticatedError: The auth command has not been run or the saved credentials are invalid
+    """
+    return get_credential_manager(profile_dir).credentials
+
 
 def cmd_auth(args):
     """The authentication command
     """
     logger.debug('Running command auth')
 
-    credentials_storage_path = os.path.join(args.profile_dir, config.oauth_credentials_storage_filename)
-    credentials_storage = oauth2client.file.Storage(credentials_storage_path)
-    credentials = credentials_storage.get()
-    if credentials is None or credentials.invalid:
+    credential_manager = get_credential_manager(args.profile_dir)
+    credentials_storage = credential_manager.storage
+    scopes = list(config.oauth_scopes)
+    if args.pubsub:
+        scopes.append(config.pubsub_oauth_scope)
+    try:
+        credentials = credential_manager.credentials
+    except NotAuthenticatedError:
+        credentials = None
+    if credentials is None or (args.pubsub and not credentials.has_scopes(scopes)):
 
         client_secret_file_handle, client_secret_path = tempfile.mkstemp()
         client_secret_fout = os.fdopen(client_secret_file_handle, 'w')
         json.dump(config.oauth_client_secret, client_secret_fout)
         client_secret_fout.close()
-        flow = oauth2client.client.flow_from_clientsecrets(client_secret_path,
-                                                           config.oauth_scopes)
+        flow = oauth2client.client.flow_from_clientsecrets(client_secret_path, scopes)
         flow.user_agent = config.oauth_application_name
         credentials = oauth2client.tools.run_flow(flow, credentials_storage, args)
         os.remove(client_secret_path)
@@ -45,7 +238,7 @@ def cmd_auth_register(parsers, environ):
     Args:
         parsers (Parsers): The parsers which belong to the higher level parser
     """
-    parser = parsers.add_parser('auth',
-                                help='Authenticate and save credentials for future invocations of gmailtool',
-                                parents=[oauth2client.tools.argparser])
+    parser = parsers.add_parser('auth', parents=[oauth2client.tools.argparser])
+    parser.add_argument('--pubsub', action='store_true',
+                        help='Also grant access to Cloud Pub/Sub, needed to follow mailboxes with --watch-topic')
     parser.set_defaults(func=cmd_auth)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""Testing the auth python module
+"""
+
+from gmailtool import auth
+
+import apiclient.http
+import datetime
+import json
+import oauth2client.client
+import os
+import shutil
+import tempfile
+import unittest
+
+
+NOW = datetime.datetime(2016, 1, 1, 12, 0, 0)
+
+
+def make_credentials(access_token, expires_in):
+    return oauth2client.client.OAuth2Credentials(access_token,
+                                                 'client-id',
+                                                 'client-secret',
+                                                 'refresh-token',
+                                                 NOW + datetime.timedelta(seconds=expires_in),
+                                                 'https://accounts.google.com/o/oauth2/token',
+                                                 'gmailtool-test')
+
+
+def token_response(access_token):
+    return ({'status': '200'}, json.dumps({'access_token': access_token, 'expires_in': 3600}))
+
+
+class TestCredentialManager(unittest.TestCase):
+    """Testing credentials are shared and refreshed ahead of expiry"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'credentials.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def save(self, credentials):
+        auth.LockedFileStorage(self.path).put(credentials)
+
+    def test_missing_credentials_should_raise(self):
+        manager = auth.CredentialManager(self.path)
+        self.assertRaises(auth.NotAuthenticatedError, lambda: manager.credentials)
+
+    def test_credentials_should_be_loaded_once(self):
+        self.save(make_credentials('token-1', 3600))
+        manager = auth.CredentialManager(self.path)
+        credentials = manager.credentials
+        self.save(make_credentials('token-2', 3600))
+        self.assertIs(manager.credentials, credentials)
+        self.assertEqual(manager.credentials.access_token, 'token-1')
+
+    def test_profiles_should_share_a_manager(self):
+        self.assertIs(auth.get_credential_manager(self.directory),
+                      auth.get_credential_manager(self.directory + '/'))
+
+    def test_token_should_not_be_refreshed_before_the_margin(self):
+        self.save(make_credentials('token-1', 3600))
+        manager = auth.CredentialManager(self.path, refresh_margin=300, utcnow=lambda: NOW)
+        self.assertEqual(manager.seconds_until_refresh(), 3300)
+        http = apiclient.http.HttpMockSequence([({'status': '500'}, 'Should never be requested')])
+        self.assertFalse(manager.refresh_if_expiring(http))
+
+    def test_token_should_be_refreshed_within_the_margin(self):
+        self.save(make_credentials('token-1', 200))
+        manager = auth.CredentialManager(self.path, refresh_margin=300, utcnow=lambda: NOW)
+        self.assertEqual(manager.seconds_until_refresh(), 0)
+        http = apiclient.http.HttpMockSequence([token_response('token-2')])
+        self.assertTrue(manager.refresh_if_expiring(http))
+        self.assertEqual(manager.credentials.access_token, 'token-2')
+        self.assertEqual(auth.LockedFileStorage(self.path).get().access_token, 'token-2',
+                         'expected the refreshed token to be saved for other processes')
+
+    def test_token_without_expiry_should_not_be_refreshed(self):
+        credentials = make_credentials('token-1', 3600)
+        credentials.token_expiry = None
+        self.save(credentials)
+        manager = auth.CredentialManager(self.path, utcnow=lambda: NOW)
+        self.assertIsNone(manager.seconds_until_refresh())
+        http = apiclient.http.HttpMockSequence([({'status': '500'}, 'Should never be requested')])
+        self.assertFalse(manager.refresh_if_expiring(http))
+
+    def test_token_refreshed_by_another_process_should_be_reused(self):
+        self.save(make_credentials('token-1', 200))
+        manager = auth.CredentialManager(self.path, refresh_margin=300, utcnow=lambda: NOW)
+        manager.credentials
+        # Another process refreshes the token after this process loaded its credentials
+        fresh = make_credentials('token-2', 3600)
+        fresh.token_expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        self.save(fresh)
+        http = apiclient.http.HttpMockSequence([({'status': '500'}, 'Should never be requested')])
+        manager.refresh_if_expiring(http)
+        self.assertEqual(manager.credentials.access_token, 'token-2')
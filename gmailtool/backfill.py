@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""Listing the messages already in a mailbox, split into date shards listed in parallel
+"""
+
+from gmailtool import retry
+
+import logging
+import Queue
+import threading
+import time
+
+
+logger = logging.getLogger('gmailtool.backfill')
+
+# The largest page of message ids gmail will return from a single messages list request
+MESSAGE_LIST_PAGE_SIZE = 500
+
+# Gmail launched in 2004 so no mailbox has mail from before then
+GMAIL_EPOCH = 1072915200
+
+
+def date_shards(after, before, shards):
+    """Split a time range into contiguous shards of about equal length
+
+    Args:
+        after (float): The start of the range in seconds since the epoch
+        before (float): The end of the range in seconds since the epoch
+        shards (int): The number of shards
+
+    Returns:
+        list of (int, int): The start and end of each shard, newest shard first
+    """
+    assert shards > 0, 'shards must be at least 1'
+    after = int(after)
+    before = int(before)
+    boundaries = [after + (before - after) * index // shards for index in range(shards + 1)]
+    ranges = [(start, end) for start, end in zip(boundaries, boundaries[1:]) if end > start]
+    return list(reversed(ranges or [(after, before)]))
+
+
+def shard_query(query, after=None, before=None):
+    """Restrict a gmail search query to a time range
+
+    The ranges of adjacent shards overlap by a second so a message on a shard boundary is
+    listed at least once, duplicates are removed by the caller.
+
+    Args:
+        query (str): The gmail search query. None matches every message
+        after (int): Only match messages from this time on, in seconds since the epoch
+        before (int): Only match messages from before this time, in seconds since the epoch
+
+    Returns:
+        str or None: The query, None if it matches every message
+    """
+    terms = [query] if query else []
+    if after is not None:
+        terms.append('after:{}'.format(int(after) - 1))
+    if before is not None:
+        terms.append('before:{}'.format(int(before)))
+    return ' '.join(terms) or None
+
+
+class MessageLister(object):
+    """List the ids of the messages matching a query with users.messages.list
+
+    The query can be split into date shards which are listed concurrently, each worker thread
+    with its own service object. Pages of ids are handed back as soon as they arrive so the
+    caller can download messages while listing continues.
+    """
+
+    def __init__(self, mailbox, api_factory, executor=None, concurrency=1, page_size=MESSAGE_LIST_PAGE_SIZE):
+        """Initialize a message lister
+
+        Args:
+            mailbox (str): The mailbox to list
+            api_factory (callable): Called with no arguments to get the gmail api service object of
+                each worker thread. Service objects must not be shared between threads unless
+                concurrency is 1
+            executor (RequestExecutor): Executes the list requests. Defaults to retrying without a quota budget
+            concurrency (int): The number of shards listed at once
+            page_size (int): The number of message ids requested per page
+        """
+        assert concurrency > 0, 'concurrency must be at least 1'
+        self._mailbox = mailbox
+        self._api_factory = api_factory
+        self._executor = executor or retry.RequestExecutor()
+        self._concurrency = concurrency
+        self._page_size = page_size
+
+    def iter_pages(self, query=None, after=None, before=None, shards=1):
+        """Iterate over the pages of message ids matching a query
+
+        Args:
+            query (str): The gmail search query. None lists every message
+            after (float): Only list messages from this time on, in seconds since the epoch
+            before (float): Only list messages from before this time, in seconds since the epoch
+            shards (int): The number of date shards to split the time range into
+
+        Yields:
+            list of str: Each page of message ids. Ids on shard boundaries may be repeated
+        """
+        if shards == 1:
+            queries = [shard_query(query, after, before)]
+        else:
+            if after is None:
+                after = GMAIL_EPOCH
+            if before is None:
+                before = time.time() + 24 * 60 * 60
+            queries = [shard_query(query, start, end) for start, end in date_shards(after, before, shards)]
+
+        if self._concurrency == 1 or len(queries) == 1:
+            api = self._api_factory()
+            for shard in queries:
+                for page in self._iter_shard_pages(api, shard):
+                    yield page
+            return
+
+        for page in self._iter_pages_concurrently(queries):
+            yield page
+
+    def _iter_pages_concurrently(self, queries):
+        """List shards from worker threads, yielding pages as they arrive
+
+        Args:
+            queries (list of str): The query of each shard
+
+        Yields:
+            list of str: Each page of message ids
+        """
+        shards = Queue.Queue()
+        for shard in queries:
+            shards.put(shard)
+        pages = Queue.Queue(maxsize=self._concurrency * 2)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def work():
+            try:
+                api = self._api_factory()
+                while not stop.is_set():
+                    try:
+                        shard = shards.get_nowait()
+                    except Queue.Empty:
+                        break
+                    for page in self._iter_shard_pages(api, shard):
+                        if not put((page, None)):
+                            return
+            except Exception as exception:  # noqa: B902 the error is re-raised in the iterating thread
+                put((None, exception))
+            put((None, None))
+
+        workers = []
+        for index in range(min(self._concurrency, len(queries))):
+            worker = threading.Thread(target=work, name='gmailtool-backfill-{}'.format(index))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        try:
+            running = len(workers)
+            while running > 0:
+                page, exception = pages.get()
+                if exception is not None:
+                    raise exception
+                if page is None:
+                    running -= 1
+                else:
+                    yield page
+        finally:
+            stop.set()
+            for worker in workers:
+                worker.join()
+
+    def _iter_shard_pages(self, api, query):
+        """List the pages of a single shard
+
+        Args:
+            api (Resource): The gmail api service object
+            query (str): The query of the shard
+
+        Yields:
+            list of str: Each page of message ids
+        """
+        page_token = None
+        while True:
+            request = api.users().messages().list(userId=self._mailbox,
+                                                  q=query,
+                                                  maxResults=self._page_size,
+                                                  pageToken=page_token)
+            message_list = self._executor.execute(request)
+            message_ids = [message['id'] for message in message_list.get('messages', [])]
+            logger.debug('Listed {} messages matching {}'.format(len(message_ids), query))
+            if len(message_ids) > 0:
+                yield message_ids
+            page_token = message_list.get('nextPageToken')
+            if page_token is None:
+                return
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""Testing the backfill python module
+"""
+
+from gmailtool import backfill
+from gmailtool import mailstream
+from gmailtool.mailstream_test import generate_mock_message
+from gmailtool.mailstream_test import get_gmail_api_descovery_json
+from gmailtool.scheduler_test import FakeClock
+
+import apiclient.http
+import httplib2
+import json
+import re
+import threading
+import unittest
+import urllib
+
+
+class MockListHttp(object):
+    """A mock http object answering messages list requests from a fixed set of message times
+
+    Pages of two ids are returned for the messages matching the after: and before: terms of the query.
+    """
+
+    def __init__(self, message_times):
+        self.message_times = message_times
+        self.queries = []
+        self.threads = set()
+        self.lock = threading.Lock()
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=1, connection_type=None):
+        if '/discovery/' in uri:
+            return httplib2.Response({'status': '200'}), get_gmail_api_descovery_json()
+        query = urllib.unquote_plus(re.search(r'[?&]q=([^&]*)', uri).group(1))
+        token = re.search(r'[?&]pageToken=([^&]*)', uri)
+        start = int(token.group(1)) if token else 0
+        with self.lock:
+            self.queries.append(query)
+            self.threads.add(threading.current_thread())
+        after = int(re.search(r'after:(\d+)', query).group(1))
+        before = int(re.search(r'before:(\d+)', query).group(1))
+        matching = sorted(message_id for message_id, message_time in self.message_times.items()
+                          if after < message_time < before)
+        response = {'messages': [{'id': message_id} for message_id in matching[start:start + 2]]}
+        if start + 2 < len(matching):
+            response['nextPageToken'] = str(start + 2)
+        return httplib2.Response({'status': '200'}), json.dumps(response)
+
+
+class TestShards(unittest.TestCase):
+    """Testing time ranges are split into shards"""
+
+    def test_shards_should_cover_the_range_newest_first(self):
+        self.assertEqual(backfill.date_shards(0, 10, 3), [(6, 10), (3, 6), (0, 3)])
+
+    def test_short_ranges_should_not_produce_empty_shards(self):
+        self.assertEqual(backfill.date_shards(0, 2, 4), [(1, 2), (0, 1)])
+
+    def test_shard_query_should_overlap_adjacent_shards(self):
+        self.assertEqual(backfill.shard_query('label:inbox', 100, 200), 'label:inbox after:99 before:200')
+        self.assertIsNone(backfill.shard_query(None))
+
+
+class TestMessageLister(unittest.TestCase):
+    """Testing shards are listed concurrently"""
+
+    def setUp(self):
+        self.message_times = dict(('test{}'.format(index), 1000 + index * 10) for index in range(20))
+        self.http = MockListHttp(self.message_times)
+
+    def api_factory(self):
+        return apiclient.discovery.build('gmail', 'v1', http=self.http)
+
+    def test_all_shards_should_be_listed(self):
+        lister = backfill.MessageLister('recipient@example.adamandpaul.biz', self.api_factory, concurrency=3)
+        listed = set()
+        for page in lister.iter_pages(after=1000, before=1200, shards=5):
+            listed.update(page)
+        self.assertEqual(listed, set(self.message_times))
+        self.assertEqual(len(set(self.http.queries)), 5)
+
+
+class TestStreamBackfill(unittest.TestCase):
+    """Testing backfilling a mailbox then following on from where the backfill started"""
+
+    def create_inbox(self, responses, cursor='{"last_history_id": 1}', **kwargs):
+        http = apiclient.http.HttpMockSequence([
+            ({'status': '200'}, get_gmail_api_descovery_json()),
+        ] + responses + [
+            ({'status': '400'}, 'Should never be requested'),
+        ])
+        return mailstream.GmailMailStream(http, 'recipient@example.adamandpaul.biz', cursor=cursor, **kwargs)
+
+    def test_backfill_should_hand_off_to_history(self):
+        test_message_1 = generate_mock_message('test1234')
+        test_message_2 = generate_mock_message('test5432')
+        test_message_3 = generate_mock_message('test9876')
+        inbox = self.create_inbox([
+            ({'status': '200'}, json.dumps({'historyId': '10'})),
+            ({'status': '200'}, json.dumps({'messages': [{'id': 'test1234'}], 'nextPageToken': 'page2'})),
+            ({'status': '200'}, json.dumps({'messages': [{'id': 'test1234'}, {'id': 'test5432'}]})),
+            ({'status': '200'}, json.dumps(test_message_1)),
+            ({'status': '200'}, json.dumps(test_message_2)),
+            ({'status': '200'}, json.dumps({'historyId': '12'})),
+            # test5432 arrived during the backfill, so it is in history after 10 as well
+            ({'status': '200'}, json.dumps({'history': [
+                {'id': 11, 'messagesAdded': [{'message': test_message_2}]},
+                {'id': 13, 'messagesAdded': [{'message': test_message_3}]},
+            ]})),
+            ({'status': '200'}, json.dumps(test_message_3)),
+        ])
+        chunks = list(inbox.backfill())
+        self.assertEqual([[message['subject'] for message in chunk] for chunk in chunks], [['test1234', 'test5432']])
+        self.assertEqual(json.loads(inbox.cursor)['last_history_id'], 10)
+        histories = inbox.read_many()
+        self.assertEqual([(history_id, [message['subject'] for message in messages])
+                          for history_id, messages in histories],
+                         [(11, []), (13, ['test9876'])])
+
+    def test_stopping_a_backfill_early_should_not_move_the_cursor(self):
+        test_message_1 = generate_mock_message('test1234')
+        inbox = self.create_inbox([
+            ({'status': '200'}, json.dumps({'historyId': '10'})),
+            ({'status': '200'}, json.dumps({'messages': [{'id': 'test1234'}, {'id': 'test5432'}]})),
+            ({'status': '200'}, json.dumps(test_message_1)),
+        ])
+        chunks = inbox.backfill(chunk_size=1)
+        next(chunks)
+        chunks.close()
+        self.assertEqual(json.loads(inbox.cursor)['last_history_id'], 1)
+
+    def test_messages_of_an_interrupted_backfill_should_be_skipped(self):
+        test_message_2 = generate_mock_message('test5432')
+        inbox = self.create_inbox([
+            ({'status': '200'}, json.dumps({'historyId': '10'})),
+            ({'status': '200'}, json.dumps({'messages': [{'id': 'test1234'}, {'id': 'test5432'}]})),
+            ({'status': '200'}, json.dumps(test_message_2)),
+            ({'status': '200'}, json.dumps({'historyId': '12'})),
+            ({'status': '200'}, json.dumps({'history': [
+                {'id': 11, 'messagesAdded': [{'message': generate_mock_message('test1234')}]},
+            ]})),
+        ])
+        chunks = list(inbox.backfill(skip_ids=set(['test1234'])))
+        self.assertEqual([[message['subject'] for message in chunk] for chunk in chunks], [['test5432']])
+        self.assertEqual(inbox.read_many(), [(11, [])])
+
+    def test_expired_cursor_should_be_recovered_by_backfilling(self):
+        clock = FakeClock()
+        test_message_1 = generate_mock_message('test1234')
+        inbox = self.create_inbox([
+            ({'status': '404'}, '{"error": {"code": 404}}'),
+            ({'status': '200'}, json.dumps({'historyId': '500'})),
+            ({'status': '200'}, json.dumps({'messages': [{'id': 'test1234'}]})),
+            ({'status': '200'}, json.dumps(test_message_1)),
+            ({'status': '200'}, json.dumps({'historyId': '500'})),
+        ], cursor='{"last_history_id": 1, "checked_time": 200000}', clock=clock.time)
+        messages = inbox.read()
+        self.assertEqual([message['subject'] for message in messages], ['test1234'])
+        self.assertEqual(json.loads(inbox.cursor)['last_history_id'], 500)
+
+    def test_expired_cursor_should_raise_when_recovery_is_disabled(self):
+        inbox = self.create_inbox([
+            ({'status': '404'}, '{"error": {"code": 404}}'),
+        ], recover_expired_cursor=False)
+        with self.assertRaises(mailstream.CursorExpiredError):
+            inbox.read()
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""Throughput benchmarks of GmailMailStream against the local fake gmail server
+
+Run with ``python -m gmailtool.benchmark``.
+"""
+
+from gmailtool import fakegmail
+from gmailtool import fetch
+from gmailtool import mailstream
+from gmailtool import retry
+
+import argparse
+import httplib2
+import json
+import logging
+import resource
+import sys
+import time
+
+
+logger = logging.getLogger('gmailtool.benchmark')
+
+# The address of the synthetic mailbox benchmarked
+BENCHMARK_MAILBOX = 'benchmark@example.adamandpaul.biz'
+
+# The headers fetched by the metadata format scenario
+BENCHMARK_METADATA_HEADERS = ['From', 'Subject', 'Message-ID']
+
+
+class BenchmarkResult(object):
+    """The measurements of reading a mailbox once
+
+    Attributes:
+        name (str): The scenario name
+        messages (int): The number of messages read
+        seconds (float): The time taken to read them
+        bytes_sent (int): The response bytes the server sent
+        http_requests (int): The number of http requests made
+        api_calls (int): The number of api calls made, counting each call in a batch
+        retries (int): The number of requests retried after errors
+        peak_rss (int): The peak resident memory of the process so far, in bytes
+    """
+
+    def __init__(self, name, messages, seconds, bytes_sent, http_requests, api_calls, retries, peak_rss):
+        self.name = name
+        self.messages = messages
+        self.seconds = seconds
+        self.bytes_sent = bytes_sent
+        self.http_requests = http_requests
+        self.api_calls = api_calls
+        self.retries = retries
+        self.peak_rss = peak_rss
+
+    @property
+    def messages_per_second(self):
+        """float: Messages read per second"""
+        return self.messages / self.seconds if self.seconds > 0 else 0.0
+
+    @property
+    def bytes_per_second(self):
+        """float: Response bytes received per second"""
+        return self.bytes_sent / self.seconds if self.seconds > 0 else 0.0
+
+    @property
+    def api_calls_per_message(self):
+        """float: Api calls made per message read"""
+        return float(self.api_calls) / self.messages if self.messages > 0 else 0.0
+
+    def as_dict(self):
+        """dict: The measurements and rates, for json output"""
+        return {
+            'name': self.name,
+            'messages': self.messages,
+            'seconds': self.seconds,
+            'bytes_sent': self.bytes_sent,
+            'http_requests': self.http_requests,
+            'api_calls': self.api_calls,
+            'retries': self.retries,
+            'peak_rss': self.peak_rss,
+            'messages_per_second': self.messages_per_second,
+            'bytes_per_second': self.bytes_per_second,
+            'api_calls_per_message': self.api_calls_per_message,
+        }
+
+
+def peak_rss():
+    """int: The peak resident memory of the process in bytes"""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS reports bytes
+    if sys.platform == 'darwin':
+        return maxrss
+    return maxrss * 1024
+
+
+def scenarios(concurrency_levels=(1, 2, 4, 8), message_formats=fetch.MESSAGE_FORMATS):
+    """The benchmark scenarios: each fetcher reading raw messages, then each format with batching
+
+    Args:
+        concurrency_levels (list of int): The ThreadedFetcher concurrencies compared
+        message_formats (list of str): The message formats compared
+
+    Returns:
+        list of (str, callable): The name of each scenario and a function called with the server and
+        executor returning the keyword arguments of the stream
+    """
+    def serial(server, executor):
+        return {'fetcher': fetch.SerialFetcher(executor=executor)}
+
+    def batch(server, executor):
+        return {'fetcher': fetch.BatchFetcher(executor=executor)}
+
+    def threaded(concurrency):
+        def stream_kwargs(server, executor):
+            return {'fetcher': fetch.ThreadedFetcher(httplib2.Http,
+                                                     concurrency=concurrency,
+                                                     discovery_cache=server.discovery_cache(),
+                                                     executor=executor)}
+        return stream_kwargs
+
+    def formatted(message_format):
+        def stream_kwargs(server, executor):
+            return {'fetcher': fetch.BatchFetcher(executor=executor),
+                    'message_format': message_format,
+                    'metadata_headers': BENCHMARK_METADATA_HEADERS if message_format == 'metadata' else None}
+        return stream_kwargs
+
+    result = [('serial', serial), ('batch', batch)]
+    result.extend(('threaded-{}'.format(concurrency), threaded(concurrency)) for concurrency in concurrency_levels)
+    result.extend(('format-{}'.format(message_format), formatted(message_format))
+                  for message_format in message_formats)
+    return result
+
+
+def run_scenario(server, mailbox, name, stream_kwargs, histories_per_read=100):
+    """Read every message of a mailbox once and measure it
+
+    Args:
+        server (FakeGmailServer): The running server serving the mailbox
+        mailbox (SyntheticMailbox): The mailbox read
+        name (str): The scenario name
+        stream_kwargs (callable): Called with the server and executor, returns the keyword arguments
+            of the stream, see scenarios
+        histories_per_read (int): The number of histories read at a time
+
+    Returns:
+        BenchmarkResult: The measurements
+    """
+    discovery_cache = server.discovery_cache()
+    http = httplib2.Http()
+    # Fetch the discovery document before measuring
+    discovery_cache.build(http)
+    executor = retry.RequestExecutor()
+    kwargs = stream_kwargs(server, executor)
+    server.reset_stats()
+
+    start = time.time()
+    stream = mailstream.GmailMailStream(http, mailbox.address,
+                                        cursor=json.dumps({'last_history_id': mailbox.first_history_id}),
+                                        discovery_cache=discovery_cache,
+                                        executor=executor,
+                                        seen_window=0,
+                                        **kwargs)
+    messages = 0
+    while True:
+        histories = stream.read_many(histories_per_read)
+        if histories is None:
+            break
+        messages += sum(len(history_messages) for history_id, history_messages in histories)
+    seconds = time.time() - start
+
+    if hasattr(kwargs['fetcher'], 'close'):
+        kwargs['fetcher'].close()
+    stats = server.stats
+    return BenchmarkResult(name, messages, seconds, stats['bytes_sent'], stats['http_requests'], stats['api_calls'],
+                           executor.retries, peak_rss())
+
+
+def run_suite(message_count=1000,
+              message_size=None,
+              messages_per_history=10,
+              latency=0.0,
+              rate_limit_probability=0.0,
+              concurrency_levels=(1, 2, 4, 8),
+              message_formats=fetch.MESSAGE_FORMATS,
+              names=None,
+              seed=0):
+    """Run the benchmark scenarios against a fake gmail server
+
+    Args:
+        message_count (int): The number of messages in the synthetic mailbox
+        message_size (callable): The message size distribution, see SyntheticMailbox
+        messages_per_history (int): The number of messages added in each history
+        latency (float): The seconds the server waits before answering each http request
+        rate_limit_probability (float): The chance each api call is answered with a 429
+        concurrency_levels (list of int): The ThreadedFetcher concurrencies compared
+        message_formats (list of str): The message formats compared
+        names (list of str): Only run the scenarios with these names. None runs every scenario
+        seed (int): Seeds the mailbox and the rate limit injection
+
+    Returns:
+        list of BenchmarkResult: The measurements of each scenario
+    """
+    mailbox = fakegmail.SyntheticMailbox(BENCHMARK_MAILBOX, message_count, message_size=message_size,
+                                         messages_per_history=messages_per_history, seed=seed)
+    results = []
+    with fakegmail.FakeGmailServer([mailbox], latency=latency, rate_limit_probability=rate_limit_probability,
+                                   seed=seed) as server:
+        for name, stream_kwargs in scenarios(concurrency_levels, message_formats):
+            if names is not None and name not in names:
+                continue
+            logger.info('Running benchmark scenario ' + name)
+            results.append(run_scenario(server, mailbox, name, stream_kwargs))
+    return results
+
+
+def format_results(results):
+    """Format benchmark results as a table
+
+    Args:
+        results (list of BenchmarkResult): The results
+
+    Returns:
+        str: The table
+    """
+    lines = ['{:<16} {:>8} {:>10} {:>12} {:>10} {:>10} {:>8} {:>10}'.format(
+        'scenario', 'messages', 'msg/s', 'KiB/s', 'calls/msg', 'http/msg', 'retries', 'rss MiB')]
+    for result in results:
+        http_per_message = float(result.http_requests) / result.messages if result.messages > 0 else 0.0
+        lines.append('{:<16} {:>8} {:>10.1f} {:>12.1f} {:>10.2f} {:>10.2f} {:>8} {:>10.1f}'.format(
+            result.name, result.messages, result.messages_per_second, result.bytes_per_second / 1024,
+            result.api_calls_per_message, http_per_message, result.retries, result.peak_rss / 1024.0 / 1024))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    """Run the benchmark suite from the command line
+
+    Args:
+        argv (list of str): The command line arguments. Defaults to sys.argv[1:]
+    """
+    parser = argparse.ArgumentParser(prog='python -m gmailtool.benchmark',
+                                     description='Benchmark reading a synthetic mailbox from a local fake gmail server')
+    parser.add_argument('--messages', type=int, default=1000,
+                        help='The number of messages in the mailbox')
+    parser.add_argument('--median-size', type=int, default=8 * 1024,
+                        help='The median message size in bytes')
+    parser.add_argument('--size-sigma', type=float, default=1.0,
+                        help='The spread of the lognormal message sizes, 0 for every message to be the median size')
+    parser.add_argument('--messages-per-history', type=int, default=10,
+                        help='The number of messages added in each history. Messages are fetched a history at a time')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='The seconds the server waits before answering each http request')
+    parser.add_argument('--rate-limit-probability', type=float, default=0.0,
+                        help='The chance each api call is answered with a 429 rate limit error')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help='The threaded fetcher concurrencies compared')
+    parser.add_argument('--scenario', action='append', dest='scenarios',
+                        help='Only run this scenario, may be given more than once. Run one scenario per process '
+                             'to measure the peak memory of each scenario alone')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seeds the message sizes and the rate limit injection')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the results as json')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARN)
+
+    results = run_suite(message_count=args.messages,
+                        message_size=fakegmail.lognormal_sizes(args.median_size, args.size_sigma),
+                        messages_per_history=args.messages_per_history,
+                        latency=args.latency,
+                        rate_limit_probability=args.rate_limit_probability,
+                        concurrency_levels=args.concurrency,
+                        names=args.scenarios,
+                        seed=args.seed)
+    if args.json:
+        print(json.dumps([result.as_dict() for result in results], indent=2))
+    else:
+        print(format_results(results))
+
+
+if __name__ == '__main__':
+    main()
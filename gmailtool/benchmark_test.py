@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""Testing the benchmark python module
+"""
+
+from gmailtool import benchmark
+from gmailtool import fakegmail
+
+import unittest
+
+
+class TestBenchmarkSuite(unittest.TestCase):
+    """Testing every scenario reads the whole mailbox and is measured"""
+
+    def test_suite_should_measure_each_scenario(self):
+        results = benchmark.run_suite(message_count=6,
+                                      message_size=fakegmail.lognormal_sizes(1024, sigma=0),
+                                      messages_per_history=3,
+                                      concurrency_levels=[2])
+        self.assertEqual([result.name for result in results],
+                         ['serial', 'batch', 'threaded-2',
+                          'format-raw', 'format-full', 'format-metadata', 'format-minimal'])
+        for result in results:
+            self.assertEqual(result.messages, 6)
+            self.assertGreaterEqual(result.api_calls_per_message, 1)
+            self.assertGreater(result.peak_rss, 0)
+        by_name = dict((result.name, result) for result in results)
+        self.assertLess(by_name['batch'].http_requests, by_name['serial'].http_requests)
+        self.assertLess(by_name['format-metadata'].bytes_sent, by_name['format-raw'].bytes_sent)
+        self.assertIn('threaded-2', benchmark.format_results(results))
+
+    def test_suite_should_only_run_named_scenarios(self):
+        results = benchmark.run_suite(message_count=2, names=['batch'])
+        self.assertEqual([result.name for result in results], ['batch'])
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""On disk cache of gmail api message resources
+"""
+
+import collections
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import zlib
+
+
+logger = logging.getLogger('gmailtool.cache')
+
+
+class MessageCache(object):
+    """A size bounded cache of message resources keyed by gmail message id
+
+    Gmail messages never change once they exist, so a message fetched once never needs to be
+    downloaded again. Each message is stored in its own file. When the total size of the files
+    exceeds max_bytes the least recently used messages are removed. File modification times
+    record use, so the usage order survives between processes.
+    """
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024, compress=False):
+        """Initialize a message cache, creating the cache directory if needed
+
+        Args:
+            directory (str): The directory the cached messages are stored in
+            max_bytes (int): The maximum total size of the cached files
+            compress (bool): Compress newly cached messages with zlib
+        """
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._compress = compress
+        self._lock = threading.Lock()
+        self._sizes = collections.OrderedDict()
+        self._total_bytes = 0
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        entries = []
+        for filename in os.listdir(directory):
+            if filename.startswith('.'):
+                continue
+            stat = os.stat(os.path.join(directory, filename))
+            entries.append((stat.st_mtime, filename, stat.st_size))
+        for mtime, filename, size in sorted(entries):
+            self._sizes[filename] = size
+            self._total_bytes += size
+
+    @property
+    def total_bytes(self):
+        """int: The total size of the cached files"""
+        return self._total_bytes
+
+    def get(self, message_id):
+        """Get a cached message
+
+        Args:
+            message_id (str): The gmail message id
+
+        Returns:
+            dict or None: The cached message resource, None if the message is not cached
+        """
+        with self._lock:
+            for filename in self._filenames(message_id):
+                if filename in self._sizes:
+                    break
+            else:
+                return None
+            path = os.path.join(self._directory, filename)
+            try:
+                with open(path, 'rb') as fin:
+                    data = fin.read()
+                os.utime(path, None)
+            except (IOError, OSError):
+                logger.warning('Cached message disappeared: ' + path)
+                self._forget(filename)
+                return None
+            self._sizes[filename] = self._sizes.pop(filename)
+        if filename.endswith('.z'):
+            data = zlib.decompress(data)
+        return json.loads(data)
+
+    def put(self, message_id, message):
+        """Cache a message, evicting the least recently used messages if the cache is full
+
+        Args:
+            message_id (str): The gmail message id
+            message (dict): The message resource
+        """
+        data = json.dumps(message)
+        filename = self._filenames(message_id)[0]
+        if self._compress:
+            data = zlib.compress(data)
+            filename += '.z'
+        if len(data) > self._max_bytes:
+            return
+        path = os.path.join(self._directory, filename)
+        file_handle, temp_path = tempfile.mkstemp(prefix='.' + filename + '.', dir=self._directory)
+        with os.fdopen(file_handle, 'wb') as fout:
+            fout.write(data)
+        os.rename(temp_path, path)
+        with self._lock:
+            for existing in self._filenames(message_id):
+                if existing in self._sizes and existing != filename:
+                    os.remove(os.path.join(self._directory, existing))
+                self._forget(existing)
+            self._sizes[filename] = len(data)
+            self._total_bytes += len(data)
+            self._evict()
+
+    def _filenames(self, message_id):
+        """The possible cache file names of a message, uncompressed first
+
+        Args:
+            message_id (str): The gmail message id
+
+        Returns:
+            list of str: The uncompressed and compressed file names
+        """
+        filename = re.sub('[^A-Za-z0-9_-]', '_', message_id) + '.json'
+        return [filename, filename + '.z']
+
+    def _forget(self, filename):
+        """Stop tracking a cache file. Must be called with the lock held"""
+        size = self._sizes.pop(filename, None)
+        if size is not None:
+            self._total_bytes -= size
+
+    def _evict(self):
+        """Remove least recently used files until the cache fits in max_bytes. Must be called with the lock held"""
+        while self._total_bytes > self._max_bytes:
+            filename, size = self._sizes.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(os.path.join(self._directory, filename))
+            except OSError:
+                logger.warning('Could not evict cached message: ' + filename)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Testing the cache python module
+"""
+
+from gmailtool import cache
+from gmailtool import mailstream
+from gmailtool.mailstream_test import generate_mock_message
+from gmailtool.mailstream_test import get_gmail_api_descovery_json
+
+import apiclient.http
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class TestMessageCache(unittest.TestCase):
+    """Testing storing and evicting cached messages"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.message_size = len(json.dumps(generate_mock_message('test0')))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_get_should_return_put_message(self):
+        message_cache = cache.MessageCache(self.directory)
+        message_cache.put('test1234', generate_mock_message('test1234'))
+        self.assertEqual(message_cache.get('test1234'), generate_mock_message('test1234'))
+        self.assertIsNone(message_cache.get('test5432'))
+
+    def test_compressed_messages_should_be_readable_by_uncompressed_cache(self):
+        cache.MessageCache(self.directory, compress=True).put('test1234', generate_mock_message('test1234'))
+        self.assertEqual(cache.MessageCache(self.directory).get('test1234'), generate_mock_message('test1234'))
+
+    def test_least_recently_used_message_should_be_evicted(self):
+        message_cache = cache.MessageCache(self.directory, max_bytes=self.message_size * 2)
+        message_cache.put('test1', generate_mock_message('test1'))
+        message_cache.put('test2', generate_mock_message('test2'))
+        message_cache.get('test1')
+        message_cache.put('test3', generate_mock_message('test3'))
+        self.assertIsNotNone(message_cache.get('test1'))
+        self.assertIsNone(message_cache.get('test2'))
+        self.assertIsNotNone(message_cache.get('test3'))
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+        self.assertLessEqual(message_cache.total_bytes, self.message_size * 2)
+
+    def test_cache_should_reload_existing_messages(self):
+        cache.MessageCache(self.directory).put('test1234', generate_mock_message('test1234'))
+        message_cache = cache.MessageCache(self.directory)
+        self.assertEqual(message_cache.total_bytes, len(json.dumps(generate_mock_message('test1234'))))
+        self.assertIsNotNone(message_cache.get('test1234'))
+
+
+class TestReplayFromCache(unittest.TestCase):
+    """Testing a replayed history is read from the cache without fetching messages"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.message_cache = cache.MessageCache(self.directory)
+        self.test_message = generate_mock_message('test1234')
+        self.history_list = json.dumps({'history': [{'id': 2, 'messagesAdded': [{'message': self.test_message}]}]})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read_history(self, responses):
+        http = apiclient.http.HttpMockSequence([
+            ({'status': '200'}, get_gmail_api_descovery_json()),
+            ({'status': '200'}, self.history_list),
+        ] + responses + [
+            ({'status': '403'}, 'Should never be requested'),
+        ])
+        inbox = mailstream.GmailMailStream(http,
+                                           'recipient@example.adamandpaul.biz',
+                                           cursor='{"last_history_id": 1}',
+                                           cache=self.message_cache)
+        return inbox.read()
+
+    def test_replay_should_only_cost_the_history_list(self):
+        first = self.read_history([({'status': '200'}, json.dumps(self.test_message))])
+        replay = self.read_history([])
+        self.assertEqual(first[0]['subject'], 'test1234')
+        self.assertEqual(replay[0]['subject'], 'test1234')
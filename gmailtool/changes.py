@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Compact events describing the changes recorded in gmail history
+"""
+
+
+# Message added to the mailbox
+MESSAGE_ADDED = 'messageAdded'
+
+# Message deleted from the mailbox
+MESSAGE_DELETED = 'messageDeleted'
+
+# Labels added to a message
+LABEL_ADDED = 'labelAdded'
+
+# Labels removed from a message
+LABEL_REMOVED = 'labelRemoved'
+
+# Every history type, in the order the events of a single history are emitted
+HISTORY_TYPES = [MESSAGE_ADDED, LABEL_ADDED, LABEL_REMOVED, MESSAGE_DELETED]
+
+# The field of a history record holding the changes of each history type
+_HISTORY_FIELDS = {
+    MESSAGE_ADDED: 'messagesAdded',
+    MESSAGE_DELETED: 'messagesDeleted',
+    LABEL_ADDED: 'labelsAdded',
+    LABEL_REMOVED: 'labelsRemoved',
+}
+
+
+class ChangeEvent(object):
+    """A single change to a single message
+
+    Events use __slots__ as a mailbox can produce very many of them.
+
+    Attributes:
+        history_id (int): The history the change was made in
+        change_type (str): One of HISTORY_TYPES
+        message_id (str): The gmail id of the changed message
+        thread_id (str): The gmail thread id of the changed message
+        label_ids (list of str): The labels added or removed by a label change, or the labels of
+            an added message. None for deleted messages
+        message (email message): The added message, None for other changes or when the body
+            was not fetched
+    """
+
+    __slots__ = ('history_id', 'change_type', 'message_id', 'thread_id', 'label_ids', 'message')
+
+    def __init__(self, history_id, change_type, message_id, thread_id=None, label_ids=None, message=None):
+        self.history_id = history_id
+        self.change_type = change_type
+        self.message_id = message_id
+        self.thread_id = thread_id
+        self.label_ids = label_ids
+        self.message = message
+
+    def __repr__(self):
+        return '<ChangeEvent {} {} {} {}>'.format(self.history_id, self.change_type, self.message_id,
+                                                  self.label_ids)
+
+
+def events_from_history(history):
+    """The change events of a history record
+
+    Args:
+        history (dict): A history record from the gmail history list
+
+    Returns:
+        list of ChangeEvent: The events, added messages first then label changes then deletions
+    """
+    history_id = int(history['id'])
+    events = []
+    for change_type in HISTORY_TYPES:
+        for change in history.get(_HISTORY_FIELDS[change_type], []):
+            message = change['message']
+            if change_type in (LABEL_ADDED, LABEL_REMOVED):
+                label_ids = change.get('labelIds', [])
+            elif change_type == MESSAGE_ADDED:
+                label_ids = message.get('labelIds')
+            else:
+                label_ids = None
+            events.append(ChangeEvent(history_id, change_type, message['id'], message.get('threadId'), label_ids))
+    return events
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""Testing the changes python module
+"""
+
+from gmailtool import changes
+from gmailtool import fetch
+from gmailtool import mailstream
+from gmailtool.fetch_test import generate_mock_batch_response
+from gmailtool.mailmessage_test import RecordingHttpMockSequence
+from gmailtool.mailstream_test import generate_mock_message
+from gmailtool.mailstream_test import get_gmail_api_descovery_json
+
+import json
+import unittest
+
+
+def summarize(events):
+    return [(event.history_id, event.change_type, event.message_id, event.label_ids,
+             event.message['subject'] if event.message is not None else None)
+            for event in events]
+
+
+class TestReadChanges(unittest.TestCase):
+    """Testing every history type is read in one pass"""
+
+    def create_inbox(self, responses, **kwargs):
+        self.http = RecordingHttpMockSequence([
+            ({'status': '200'}, get_gmail_api_descovery_json()),
+        ] + responses + [
+            ({'status': '400'}, 'Should never be requested'),
+        ])
+        return mailstream.GmailMailStream(self.http,
+                                          'recipient@example.adamandpaul.biz',
+                                          cursor='{"last_history_id": 1}',
+                                          **kwargs)
+
+    def test_changes_should_only_download_added_messages(self):
+        test_message = generate_mock_message('test1234')
+        test_message['labelIds'] = ['INBOX']
+        inbox = self.create_inbox([
+            ({'status': '200'}, json.dumps({'history': [
+                {'id': 2, 'messagesAdded': [{'message': {'id': 'test1234', 'labelIds': ['INBOX']}}]},
+                {'id': 3, 'labelsAdded': [{'message': {'id': 'old1'}, 'labelIds': ['STARRED']}],
+                          'labelsRemoved': [{'message': {'id': 'old2'}, 'labelIds': ['UNREAD']}]},
+                {'id': 4, 'messagesDeleted': [{'message': {'id': 'old3'}}]},
+            ]})),
+            ({'status': '200'}, json.dumps(test_message)),
+        ])
+        events = inbox.read_changes()
+        self.assertEqual(summarize(events), [
+            (2, changes.MESSAGE_ADDED, 'test1234', ['INBOX'], 'test1234'),
+            (3, changes.LABEL_ADDED, 'old1', ['STARRED'], None),
+            (3, changes.LABEL_REMOVED, 'old2', ['UNREAD'], None),
+            (4, changes.MESSAGE_DELETED, 'old3', None, None),
+        ])
+        self.assertEqual(json.loads(inbox.cursor)['last_history_id'], 4)
+        for history_type in changes.HISTORY_TYPES:
+            self.assertIn('historyTypes=' + history_type, self.http.uris[1])
+
+    def test_messages_deleted_again_should_not_be_downloaded(self):
+        inbox = self.create_inbox([
+            ({'status': '200'}, json.dumps({'history': [
+                {'id': 2, 'messagesAdded': [{'message': {'id': 'test1234'}}]},
+                {'id': 3, 'messagesDeleted': [{'message': {'id': 'test1234'}}]},
+            ]})),
+        ])
+        self.assertEqual(summarize(inbox.read_changes()), [
+            (2, changes.MESSAGE_ADDED, 'test1234', None, None),
+            (3, changes.MESSAGE_DELETED, 'test1234', None, None),
+        ])
+
+    def test_messages_deleted_in_a_later_history_should_be_left_out(self):
+        test_message = generate_mock_message('test1234')
+        inbox = self.create_inbox([
+            ({'status': '200'}, json.dumps({'history': [
+                {'id': 2, 'messagesAdded': [{'message': {'id': 'test1234'}}, {'message': {'id': 'gone1'}}]},
+                {'id': 3, 'labelsAdded': [{'message': {'id': 'gone1'}, 'labelIds': ['STARRED']}]},
+            ]})),
+            generate_mock_batch_response([
+                ('test1234', '200 OK', json.dumps(test_message)),
+                ('gone1', '404 Not Found', '{"error": {"code": 404}}'),
+            ]),
+            generate_mock_batch_response([('test1234', '200 OK', json.dumps(test_message))]),
+        ], fetcher=fetch.BatchFetcher())
+        self.assertEqual(summarize(inbox.read_changes()), [
+            (2, changes.MESSAGE_ADDED, 'test1234', None, 'test1234'),
+            (3, changes.LABEL_ADDED, 'gone1', ['STARRED'], None),
+        ])
+        self.assertEqual(json.loads(inbox.cursor)['last_history_id'], 3)
+
+    def test_message_not_found_by_a_single_request_should_be_left_out(self):
+        test_message = generate_mock_message('test1234')
+        inbox = self.create_inbox([
+            ({'status': '200'}, json.dumps({'history': [
+                {'id': 2, 'messagesAdded': [{'message': {'id': 'gone1'}}, {'message': {'id': 'test1234'}}]},
+            ]})),
+            ({'status': '404'}, '{"error": {"code": 404}}'),
+            ({'status': '404'}, '{"error": {"code": 404}}'),
+            ({'status': '200'}, json.dumps(test_message)),
+        ])
+        self.assertEqual(summarize(inbox.read_changes()), [
+            (2, changes.MESSAGE_ADDED, 'test1234', None, 'test1234'),
+        ])
+        self.assertEqual(json.loads(inbox.cursor)['last_history_id'], 2)
+
+    def test_no_new_history_should_return_none(self):
+        inbox = self.create_inbox([
+            ({'status': '200'}, json.dumps({'history': []})),
+        ])
+        self.assertIsNone(inbox.read_changes())
+
+    def test_events_should_use_slots(self):
+        event = changes.ChangeEvent(2, changes.MESSAGE_DELETED, 'test1234')
+        self.assertFalse(hasattr(event, '__dict__'))
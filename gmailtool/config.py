@@ -18,4 +18,19 @@ oauth_client_secret = {
 
 oauth_scopes = ['https://www.googleapis.com/auth/gmail.readonly']
 
+# Granted by auth --pubsub, for pulling gmail watch notifications
+pubsub_oauth_scope = 'https://www.googleapis.com/auth/pubsub'
+
 oauth_credentials_storage_filename = 'credentials.json'
+
+cursor_storage_filename = 'cursors.json'
+
+export_cursor_storage_filename = 'export-cursors.json'
+
+export_backfill_progress_dirname = 'export-backfill'
+
+message_cache_dirname = 'message-cache'
+
+discovery_cache_filename = 'gmail-discovery.json'
+
+message_index_filename = 'message-index.sqlite'
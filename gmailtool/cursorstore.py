@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""Durable storage of mail stream cursors
+"""
+
+import json
+import logging
+import os
+import tempfile
+import time
+
+
+logger = logging.getLogger('gmailtool.cursorstore')
+
+
+def atomic_write(path, data):
+    """Replace the contents of a file so that a crash leaves either the old or the new contents
+
+    The data is written to a temporary file in the same directory, flushed to disk and renamed
+    over the original file.
+
+    Args:
+        path (str): The path of the file to replace
+        data (str): The new contents of the file
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    file_handle, temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', dir=directory)
+    try:
+        with os.fdopen(file_handle, 'w') as fout:
+            fout.write(data)
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.rename(temp_path, path)
+    except:  # noqa: B901 the temporary file is removed before re-raising
+        os.remove(temp_path)
+        raise
+    directory_handle = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(directory_handle)
+    finally:
+        os.close(directory_handle)
+
+
+class CursorStore(object):
+    """Cursors of many mailboxes checkpointed together in a single file
+
+    Cursors set on the store are only written to disk at a checkpoint, which happens once
+    checkpoint_histories histories have been recorded or checkpoint_seconds have passed since the
+    last checkpoint. Callers set a cursor only after the messages before it have been delivered,
+    so after a crash at most one checkpoint interval of messages is delivered again and none are
+    skipped.
+    """
+
+    def __init__(self, path, checkpoint_histories=100, checkpoint_seconds=30.0, clock=time.time):
+        """Initialize a cursor store, loading any previously checkpointed cursors
+
+        Args:
+            path (str): The path of the file holding the cursors
+            checkpoint_histories (int): The number of histories recorded before a checkpoint is taken
+            checkpoint_seconds (float): The number of seconds after which pending cursors are checkpointed
+            clock (callable): Returns the current time in seconds
+        """
+        self._path = path
+        self._checkpoint_histories = checkpoint_histories
+        self._checkpoint_seconds = checkpoint_seconds
+        self._clock = clock
+        self._cursors = {}
+        self._pending_histories = 0
+        self._dirty = False
+        self._last_checkpoint = clock()
+        if os.path.exists(path):
+            with open(path, 'r') as fin:
+                self._cursors = json.load(fin)
+
+    def get(self, mailbox):
+        """Get the cursor of a mailbox
+
+        Args:
+            mailbox (str): The mailbox
+
+        Returns:
+            str or None: The cursor of the mailbox, None if no cursor has been stored
+        """
+        return self._cursors.get(mailbox)
+
+    def set(self, mailbox, cursor, histories=1):
+        """Record the cursor of a mailbox, checkpointing if one is due
+
+        Args:
+            mailbox (str): The mailbox
+            cursor (str): The cursor, positioned after messages which have been delivered
+            histories (int): The number of histories the cursor advanced by
+        """
+        if self._cursors.get(mailbox) != cursor:
+            self._cursors[mailbox] = cursor
+            self._dirty = True
+        self._pending_histories += histories
+        self.checkpoint_if_due()
+
+    def checkpoint_if_due(self):
+        """Checkpoint if enough histories have been recorded or enough time has passed
+
+        Returns:
+            bool: True if a checkpoint was taken
+        """
+        if self._pending_histories >= self._checkpoint_histories or \
+                self._clock() - self._last_checkpoint >= self._checkpoint_seconds:
+            return self.checkpoint()
+        return False
+
+    def checkpoint(self):
+        """Atomically write the cursors to disk if any have changed since the last checkpoint
+
+        Returns:
+            bool: True if a checkpoint was taken
+        """
+        self._pending_histories = 0
+        self._last_checkpoint = self._clock()
+        if not self._dirty:
+            return False
+        logger.debug('Checkpointing {} cursors to {}'.format(len(self._cursors), self._path))
+        atomic_write(self._path, json.dumps(self._cursors, indent=2, sort_keys=True))
+        self._dirty = False
+        return True
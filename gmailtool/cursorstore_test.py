@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""Testing the cursorstore python module
+"""
+
+from gmailtool import cursorstore
+from gmailtool import scheduler
+from gmailtool.scheduler_test import FakeClock
+from gmailtool.scheduler_test import FakeStream
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class TestCheckpointing(unittest.TestCase):
+    """Testing cursors are only written to disk at checkpoints"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cursors.json')
+        self.clock = FakeClock()
+        self.store = cursorstore.CursorStore(self.path,
+                                             checkpoint_histories=3,
+                                             checkpoint_seconds=60,
+                                             clock=self.clock.time)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def saved_cursor(self, mailbox):
+        return cursorstore.CursorStore(self.path).get(mailbox)
+
+    def test_cursors_should_not_be_written_before_a_checkpoint_is_due(self):
+        self.store.set('a@example.adamandpaul.biz', '{"last_history_id": 2}')
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(self.store.get('a@example.adamandpaul.biz'), '{"last_history_id": 2}')
+
+    def test_checkpoint_should_be_taken_after_checkpoint_histories(self):
+        self.store.set('a@example.adamandpaul.biz', '{"last_history_id": 2}', histories=2)
+        self.store.set('b@example.adamandpaul.biz', '{"last_history_id": 7}', histories=1)
+        self.assertEqual(self.saved_cursor('a@example.adamandpaul.biz'), '{"last_history_id": 2}')
+        self.assertEqual(self.saved_cursor('b@example.adamandpaul.biz'), '{"last_history_id": 7}')
+
+    def test_checkpoint_should_be_taken_after_checkpoint_seconds(self):
+        self.store.set('a@example.adamandpaul.biz', '{"last_history_id": 2}')
+        self.clock.sleep(60)
+        self.assertTrue(self.store.checkpoint_if_due())
+        self.assertEqual(self.saved_cursor('a@example.adamandpaul.biz'), '{"last_history_id": 2}')
+
+    def test_checkpoint_should_leave_no_temporary_files(self):
+        self.store.set('a@example.adamandpaul.biz', '{"last_history_id": 2}')
+        self.store.checkpoint()
+        self.store.set('a@example.adamandpaul.biz', '{"last_history_id": 3}')
+        self.store.checkpoint()
+        self.assertEqual(os.listdir(self.directory), ['cursors.json'])
+
+    def test_unchanged_cursors_should_not_be_rewritten(self):
+        self.store.set('a@example.adamandpaul.biz', '{"last_history_id": 2}')
+        self.assertTrue(self.store.checkpoint())
+        self.store.set('a@example.adamandpaul.biz', '{"last_history_id": 2}')
+        self.assertFalse(self.store.checkpoint())
+
+
+class TestSchedulerCheckpointing(unittest.TestCase):
+    """Testing the scheduler only records cursors of delivered histories"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cursors.json')
+        self.store = cursorstore.CursorStore(self.path, checkpoint_histories=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_cursor_should_be_recorded_after_handler(self):
+        follower = scheduler.Scheduler(lambda *args: None, cursor_store=self.store, histories_per_turn=2)
+        follower.add('a@example.adamandpaul.biz', FakeStream([1, 2, 3]))
+        follower.run(until_idle=True)
+        saved = cursorstore.CursorStore(self.path).get('a@example.adamandpaul.biz')
+        self.assertEqual(json.loads(saved)['last_history_id'], 3)
+
+    def test_cursor_should_not_be_recorded_when_handler_fails(self):
+        def handler(mailbox, history_id, messages):
+            if history_id == 3:
+                raise RuntimeError('handler failed')
+
+        follower = scheduler.Scheduler(handler, cursor_store=self.store, histories_per_turn=2)
+        follower.add('a@example.adamandpaul.biz', FakeStream([1, 2, 3, 4]))
+        follower.run(until_idle=True)
+        saved = cursorstore.CursorStore(self.path).get('a@example.adamandpaul.biz')
+        self.assertEqual(json.loads(saved)['last_history_id'], 2)
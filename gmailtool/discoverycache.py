@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""Build gmail api service objects without fetching the discovery document every time
+"""
+
+from gmailtool import cursorstore
+
+import apiclient
+import apiclient.errors
+import httplib2
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+
+
+logger = logging.getLogger('gmailtool.discoverycache')
+
+DISCOVERY_URI = apiclient.discovery.DISCOVERY_URI.format(api='gmail', apiVersion='v1')
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_discovery_cache(path, ttl=24 * 60 * 60):
+    """Get the discovery cache for a path, shared by everything in the process using that path
+
+    Args:
+        path (str): The file the discovery document is cached in
+        ttl (float): The number of seconds the cached document is used for before it is fetched again
+
+    Returns:
+        DiscoveryCache: The discovery cache
+    """
+    path = os.path.abspath(path)
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = DiscoveryCache(path, ttl=ttl)
+        return _caches[path]
+
+
+class DiscoveryCache(object):
+    """Build gmail api service objects from a discovery document kept on disk and in memory
+
+    The discovery document is fetched at most once per ttl and parsed at most once per process.
+    Service objects are shared between everyone building a service with the same http object.
+    When the document can not be fetched an expired copy is used, and without one building fails.
+    """
+
+    def __init__(self, path=None, ttl=24 * 60 * 60, discovery_uri=DISCOVERY_URI, clock=time.time):
+        """Initialize a discovery cache
+
+        Args:
+            path (str): The file the discovery document is cached in. None to only cache in memory
+            ttl (float): The number of seconds the cached document is used for before it is fetched again
+            discovery_uri (str): The uri the discovery document is fetched from
+            clock (callable): Returns the current time in seconds
+        """
+        self._path = path
+        self._ttl = ttl
+        self._discovery_uri = discovery_uri
+        self._clock = clock
+        self._document = None
+        self._document_time = None
+        self._services = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def build(self, http):
+        """Build a gmail api service object
+
+        Args:
+            http (http): The oauthed http object requests are made with
+
+        Returns:
+            Resource: The gmail api service object
+
+        Raises:
+            HttpError: The discovery document could not be fetched and there is no expired copy
+            HttpLib2Error: As for HttpError
+        """
+        self._get_document(http)
+        with self._lock:
+            service = self._services.get(http)
+            if service is None:
+                service = apiclient.discovery.build_from_document(self._document, http=http)
+                self._services[http] = service
+            return service
+
+    def _get_document(self, http):
+        """Get the parsed discovery document from memory, disk or the network
+
+        The lock is not held while fetching, so a slow fetch does not hold up streams which can
+        use the document in memory.
+
+        Args:
+            http (http): The http object used if the document needs to be fetched
+
+        Returns:
+            dict: The discovery document
+        """
+        with self._lock:
+            now = self._clock()
+            if self._document is not None and now - self._document_time < self._ttl:
+                return self._document
+            if self._path is not None and os.path.exists(self._path):
+                cached_time = os.path.getmtime(self._path)
+                if now - cached_time < self._ttl:
+                    logger.debug('Using cached discovery document: ' + self._path)
+                    self._set_document(self._read(self._path), cached_time)
+                    return self._document
+
+        try:
+            document = self._fetch(http)
+        except (apiclient.errors.HttpError, httplib2.HttpLib2Error, IOError, ValueError) as error:
+            with self._lock:
+                if self._document is not None:
+                    logger.warning('Could not fetch discovery document, keeping the expired copy: ' + str(error))
+                    return self._document
+                if self._path is None or not os.path.exists(self._path):
+                    raise
+                logger.warning('Could not fetch discovery document, using the expired copy in ' +
+                               self._path + ': ' + str(error))
+                self._set_document(self._read(self._path), os.path.getmtime(self._path))
+                return self._document
+
+        if self._path is not None:
+            cursorstore.atomic_write(self._path, json.dumps(document))
+        with self._lock:
+            self._set_document(document, now)
+            return self._document
+
+    def _set_document(self, document, document_time):
+        """Replace the in memory document, discarding services built from the previous one"""
+        self._document = document
+        self._document_time = document_time
+        self._services = weakref.WeakKeyDictionary()
+
+    def _fetch(self, http):
+        """Fetch the discovery document
+
+        Args:
+            http (http): The http object to fetch with
+
+        Returns:
+            dict: The discovery document
+        """
+        logger.debug('Fetching discovery document: ' + self._discovery_uri)
+        response, content = http.request(self._discovery_uri)
+        if int(response.status) >= 400:
+            raise apiclient.errors.HttpError(response, content, uri=self._discovery_uri)
+        return json.loads(content)
+
+    def _read(self, path):
+        """Read a discovery document from a file
+
+        Args:
+            path (str): The file
+
+        Returns:
+            dict: The discovery document
+        """
+        with open(path, 'r') as fin:
+            return json.load(fin)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""Testing the discoverycache python module
+"""
+
+from gmailtool import discoverycache
+from gmailtool import mailstream
+from gmailtool.mailstream_test import get_gmail_api_descovery_json
+from gmailtool.scheduler_test import FakeClock
+
+import apiclient.errors
+import apiclient.http
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class TestDiscoveryCache(unittest.TestCase):
+    """Testing the discovery document is fetched once and reused"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'gmail-discovery.json')
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_document_should_be_fetched_and_saved(self):
+        http = apiclient.http.HttpMockSequence([
+            ({'status': '200'}, get_gmail_api_descovery_json()),
+            ({'status': '403'}, 'Should never be requested'),
+        ])
+        cache = discoverycache.DiscoveryCache(self.path)
+        api = cache.build(http)
+        self.assertTrue(os.path.exists(self.path))
+        self.assertIs(cache.build(http), api, 'expected the service to be shared for the same http object')
+
+    def test_stream_should_start_without_fetching_a_saved_document(self):
+        discoverycache.DiscoveryCache(self.path).build(apiclient.http.HttpMockSequence([
+            ({'status': '200'}, get_gmail_api_descovery_json()),
+        ]))
+        http = apiclient.http.HttpMockSequence([
+            ({'status': '200'}, '{"historyId": 12345}'),
+            ({'status': '403'}, 'Should never be requested'),
+        ])
+        inbox = mailstream.GmailMailStream(http,
+                                           'email@example.adamandpaul.biz',
+                                           discovery_cache=discoverycache.DiscoveryCache(self.path))
+        self.assertEqual(json.loads(inbox.cursor)['last_history_id'], 12345)
+
+    def test_expired_document_should_be_fetched_again(self):
+        http = apiclient.http.HttpMockSequence([
+            ({'status': '200'}, get_gmail_api_descovery_json()),
+            ({'status': '200'}, get_gmail_api_descovery_json()),
+            ({'status': '403'}, 'Should never be requested'),
+        ])
+        cache = discoverycache.DiscoveryCache(ttl=60, clock=self.clock.time)
+        cache.build(http)
+        self.clock.sleep(61)
+        cache.build(http)
+        response, content = http.request('https://www.googleapis.com/')
+        self.assertEqual(int(response.status), 403, 'expected both discovery documents to have been fetched')
+
+    def test_build_should_fail_when_fetching_fails_without_a_copy(self):
+        http = apiclient.http.HttpMockSequence([
+            ({'status': '503'}, 'Unavailable'),
+        ])
+        with self.assertRaises(apiclient.errors.HttpError):
+            discoverycache.DiscoveryCache(self.path).build(http)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_expired_saved_document_should_be_used_when_fetching_fails(self):
+        discoverycache.DiscoveryCache(self.path).build(apiclient.http.HttpMockSequence([
+            ({'status': '200'}, get_gmail_api_descovery_json()),
+        ]))
+        os.utime(self.path, (0, 0))
+        http = apiclient.http.HttpMockSequence([
+            ({'status': '503'}, 'Unavailable'),
+        ])
+        api = discoverycache.DiscoveryCache(self.path).build(http)
+        self.assertTrue(hasattr(api, 'users'))
+
+    def test_lock_should_not_be_held_while_fetching(self):
+        cache = discoverycache.DiscoveryCache()
+        locked_while_fetching = []
+
+        class LockCheckingHttp(apiclient.http.HttpMockSequence):
+
+            def request(self, *args, **kwargs):
+                acquired = cache._lock.acquire(False)
+                if acquired:
+                    cache._lock.release()
+                locked_while_fetching.append(not acquired)
+                return super(LockCheckingHttp, self).request(*args, **kwargs)
+
+        cache.build(LockCheckingHttp([({'status': '200'}, get_gmail_api_descovery_json())]))
+        self.assertEqual(locked_while_fetching, [False])
+
+    def test_caches_should_be_shared_by_path(self):
+        self.assertIs(discoverycache.get_discovery_cache(self.path), discoverycache.get_discovery_cache(self.path))
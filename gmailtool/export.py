@@ -0,0 +1,445 @@
+# -*- coding: utf-8 -*-
+"""Export mail to mbox files and Maildir directories
+"""
+
+from gmailtool import auth
+from gmailtool import config
+from gmailtool import cursorstore
+from gmailtool import discoverycache
+from gmailtool import fetch
+from gmailtool import httppool
+from gmailtool import mailstream
+from gmailtool import messageindex
+from gmailtool import quota
+from gmailtool import retry
+
+import argparse
+import hashlib
+import itertools
+import logging
+import os
+import re
+import socket
+import sys
+import time
+
+
+logger = logging.getLogger('gmailtool.export')
+
+# The formats messages can be exported in
+EXPORT_FORMATS = ('mbox', 'maildir')
+
+# The sender written on the From_ line separating messages in an mbox file. Taking the real
+# sender would mean parsing the headers of every message.
+MBOX_SENDER = 'MAILER-DAEMON'
+
+# The size of the write buffer of an mbox file
+MBOX_BUFFER_BYTES = 1024 * 1024
+
+# Lines which would be read as the start of a new message in an mbox file, see the mboxrd format
+_MBOX_FROM_LINE = re.compile(r'^(>*From )', re.MULTILINE)
+
+
+def message_bytes(message):
+    """The bytes of a message as received from gmail
+
+    Args:
+        message (email message or LazyMessage): The message
+
+    Returns:
+        str: The bytes of the message
+    """
+    raw = getattr(message, 'raw', None)
+    if raw is not None:
+        return raw
+    return message.as_string()
+
+
+def message_time(message):
+    """The time gmail received a message
+
+    Args:
+        message (email message or LazyMessage): A message with gmail attributes
+
+    Returns:
+        float: Seconds since the epoch, the current time if gmail did not say
+    """
+    internal_date = getattr(message, 'internal_date', None)
+    if internal_date is None:
+        return time.time()
+    return internal_date / 1000.0
+
+
+class MboxWriter(object):
+    """Append messages to an mbox file in the mboxrd format
+
+    Writes are buffered and the file is only flushed to disk by sync, which is called every
+    sync_messages messages and by close. A full buffer can reach the disk before then, so the
+    size of the file at the last sync is saved with the cursor, and an interrupted export is
+    resumed by truncating the file back to it.
+
+    Attributes:
+        offset (int): The size of the file once the synced messages are on disk
+    """
+
+    def __init__(self, path, sync_messages=1000, buffer_bytes=MBOX_BUFFER_BYTES, offset=None):
+        """Initialize an mbox writer, creating the file if it does not exist
+
+        Args:
+            path (str): The mbox file
+            sync_messages (int): The number of messages written between syncs
+            buffer_bytes (int): The size of the write buffer
+            offset (int): The offset saved at the last sync of an earlier export. Anything written
+                after it, which the saved cursor does not cover, is dropped before appending
+        """
+        self._fout = open(path, 'ab', buffer_bytes)
+        self._fout.seek(0, os.SEEK_END)
+        if offset is not None and self._fout.tell() > offset:
+            logger.warning('Dropping {} bytes written to {} after the last sync'.format(
+                self._fout.tell() - offset, path))
+            self._fout.truncate(offset)
+            self._fout.seek(0, os.SEEK_END)
+        self.offset = self._fout.tell()
+        self._sync_messages = sync_messages
+        self._unsynced = 0
+
+    def write(self, message):
+        """Append a message
+
+        Args:
+            message (email message or LazyMessage): The message
+        """
+        data = _MBOX_FROM_LINE.sub(r'>\1', message_bytes(message))
+        from_line = 'From {} {}\n'.format(MBOX_SENDER, time.asctime(time.gmtime(message_time(message))))
+        self._fout.write(from_line)
+        self._fout.write(data)
+        self._fout.write('\n' if data.endswith('\n') else '\n\n')
+        self._unsynced += 1
+        if self._unsynced >= self._sync_messages:
+            self.sync()
+
+    def sync(self):
+        """Flush the written messages to disk"""
+        self._fout.flush()
+        os.fsync(self._fout.fileno())
+        self.offset = self._fout.tell()
+        self._unsynced = 0
+
+    def close(self):
+        """Sync and close the file"""
+        self.sync()
+        self._fout.close()
+
+
+class MaildirWriter(object):
+    """Deliver messages to a Maildir directory
+
+    Each message is written to tmp, then synced to disk and moved to new. Rather than syncing
+    every message and directory on their own, the messages are synced and moved together by
+    sync, which is called every sync_messages messages and by close.
+
+    Attributes:
+        offset (None): Maildirs have no offset to resume from, each message is its own file
+    """
+
+    def __init__(self, directory, sync_messages=100):
+        """Initialize a Maildir writer, creating the Maildir if it does not exist
+
+        Args:
+            directory (str): The Maildir
+            sync_messages (int): The number of messages written between syncs
+        """
+        self.offset = None
+        self._directory = directory
+        self._sync_messages = sync_messages
+        self._pending = []
+        self._counter = itertools.count()
+        self._hostname = socket.gethostname().replace('/', r'\057').replace(':', r'\072')
+        for subdirectory in ('tmp', 'new', 'cur'):
+            path = os.path.join(directory, subdirectory)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def write(self, message):
+        """Write a message to tmp, it is synced and moved to new by the next sync
+
+        Args:
+            message (email message or LazyMessage): The message
+        """
+        now = time.time()
+        unique = 'M{}P{}Q{}'.format(int(now % 1 * 1000000), os.getpid(), next(self._counter))
+        name = '{}.{}.{}'.format(int(now), unique, self._hostname)
+        label_ids = getattr(message, 'label_ids', None)
+        if label_ids is not None and 'UNREAD' not in label_ids:
+            destination = os.path.join(self._directory, 'cur', name + ':2,S')
+        else:
+            destination = os.path.join(self._directory, 'new', name)
+        temp_path = os.path.join(self._directory, 'tmp', name)
+        with open(temp_path, 'wb') as fout:
+            fout.write(message_bytes(message))
+        self._pending.append((temp_path, destination))
+        if len(self._pending) >= self._sync_messages:
+            self.sync()
+
+    def sync(self):
+        """Sync the written messages to disk, deliver them and sync the directories they were moved to"""
+        if len(self._pending) == 0:
+            return
+        for temp_path, destination in self._pending:
+            _fsync_path(temp_path)
+        for temp_path, destination in self._pending:
+            os.rename(temp_path, destination)
+        self._pending = []
+        for subdirectory in ('new', 'cur'):
+            _fsync_path(os.path.join(self._directory, subdirectory))
+
+    def close(self):
+        """Sync and deliver the written messages"""
+        self.sync()
+
+
+class BackfillProgress(object):
+    """The ids of the messages a backfill has exported, kept in a file until the backfill finishes
+
+    Ids are appended once their messages are synced to disk, so running an interrupted backfill
+    again skips the messages it already exported instead of writing them a second time.
+    """
+
+    def __init__(self, path):
+        """Initialize backfill progress
+
+        Args:
+            path (str): The file the ids are kept in
+        """
+        self._path = path
+
+    def load(self):
+        """set of str: The ids of the messages exported so far, empty when the backfill has not started"""
+        if not os.path.exists(self._path):
+            return set()
+        with open(self._path, 'r') as fin:
+            return set(line.strip() for line in fin if line.strip())
+
+    def add(self, message_ids):
+        """Record messages once they are synced to disk
+
+        Args:
+            message_ids (list of str): The ids of the messages
+        """
+        if len(message_ids) == 0:
+            return
+        directory = os.path.dirname(os.path.abspath(self._path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self._path, 'a') as fout:
+            fout.write(''.join(message_id + '\n' for message_id in message_ids))
+            fout.flush()
+            os.fsync(fout.fileno())
+
+    def remove(self):
+        """Forget the progress once the backfill has finished and the cursor is saved"""
+        if os.path.exists(self._path):
+            os.remove(self._path)
+
+
+def _fsync_path(path):
+    """Sync a file or directory to disk without holding it open
+
+    Args:
+        path (str): The file or directory
+    """
+    handle = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(handle)
+    finally:
+        os.close(handle)
+
+
+def create_writer(export_format, destination, sync_messages, offset=None):
+    """Create the writer of an export format
+
+    Args:
+        export_format (str): One of EXPORT_FORMATS
+        destination (str): The mbox file or Maildir directory
+        sync_messages (int): The number of messages written between syncs
+        offset (int): The writer offset saved by an earlier export, see MboxWriter
+
+    Returns:
+        MboxWriter or MaildirWriter: The writer
+    """
+    assert export_format in EXPORT_FORMATS, 'unknown export format: ' + export_format
+    if export_format == 'mbox':
+        return MboxWriter(destination, sync_messages=sync_messages, offset=offset)
+    return MaildirWriter(destination, sync_messages=sync_messages)
+
+
+def export_stream(stream, writer, save_cursor, backfill=None, follow=False, poll_interval=10.0,
+                  histories_per_read=100, backfill_progress=None, sleep=time.sleep):
+    """Write the messages of a mail stream, saving the cursor each time the written messages are synced
+
+    Args:
+        stream (GmailMailStream): A stream of lazy raw messages
+        writer (MboxWriter or MaildirWriter): The writer
+        save_cursor (callable): Called as save_cursor(cursor, offset) with the stream cursor and the
+            writer offset once the messages before them are on disk. The cursor is None while a
+            backfill with progress is part way through
+        backfill (dict): The keyword arguments of GmailMailStream.backfill to export the existing mail
+            first. None to only export mail from the cursor on
+        follow (bool): Keep exporting new mail once the latest history is reached
+        poll_interval (float): The number of seconds between checks for new history when following
+        histories_per_read (int): The number of histories read between syncs
+        backfill_progress (BackfillProgress): Records the messages of each backfilled chunk once
+            they are synced, so an interrupted backfill can skip them when run again. Pass the
+            ids it loaded as the skip_ids of the backfill
+        sleep (callable): Sleeps for the given number of seconds
+
+    Returns:
+        int: The number of messages written
+    """
+    written = 0
+    if backfill is not None:
+        for messages in stream.backfill(**backfill):
+            for message in messages:
+                writer.write(message)
+            written += len(messages)
+            if backfill_progress is not None:
+                writer.sync()
+                # Saved before the progress, so a crash in between writes the chunk again rather than losing it
+                save_cursor(None, writer.offset)
+                backfill_progress.add([message.gmail_id for message in messages])
+            logger.info('Backfilled {} messages'.format(written))
+        writer.sync()
+        save_cursor(stream.cursor, writer.offset)
+        if backfill_progress is not None:
+            backfill_progress.remove()
+
+    while True:
+        histories = stream.read_many(max_histories=histories_per_read)
+        if histories is None:
+            if not follow:
+                return written
+            sleep(poll_interval)
+            continue
+        for history_id, messages in histories:
+            for message in messages:
+                writer.write(message)
+            written += len(messages)
+        writer.sync()
+        save_cursor(stream.cursor, writer.offset)
+        logger.info('Exported {} messages up to history {}'.format(written, histories[-1][0]))
+
+
+def cmd_export(args):
+    """The export command
+    """
+    logger.debug('Running command export')
+
+    profile_dir = os.path.expanduser(args.profile_dir)
+    credential_manager = auth.get_credential_manager(profile_dir)
+    pool = httppool.get_connection_pool(profile_dir)
+    try:
+        http = credential_manager.authorize(pool.http())
+    except auth.NotAuthenticatedError as error:
+        logger.error(str(error))
+        sys.exit(1)
+    credential_manager.start()
+
+    # Cursors are kept per destination so exporting a mailbox to several places resumes each one
+    cursor_key = args.mailbox + ' ' + os.path.abspath(args.destination)
+    # The writer offset is kept beside the cursor and saved in the same checkpoint
+    offset_key = cursor_key + ' offset'
+    cursor_store = cursorstore.CursorStore(os.path.join(profile_dir, config.export_cursor_storage_filename))
+    cursor = cursor_store.get(cursor_key)
+
+    executor = retry.RequestExecutor()
+    if args.quota_units_per_second > 0:
+        executor = retry.RequestExecutor(budget=quota.TokenBucket(args.quota_units_per_second))
+    discovery_cache = discoverycache.get_discovery_cache(os.path.join(profile_dir, config.discovery_cache_filename))
+    index = None
+    if args.index:
+        index = messageindex.MessageIndex(os.path.join(profile_dir, config.message_index_filename))
+    stream = mailstream.GmailMailStream(http, args.mailbox,
+                                        cursor=cursor,
+                                        discovery_cache=discovery_cache,
+                                        executor=executor,
+                                        fetcher=fetch.BatchFetcher(executor=executor),
+                                        lazy=True,
+                                        index=index,
+                                        seen_window=args.seen_window)
+
+    backfill = None
+    backfill_progress = None
+    if cursor is None and not args.new_only:
+        backfill_progress = BackfillProgress(os.path.join(profile_dir, config.export_backfill_progress_dirname,
+                                                          hashlib.sha1(cursor_key).hexdigest()))
+        exported_ids = backfill_progress.load()
+        if len(exported_ids) > 0:
+            logger.info('Resuming the export of existing mail, skipping {} messages already exported'.format(
+                len(exported_ids)))
+        backfill = {
+            'query': args.query,
+            'shards': args.shards,
+            'http_factory': lambda: credential_manager.authorize(pool.http()),
+            'concurrency': args.concurrency,
+            'skip_ids': exported_ids,
+        }
+
+    def save_cursor(cursor, offset):
+        if cursor is not None:
+            cursor_store.set(cursor_key, cursor)
+        if offset is not None:
+            cursor_store.set(offset_key, offset)
+        cursor_store.checkpoint()
+
+    writer = create_writer(args.format, args.destination, args.sync_messages, offset=cursor_store.get(offset_key))
+    if backfill is None:
+        save_cursor(stream.cursor, writer.offset)
+    try:
+        written = export_stream(stream, writer, save_cursor,
+                                backfill=backfill,
+                                follow=args.follow,
+                                poll_interval=args.poll_interval,
+                                backfill_progress=backfill_progress)
+    finally:
+        writer.close()
+        credential_manager.stop()
+        httppool.log_stats(pool)
+        pool.close()
+        if index is not None:
+            index.close()
+    logger.info('Exported {} messages to {}'.format(written, args.destination))
+
+
+def cmd_export_register(parsers, environ):
+    """Configure the argument parser for use with the export command
+
+    Args:
+        parsers (Parsers): The parsers which belong to the higher level parser
+    """
+    parser = parsers.add_parser('export', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('mailbox', help='The mailbox to export (e.g. example@gmail.com)')
+    parser.add_argument('destination', help='The mbox file or Maildir directory to export to')
+    parser.add_argument('--format', choices=EXPORT_FORMATS, default='mbox',
+                        help='The format to export in')
+    parser.add_argument('--query',
+                        help='Only export existing mail matching this gmail search query (e.g. label:inbox)')
+    parser.add_argument('--new-only', action='store_true',
+                        help='Skip the existing mail and only export mail arriving from now on')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='The number of date ranges the existing mail is listed in')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='The number of date ranges listed at once')
+    parser.add_argument('--follow', action='store_true',
+                        help='Keep exporting new mail as it arrives')
+    parser.add_argument('--poll-interval', type=float, default=10.0,
+                        help='The number of seconds between checks for new mail when following')
+    parser.add_argument('--sync-messages', type=int, default=1000,
+                        help='The number of messages written between flushes to disk')
+    parser.add_argument('--quota-units-per-second', type=float, default=quota.USER_QUOTA_UNITS_PER_SECOND,
+                        help='The gmail api quota units the export may spend per second, 0 for no limit')
+    parser.add_argument('--index', action='store_true',
+                        help='Record the headers of exported messages in the local index used by the search command')
+    parser.add_argument('--seen-window', type=int, default=mailstream.SEEN_WINDOW_SIZE,
+                        help='Remember this many recently exported message ids so repeats are not exported again, '
+                             '0 to disable')
+    parser.set_defaults(func=cmd_export)
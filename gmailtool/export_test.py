@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""Testing the export python module
+"""
+
+from gmailtool import export
+from gmailtool import mailmessage
+
+import mailbox
+import os
+import shutil
+import tempfile
+import unittest
+
+
+def make_message(subject, body='Hello\n', label_ids=None, internal_date=0):
+    message = mailmessage.LazyMessage('Subject: {}\n\n{}'.format(subject, body))
+    message.gmail_id = subject
+    message.label_ids = label_ids
+    message.internal_date = internal_date
+    return message
+
+
+class RecordingWriter(object):
+    """A writer recording the order of writes and syncs"""
+
+    def __init__(self):
+        self.events = []
+        self.offset = 0
+
+    def write(self, message):
+        self.events.append(('write', message['subject']))
+
+    def sync(self):
+        self.events.append(('sync',))
+        self.offset += 1
+
+
+class FakeExportStream(object):
+    """A stand in for GmailMailStream serving a backfill and a list of histories"""
+
+    def __init__(self, backfill_chunks, histories):
+        self.backfill_chunks = backfill_chunks
+        self.histories = histories
+        self.cursor = 'start'
+
+    def backfill(self, **kwargs):
+        for chunk in self.backfill_chunks:
+            yield chunk
+        self.cursor = 'backfilled'
+
+    def read_many(self, max_histories=None):
+        if len(self.histories) == 0:
+            return None
+        histories, self.histories = self.histories[:max_histories], self.histories[max_histories:]
+        self.cursor = str(histories[-1][0])
+        return histories
+
+
+class TestMboxWriter(unittest.TestCase):
+    """Testing messages are appended to mbox files"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'export.mbox')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_messages_should_be_readable_as_mbox(self):
+        writer = export.MboxWriter(self.path)
+        writer.write(make_message('first', body='From the start\n>From quoted\n'))
+        writer.write(make_message('second', body='No trailing newline'))
+        writer.close()
+        messages = list(mailbox.mbox(self.path))
+        self.assertEqual([message['subject'] for message in messages], ['first', 'second'])
+        self.assertEqual(messages[0].get_payload(), '>From the start\n>>From quoted\n')
+
+    def test_from_line_should_use_the_gmail_received_time(self):
+        writer = export.MboxWriter(self.path)
+        writer.write(make_message('first', internal_date=86400 * 1000))
+        writer.close()
+        with open(self.path) as fin:
+            self.assertEqual(fin.readline(), 'From MAILER-DAEMON Fri Jan  2 00:00:00 1970\n')
+
+    def test_messages_written_after_the_last_sync_should_be_dropped(self):
+        writer = export.MboxWriter(self.path)
+        writer.write(make_message('first'))
+        writer.sync()
+        offset = writer.offset
+        self.assertEqual(offset, os.path.getsize(self.path))
+        writer.write(make_message('unsynced'))
+        writer.close()
+        with open(self.path, 'ab') as fout:
+            fout.write('From MAILER-DAEMON Thu Jan  1 00:00:00 1970\nSubject: partial')
+        writer = export.MboxWriter(self.path, offset=offset)
+        self.assertEqual(writer.offset, offset)
+        writer.write(make_message('second'))
+        writer.close()
+        self.assertEqual([message['subject'] for message in mailbox.mbox(self.path)], ['first', 'second'])
+
+    def test_export_should_append(self):
+        for subject in ['first', 'second']:
+            writer = export.MboxWriter(self.path)
+            writer.write(make_message(subject))
+            writer.close()
+        self.assertEqual(len(mailbox.mbox(self.path)), 2)
+
+
+class TestMaildirWriter(unittest.TestCase):
+    """Testing messages are delivered to Maildirs in synced batches"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'Maildir')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_messages_should_only_be_delivered_when_synced(self):
+        writer = export.MaildirWriter(self.path, sync_messages=2)
+        writer.write(make_message('first'))
+        self.assertEqual(len(mailbox.Maildir(self.path, factory=None)), 0)
+        self.assertEqual(len(os.listdir(os.path.join(self.path, 'tmp'))), 1)
+        writer.write(make_message('second'))
+        self.assertEqual(len(mailbox.Maildir(self.path, factory=None)), 2)
+        self.assertEqual(os.listdir(os.path.join(self.path, 'tmp')), [])
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), 'needs /proc to count open files')
+    def test_written_messages_should_not_hold_files_open(self):
+        open_files = len(os.listdir('/proc/self/fd'))
+        writer = export.MaildirWriter(self.path, sync_messages=1000)
+        for index in range(20):
+            writer.write(make_message('message {}'.format(index)))
+        self.assertEqual(len(os.listdir('/proc/self/fd')), open_files)
+        writer.close()
+        self.assertEqual(len(mailbox.Maildir(self.path, factory=None)), 20)
+
+    def test_messages_should_only_be_synced_to_disk_by_sync(self):
+        fsync = os.fsync
+        synced = []
+
+        def recording_fsync(handle):
+            synced.append(handle)
+            fsync(handle)
+
+        os.fsync = recording_fsync
+        try:
+            writer = export.MaildirWriter(self.path, sync_messages=1000)
+            for index in range(3):
+                writer.write(make_message('message {}'.format(index)))
+            self.assertEqual(synced, [])
+            writer.sync()
+        finally:
+            os.fsync = fsync
+        self.assertEqual(len(synced), 3 + 2, 'expected each message then the new and cur directories to be synced')
+
+    def test_read_messages_should_be_marked_seen(self):
+        writer = export.MaildirWriter(self.path)
+        writer.write(make_message('read', label_ids=['INBOX']))
+        writer.write(make_message('unread', label_ids=['INBOX', 'UNREAD']))
+        writer.close()
+        flags = dict((message['subject'], message.get_flags()) for message in mailbox.Maildir(self.path, factory=None))
+        self.assertEqual(flags, {'read': 'S', 'unread': ''})
+
+
+class TestBackfillProgress(unittest.TestCase):
+    """Testing the ids of exported messages are kept until the backfill finishes"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'export-backfill', 'progress')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_added_ids_should_be_loaded_until_removed(self):
+        progress = export.BackfillProgress(self.path)
+        self.assertEqual(progress.load(), set())
+        progress.add(['a', 'b'])
+        progress.add(['c'])
+        self.assertEqual(export.BackfillProgress(self.path).load(), set(['a', 'b', 'c']))
+        progress.remove()
+        self.assertEqual(progress.load(), set())
+
+
+class TestExportStream(unittest.TestCase):
+    """Testing the cursor is only saved once the messages before it are synced"""
+
+    def test_cursor_should_be_saved_after_sync(self):
+        stream = FakeExportStream([[make_message('old1'), make_message('old2')]],
+                                  [(5, [make_message('new1')]), (6, []), (7, [make_message('new2')])])
+        writer = RecordingWriter()
+        written = export.export_stream(stream, writer,
+                                       lambda cursor, offset: writer.events.append(('save', cursor, offset)),
+                                       backfill={},
+                                       histories_per_read=2)
+        self.assertEqual(written, 4)
+        self.assertEqual(writer.events, [
+            ('write', 'old1'), ('write', 'old2'), ('sync',), ('save', 'backfilled', 1),
+            ('write', 'new1'), ('sync',), ('save', '6', 2),
+            ('write', 'new2'), ('sync',), ('save', '7', 3),
+        ])
+
+    def test_backfilled_chunks_should_be_recorded_once_synced(self):
+        directory = tempfile.mkdtemp()
+        try:
+            progress = export.BackfillProgress(os.path.join(directory, 'progress'))
+            stream = FakeExportStream([[make_message('old1')], [make_message('old2')]], [])
+            writer = RecordingWriter()
+
+            def write(message):
+                if message['subject'] == 'old2':
+                    raise IOError('interrupted')
+                writer.events.append(('write', message['subject']))
+
+            writer.write = write
+            saved = []
+            with self.assertRaises(IOError):
+                export.export_stream(stream, writer, lambda cursor, offset: saved.append((cursor, offset)),
+                                     backfill={}, backfill_progress=progress)
+            self.assertEqual(writer.events, [('write', 'old1'), ('sync',)])
+            self.assertEqual(saved, [(None, 1)], 'expected the offset of the synced chunk to be saved')
+            self.assertEqual(progress.load(), set(['old1']))
+
+            stream = FakeExportStream([[make_message('old2')]], [])
+            export.export_stream(stream, RecordingWriter(), lambda cursor, offset: None, backfill={},
+                                 backfill_progress=progress)
+            self.assertEqual(progress.load(), set(), 'expected the progress to be removed once the cursor is saved')
+        finally:
+            shutil.rmtree(directory)
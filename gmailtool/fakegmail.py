@@ -0,0 +1,565 @@
+# -*- coding: utf-8 -*-
+"""A local stand in for the Gmail API serving synthetic mailboxes, for benchmarks and tests
+"""
+
+from gmailtool import discoverycache
+
+import base64
+import BaseHTTPServer
+import email.parser
+import email.utils
+import json
+import logging
+import math
+import os
+import random
+import socket
+import SocketServer
+import threading
+import time
+import urllib
+import urlparse
+
+
+logger = logging.getLogger('gmailtool.fakegmail')
+
+# The gmail v1 discovery document served, with its urls pointed at the server
+DISCOVERY_DOCUMENT_PATH = os.path.join(os.path.dirname(__file__), 'mock_gmail_discovery.json')
+
+# The history id before the first message of a synthetic mailbox
+FIRST_HISTORY_ID = 1000
+
+# The time the first message of a synthetic mailbox was received, in seconds since the epoch
+FIRST_MESSAGE_TIME = 1500000000
+
+# The default and largest page sizes of the list methods
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+# How long a watch lasts, in seconds
+WATCH_EXPIRATION = 7 * 24 * 60 * 60
+
+# The body of the responses to requests failed by rate limit injection
+RATE_LIMIT_ERROR = {'error': {'code': 429,
+                              'message': 'Too many concurrent requests for user',
+                              'errors': [{'reason': 'rateLimitExceeded', 'domain': 'usageLimits'}]}}
+
+# The reason phrases of the http statuses the server answers with
+_REASONS = {200: 'OK', 404: 'Not Found', 429: 'Too Many Requests'}
+
+_FILLER = 'The quick brown fox jumps over the lazy dog and keeps on running past the benchmark. '
+
+
+def lognormal_sizes(median=8 * 1024, sigma=1.0, minimum=512, maximum=10 * 1024 * 1024):
+    """A message size distribution where most messages are small and a few are very large
+
+    Args:
+        median (int): The median message size in bytes
+        sigma (float): The spread of the sizes, 0 for every message to be the median size
+        minimum (int): The smallest message size
+        maximum (int): The largest message size
+
+    Returns:
+        callable: Called with a random.Random to pick the size of a message
+    """
+    def pick(rng):
+        return int(min(maximum, max(minimum, rng.lognormvariate(math.log(median), sigma))))
+    return pick
+
+
+class SyntheticMailbox(object):
+    """A mailbox of generated messages, added to the mailbox a fixed number of messages per history
+
+    Messages are generated from their index when requested, so large mailboxes take no memory.
+    The same seed always generates the same mailbox.
+    """
+
+    def __init__(self, address, message_count=100, message_size=None, messages_per_history=1, seed=0,
+                 first_history_id=FIRST_HISTORY_ID):
+        """Initialize a synthetic mailbox
+
+        Args:
+            address (str): The email address of the mailbox
+            message_count (int): The number of messages in the mailbox
+            message_size (callable): Called with a random.Random to pick the size in bytes of each
+                message. Defaults to lognormal_sizes()
+            messages_per_history (int): The number of messages added in each history
+            seed (int): Seeds the message sizes
+            first_history_id (int): The history id before the first message. Histories before it
+                have expired
+        """
+        self.address = address
+        self.message_count = message_count
+        self._message_size = message_size or lognormal_sizes()
+        self.messages_per_history = messages_per_history
+        self._seed = seed
+        self.first_history_id = first_history_id
+
+    @property
+    def history_count(self):
+        """int: The number of histories adding messages"""
+        return (self.message_count + self.messages_per_history - 1) // self.messages_per_history
+
+    @property
+    def history_id(self):
+        """int: The latest history id of the mailbox"""
+        return self.first_history_id + self.history_count
+
+    def deliver(self, count=1):
+        """Add new messages to the mailbox, in new histories once the latest history is full
+
+        Args:
+            count (int): The number of messages to add
+        """
+        self.message_count += count
+
+    def message_id(self, index):
+        """str: The gmail id of the message at an index"""
+        return '{:016x}'.format(0x15000000000 + index)
+
+    def message_index(self, message_id):
+        """int: The index of the message with a gmail id, None if there is no such message"""
+        try:
+            index = int(message_id, 16) - 0x15000000000
+        except ValueError:
+            return None
+        if 0 <= index < self.message_count:
+            return index
+        return None
+
+    def message_time(self, index):
+        """int: The time the message at an index was received, in seconds since the epoch"""
+        return FIRST_MESSAGE_TIME + index * 60
+
+    def message_history_id(self, index):
+        """int: The id of the history the message at an index was added in"""
+        return self.first_history_id + index // self.messages_per_history + 1
+
+    def history(self, history_index):
+        """dict: The history record at an index, counting from the first history"""
+        start = history_index * self.messages_per_history
+        message_ids = [self.message_id(index)
+                       for index in range(start, min(self.message_count, start + self.messages_per_history))]
+        return {
+            'id': str(self.first_history_id + history_index + 1),
+            'messages': [{'id': message_id, 'threadId': message_id} for message_id in message_ids],
+            'messagesAdded': [{'message': {'id': message_id, 'threadId': message_id, 'labelIds': ['INBOX', 'UNREAD']}}
+                              for message_id in message_ids],
+        }
+
+    def headers(self, index):
+        """list of (str, str): The headers of the message at an index"""
+        return [
+            ('From', 'Sender {} <sender{}@example.adamandpaul.biz>'.format(index % 50, index % 50)),
+            ('To', self.address),
+            ('Subject', 'Synthetic message {}'.format(index)),
+            ('Date', email.utils.formatdate(self.message_time(index))),
+            ('Message-ID', '<{}@fakegmail.example.adamandpaul.biz>'.format(self.message_id(index))),
+            ('Content-Type', 'text/plain; charset="us-ascii"'),
+        ]
+
+    def body(self, index, header_bytes=0):
+        """str: The body of the message at an index, filling the message up to its size"""
+        size = self._message_size(random.Random(self._seed * 1000003 + index))
+        length = max(0, size - header_bytes)
+        lines = []
+        filled = 0
+        line = (_FILLER * (76 // len(_FILLER) + 2))[:76]
+        while filled < length:
+            lines.append(line[:length - filled])
+            filled += len(lines[-1]) + 1
+        return '\n'.join(lines) + '\n'
+
+    def raw(self, index):
+        """str: The bytes of the message at an index"""
+        header_block = ''.join('{}: {}\n'.format(name, value) for name, value in self.headers(index)) + '\n'
+        return header_block + self.body(index, len(header_block))
+
+    def resource(self, index, message_format='raw', metadata_headers=None):
+        """The gmail api message resource of the message at an index
+
+        Args:
+            index (int): The message index
+            message_format (str): raw, full, metadata or minimal
+            metadata_headers (list of str): The only headers included with the metadata format
+
+        Returns:
+            dict: The message resource
+        """
+        raw = self.raw(index)
+        resource = {
+            'id': self.message_id(index),
+            'threadId': self.message_id(index),
+            'labelIds': ['INBOX', 'UNREAD'],
+            'snippet': 'Synthetic message {}'.format(index),
+            'sizeEstimate': len(raw),
+            'historyId': str(self.message_history_id(index)),
+            'internalDate': str(self.message_time(index) * 1000),
+        }
+        if message_format == 'raw':
+            resource['raw'] = base64.urlsafe_b64encode(raw)
+        elif message_format in ('full', 'metadata'):
+            headers = self.headers(index)
+            if message_format == 'metadata' and metadata_headers:
+                wanted = set(name.lower() for name in metadata_headers)
+                headers = [(name, value) for name, value in headers if name.lower() in wanted]
+            payload = {'mimeType': 'text/plain',
+                       'headers': [{'name': name, 'value': value} for name, value in headers]}
+            if message_format == 'full':
+                body = raw.split('\n\n', 1)[1]
+                payload['body'] = {'size': len(body), 'data': base64.urlsafe_b64encode(body)}
+            resource['payload'] = payload
+        return resource
+
+
+class FakeGmailServer(object):
+    """A local http server answering Gmail API requests from synthetic mailboxes
+
+    Serves the discovery document with its root url pointed at the server, getProfile,
+    history.list, messages.list, messages.get, watch, stop and the batch endpoint. Latency and
+    rate limit errors can be injected, and the requests made and bytes sent are counted so
+    benchmarks can report api calls and bytes per message. Mail delivered to a watched mailbox
+    is announced on a notification source, standing in for Cloud Pub/Sub.
+    """
+
+    def __init__(self, mailboxes, latency=0.0, rate_limit_probability=0.0, seed=0, port=0, notification_source=None):
+        """Initialize a fake gmail server
+
+        Args:
+            mailboxes (list of SyntheticMailbox): The mailboxes served
+            latency (float): The number of seconds the server waits before answering each http request
+            rate_limit_probability (float): The chance each api call, including each call in a batch,
+                is answered with a 429 rate limit error
+            seed (int): Seeds the rate limit injection
+            port (int): The port to listen on, 0 for any free port
+            notification_source (QueueNotificationSource): Where deliveries to watched mailboxes are published
+        """
+        self.mailboxes = dict((mailbox.address, mailbox) for mailbox in mailboxes)
+        self.latency = latency
+        self.rate_limit_probability = rate_limit_probability
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._port = port
+        self._notification_source = notification_source
+        # The topic each watched mailbox is watched for, keyed by address
+        self.watches = {}
+        self._httpd = None
+        self._thread = None
+        self.reset_stats()
+
+    @property
+    def root_uri(self):
+        """str: The root url of the api, ending with /"""
+        return 'http://127.0.0.1:{}/'.format(self._httpd.server_address[1])
+
+    @property
+    def discovery_uri(self):
+        """str: The url of the discovery document, see DiscoveryCache"""
+        return self.root_uri + 'discovery/v1/apis/gmail/v1/rest'
+
+    def start(self):
+        """Start serving in a background thread
+
+        Returns:
+            FakeGmailServer: The server
+        """
+        self._httpd = _ThreadingHTTPServer(('127.0.0.1', self._port), _FakeGmailHandler)
+        self._httpd.fake = self
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='gmailtool-fakegmail')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving"""
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.close_connections()
+            self._httpd.server_close()
+            self._thread.join()
+            self._httpd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def discovery_cache(self):
+        """DiscoveryCache: An in memory discovery cache building service objects which talk to this server"""
+        return discoverycache.DiscoveryCache(discovery_uri=self.discovery_uri)
+
+    def reset_stats(self):
+        """Zero the request counters"""
+        with self._lock:
+            self.stats = {
+                'connections': 0,
+                'http_requests': 0,
+                'api_calls': 0,
+                'bytes_sent': 0,
+                'rate_limited': 0,
+                'calls': {},
+            }
+
+    def discovery_document(self):
+        """dict: The gmail discovery document with its urls pointing at this server"""
+        with open(DISCOVERY_DOCUMENT_PATH) as document_file:
+            document = json.load(document_file)
+        document['rootUrl'] = self.root_uri
+        document['baseUrl'] = self.root_uri + document['servicePath']
+        return document
+
+    def deliver(self, address, count=1):
+        """Add new messages to a mailbox, publishing a notification if the mailbox is watched
+
+        Args:
+            address (str): The address of the mailbox
+            count (int): The number of messages to add
+        """
+        mailbox = self.mailboxes[address]
+        mailbox.deliver(count)
+        if address in self.watches and self._notification_source is not None:
+            self._notification_source.publish(address, mailbox.history_id)
+
+    def call(self, method, path, query, body=None):
+        """Answer a single api call
+
+        Args:
+            method (str): The http method
+            path (str): The url path
+            query (dict): The query parameters, each a list of values
+            body (str): The json request body
+
+        Returns:
+            (int, dict): The http status and json body
+        """
+        route = path.strip('/').split('/')
+        if route[:3] != ['gmail', 'v1', 'users'] or len(route) < 5:
+            return 404, _error(404, 'Not Found')
+        mailbox = self._mailbox(urllib.unquote(route[3]))
+        if mailbox is None:
+            return 404, _error(404, 'Mailbox not found')
+        method_id = self._method_id(method, route[4:])
+        if method_id is None:
+            return 404, _error(404, 'Not Found')
+
+        with self._lock:
+            self.stats['api_calls'] += 1
+            self.stats['calls'][method_id] = self.stats['calls'].get(method_id, 0) + 1
+            rate_limited = self._random.random() < self.rate_limit_probability
+            if rate_limited:
+                self.stats['rate_limited'] += 1
+        if rate_limited:
+            return 429, RATE_LIMIT_ERROR
+
+        if method_id == 'gmail.users.watch':
+            with self._lock:
+                self.watches[mailbox.address] = json.loads(body or '{}').get('topicName')
+            return 200, {'historyId': str(mailbox.history_id),
+                         'expiration': str(int((time.time() + WATCH_EXPIRATION) * 1000))}
+        if method_id == 'gmail.users.stop':
+            with self._lock:
+                self.watches.pop(mailbox.address, None)
+            return 200, {}
+        if method_id == 'gmail.users.getProfile':
+            return 200, {'emailAddress': mailbox.address,
+                         'messagesTotal': mailbox.message_count,
+                         'threadsTotal': mailbox.message_count,
+                         'historyId': str(mailbox.history_id)}
+        if method_id == 'gmail.users.history.list':
+            return self._list_history(mailbox, query)
+        if method_id == 'gmail.users.messages.list':
+            return self._list_messages(mailbox, query)
+        index = mailbox.message_index(urllib.unquote(route[5]))
+        if index is None:
+            return 404, _error(404, 'Requested entity was not found.')
+        return 200, mailbox.resource(index, _param(query, 'format', 'full'), query.get('metadataHeaders'))
+
+    def batch(self, content_type, body):
+        """Answer a batch request, calling each api call in it
+
+        Args:
+            content_type (str): The multipart content type of the batch request
+            body (str): The batch request body
+
+        Returns:
+            (str, str): The content type and body of the multipart response
+        """
+        batch = email.parser.Parser().parsestr('Content-Type: {}\r\n\r\n{}'.format(content_type, body))
+        boundary = 'batch_fakegmail_boundary'
+        response = ''
+        for part in batch.get_payload():
+            request_line = part.get_payload().lstrip().split('\n', 1)[0].strip()
+            method, uri = request_line.split(' ')[:2]
+            parsed = urlparse.urlparse(uri)
+            status, result = self.call(method, parsed.path, urlparse.parse_qs(parsed.query))
+            content_id = part['Content-ID'] or ''
+            response += '--{}\r\n' \
+                        'Content-Type: application/http\r\n' \
+                        'Content-ID: <response-{}>\r\n' \
+                        '\r\n' \
+                        'HTTP/1.1 {} {}\r\n' \
+                        'Content-Type: application/json; charset=UTF-8\r\n' \
+                        '\r\n' \
+                        '{}\r\n'.format(boundary, content_id.strip('<>'), status, _REASONS[status],
+                                        json.dumps(result))
+        response += '--{}--\r\n'.format(boundary)
+        return 'multipart/mixed; boundary={}'.format(boundary), response
+
+    def count_connection(self):
+        """Count a connection accepted"""
+        with self._lock:
+            self.stats['connections'] += 1
+
+    def count_http_request(self, bytes_sent):
+        """Count a http request answered and the bytes of its response body"""
+        with self._lock:
+            self.stats['http_requests'] += 1
+            self.stats['bytes_sent'] += bytes_sent
+
+    def _mailbox(self, user_id):
+        """SyntheticMailbox: The mailbox for a user id, which may be me when only one mailbox is served"""
+        if user_id == 'me' and len(self.mailboxes) == 1:
+            return list(self.mailboxes.values())[0]
+        return self.mailboxes.get(user_id)
+
+    def _method_id(self, method, route):
+        """str: The gmail api method id of a request, None if it is not served"""
+        if method == 'GET' and route == ['profile']:
+            return 'gmail.users.getProfile'
+        if method == 'GET' and route == ['history']:
+            return 'gmail.users.history.list'
+        if method == 'GET' and route == ['messages']:
+            return 'gmail.users.messages.list'
+        if method == 'GET' and len(route) == 2 and route[0] == 'messages':
+            return 'gmail.users.messages.get'
+        if method == 'POST' and route == ['watch']:
+            return 'gmail.users.watch'
+        if method == 'POST' and route == ['stop']:
+            return 'gmail.users.stop'
+        return None
+
+    def _list_history(self, mailbox, query):
+        """Answer history.list"""
+        start_history_id = int(_param(query, 'startHistoryId', 0))
+        if start_history_id < mailbox.first_history_id:
+            return 404, _error(404, 'Requested entity was not found.')
+        page_size = min(int(_param(query, 'maxResults', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        start = start_history_id - mailbox.first_history_id + int(_param(query, 'pageToken', 0))
+        end = min(mailbox.history_count, start + page_size)
+        result = {'historyId': str(mailbox.history_id)}
+        if end > start:
+            result['history'] = [mailbox.history(index) for index in range(start, end)]
+        if end < mailbox.history_count:
+            result['nextPageToken'] = str(end - start_history_id + mailbox.first_history_id)
+        return 200, result
+
+    def _list_messages(self, mailbox, query):
+        """Answer messages.list newest first, understanding only the after: and before: search terms"""
+        after = None
+        before = None
+        for term in _param(query, 'q', '').split():
+            if term.startswith('after:'):
+                after = int(term[len('after:'):])
+            elif term.startswith('before:'):
+                before = int(term[len('before:'):])
+        indexes = [index for index in range(mailbox.message_count - 1, -1, -1)
+                   if (after is None or mailbox.message_time(index) > after) and
+                   (before is None or mailbox.message_time(index) < before)]
+        page_size = min(int(_param(query, 'maxResults', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        offset = int(_param(query, 'pageToken', 0))
+        page = indexes[offset:offset + page_size]
+        result = {'resultSizeEstimate': len(indexes)}
+        if len(page) > 0:
+            result['messages'] = [{'id': mailbox.message_id(index), 'threadId': mailbox.message_id(index)}
+                                  for index in page]
+        if offset + page_size < len(indexes):
+            result['nextPageToken'] = str(offset + page_size)
+        return 200, result
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A http server answering each connection in its own thread, which can close kept alive connections"""
+
+    daemon_threads = True
+
+    def __init__(self, server_address, handler_class):
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, handler_class)
+        self._connections = set()
+        self._connections_lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        with self._connections_lock:
+            self._connections.add(request)
+        self.fake.count_connection()
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        with self._connections_lock:
+            self._connections.discard(request)
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+    def close_connections(self):
+        """Close the connections clients are keeping alive, ending the threads answering them"""
+        with self._connections_lock:
+            connections = list(self._connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+class _FakeGmailHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers the http requests of a FakeGmailServer"""
+
+    # Keep connections alive like the real api does
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one write without waiting for acks, so small responses are not
+    # held back by the nagle algorithm
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):  # noqa: N802 the name BaseHTTPRequestHandler dispatches to
+        self._answer()
+
+    def do_POST(self):  # noqa: N802 the name BaseHTTPRequestHandler dispatches to
+        self._answer()
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _answer(self):
+        fake = self.server.fake
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length > 0 else ''
+        if fake.latency > 0:
+            time.sleep(fake.latency)
+        parsed = urlparse.urlparse(self.path)
+        if parsed.path == '/discovery/v1/apis/gmail/v1/rest':
+            status, content_type, content = 200, 'application/json', json.dumps(fake.discovery_document())
+        elif parsed.path == '/batch' and self.command == 'POST':
+            status = 200
+            content_type, content = fake.batch(self.headers.get('Content-Type'), body)
+        else:
+            status, result = fake.call(self.command, parsed.path, urlparse.parse_qs(parsed.query), body)
+            content_type, content = 'application/json; charset=UTF-8', json.dumps(result)
+        fake.count_http_request(len(content))
+        self.send_response(status, _REASONS[status])
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def _param(query, name, default=None):
+    """The first value of a query parameter"""
+    values = query.get(name)
+    if not values:
+        return default
+    return values[0]
+
+
+def _error(code, message):
+    """dict: A gmail api error body"""
+    return {'error': {'code': code, 'message': message, 'errors': [{'reason': 'notFound', 'message': message}]}}
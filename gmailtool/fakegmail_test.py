@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""Testing the fakegmail python module
+"""
+
+from gmailtool import fakegmail
+from gmailtool import fetch
+from gmailtool import mailstream
+from gmailtool import retry
+
+import httplib2
+import json
+import unittest
+
+
+class TestSyntheticMailbox(unittest.TestCase):
+    """Testing messages are generated the same way every time"""
+
+    def test_messages_should_have_the_chosen_size(self):
+        mailbox = fakegmail.SyntheticMailbox('a@example.adamandpaul.biz', 3,
+                                             message_size=fakegmail.lognormal_sizes(4096, sigma=0))
+        self.assertEqual([len(mailbox.raw(index)) for index in range(3)], [4096, 4096, 4096])
+
+    def test_message_ids_should_map_back_to_indexes(self):
+        mailbox = fakegmail.SyntheticMailbox('a@example.adamandpaul.biz', 3)
+        self.assertEqual(mailbox.message_index(mailbox.message_id(2)), 2)
+        self.assertIsNone(mailbox.message_index(mailbox.message_id(3)))
+        self.assertIsNone(mailbox.message_index('not-an-id'))
+
+    def test_histories_should_hold_messages_per_history(self):
+        mailbox = fakegmail.SyntheticMailbox('a@example.adamandpaul.biz', 5, messages_per_history=2)
+        self.assertEqual(mailbox.history_count, 3)
+        self.assertEqual(mailbox.history_id, fakegmail.FIRST_HISTORY_ID + 3)
+        self.assertEqual(len(mailbox.history(2)['messagesAdded']), 1)
+
+    def test_metadata_should_only_include_requested_headers(self):
+        mailbox = fakegmail.SyntheticMailbox('a@example.adamandpaul.biz', 1)
+        resource = mailbox.resource(0, 'metadata', ['Subject'])
+        self.assertEqual(resource['payload']['headers'], [{'name': 'Subject', 'value': 'Synthetic message 0'}])
+        self.assertNotIn('raw', resource)
+
+
+class TestFakeGmailServer(unittest.TestCase):
+    """Testing a mail stream reads the synthetic mailbox through the fake server"""
+
+    def setUp(self):
+        self.mailbox = fakegmail.SyntheticMailbox('a@example.adamandpaul.biz', 12, messages_per_history=3,
+                                                  message_size=fakegmail.lognormal_sizes(2048, sigma=0))
+        self.server = fakegmail.FakeGmailServer([self.mailbox]).start()
+        self.discovery_cache = self.server.discovery_cache()
+        self.waits = []
+        self.executor = retry.RequestExecutor(sleep=self.waits.append)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def create_inbox(self, **kwargs):
+        return mailstream.GmailMailStream(httplib2.Http(), self.mailbox.address,
+                                          cursor=json.dumps({'last_history_id': self.mailbox.first_history_id}),
+                                          discovery_cache=self.discovery_cache,
+                                          executor=self.executor,
+                                          **kwargs)
+
+    def read_subjects(self, inbox, max_histories=None):
+        subjects = []
+        while True:
+            histories = inbox.read_many(max_histories)
+            if histories is None:
+                return subjects
+            subjects.extend(message['subject'] for history_id, messages in histories for message in messages)
+
+    def test_stream_should_read_every_message_over_pages_of_history(self):
+        inbox = self.create_inbox()
+        self.assertEqual(self.read_subjects(inbox, max_histories=2),
+                         ['Synthetic message {}'.format(index) for index in range(12)])
+        self.assertEqual(json.loads(inbox.cursor)['last_history_id'], self.mailbox.history_id)
+        self.assertEqual(self.server.stats['calls']['gmail.users.messages.get'], 12)
+
+    def test_batch_fetcher_should_fetch_each_history_in_one_request(self):
+        inbox = self.create_inbox(fetcher=fetch.BatchFetcher(executor=self.executor))
+        self.server.reset_stats()
+        self.assertEqual(len(self.read_subjects(inbox)), 12)
+        # One history list, one batch per history and the final empty history list
+        self.assertEqual(self.server.stats['http_requests'], 1 + 4 + 1)
+        self.assertEqual(self.server.stats['api_calls'], 1 + 12 + 1)
+
+    def test_threaded_fetcher_should_read_every_message(self):
+        fetcher = fetch.ThreadedFetcher(httplib2.Http, concurrency=3, discovery_cache=self.discovery_cache,
+                                        executor=self.executor)
+        try:
+            self.assertEqual(len(self.read_subjects(self.create_inbox(fetcher=fetcher))), 12)
+        finally:
+            fetcher.close()
+
+    def test_new_messages_should_be_read_after_delivery(self):
+        inbox = self.create_inbox()
+        self.read_subjects(inbox)
+        self.mailbox.deliver(2)
+        self.assertEqual(self.read_subjects(inbox), ['Synthetic message 12', 'Synthetic message 13'])
+
+    def test_checked_time_should_only_move_once_the_latest_history_is_read(self):
+        inbox = self.create_inbox(clock=lambda: 1000.0)
+        inbox.read_many(max_histories=2)
+        self.assertIsNone(json.loads(inbox.cursor)['checked_time'],
+                          'expected the checked time to stay while history is waiting')
+        self.read_subjects(inbox, max_histories=2)
+        self.assertEqual(json.loads(inbox.cursor)['checked_time'], 1000.0)
+
+    def test_rate_limited_calls_should_be_retried(self):
+        self.server.rate_limit_probability = 0.3
+        inbox = self.create_inbox(fetcher=fetch.BatchFetcher(executor=self.executor))
+        self.assertEqual(len(self.read_subjects(inbox)), 12)
+        self.assertGreater(self.server.stats['rate_limited'], 0)
+        self.assertGreater(len(self.waits), 0)
+
+    def test_expired_history_should_be_recovered_by_backfill(self):
+        inbox = mailstream.GmailMailStream(httplib2.Http(), self.mailbox.address,
+                                           cursor=json.dumps({'last_history_id': 1, 'checked_time': 0}),
+                                           discovery_cache=self.discovery_cache,
+                                           executor=self.executor)
+        self.assertEqual(len(inbox.read()), 12)
+        self.assertEqual(inbox.history_id, self.mailbox.history_id)
+
+    def test_expired_history_should_be_recovered_a_chunk_at_a_time(self):
+        chunk_size = mailstream.EXPIRED_CURSOR_CHUNK_SIZE
+        mailstream.EXPIRED_CURSOR_CHUNK_SIZE = 5
+        try:
+            inbox = mailstream.GmailMailStream(httplib2.Http(), self.mailbox.address,
+                                               cursor=json.dumps({'last_history_id': 1, 'checked_time': 0}),
+                                               discovery_cache=self.discovery_cache,
+                                               executor=self.executor)
+            self.assertEqual([message['subject'] for message in inbox.read()],
+                             ['Synthetic message {}'.format(index) for index in range(5)])
+            cursor = json.loads(inbox.cursor)
+            self.assertEqual(cursor['last_history_id'], 1, 'expected the cursor to stay until recovery finishes')
+            self.assertEqual(cursor['checked_time'], self.mailbox.message_time(4))
+            self.server.reset_stats()
+            self.assertEqual(len(inbox.read()), 5)
+            self.assertEqual(self.server.stats['calls'].get('gmail.users.history.list'), None,
+                             'expected the recovery to carry on without listing history')
+            self.assertEqual(len(inbox.read()), 2)
+            self.assertEqual(inbox.history_id, self.mailbox.history_id)
+        finally:
+            mailstream.EXPIRED_CURSOR_CHUNK_SIZE = chunk_size
+
+    def test_recently_read_messages_should_not_be_recovered_again(self):
+        chunk_size = mailstream.EXPIRED_CURSOR_CHUNK_SIZE
+        mailstream.EXPIRED_CURSOR_CHUNK_SIZE = 5
+        try:
+            seen_ids = [self.mailbox.message_id(index) for index in range(3)]
+            inbox = mailstream.GmailMailStream(httplib2.Http(), self.mailbox.address,
+                                               cursor=json.dumps({'last_history_id': 1, 'checked_time': 0,
+                                                                  'seen': seen_ids}),
+                                               discovery_cache=self.discovery_cache,
+                                               executor=self.executor)
+            self.assertEqual([message['subject'] for message in inbox.read()],
+                             ['Synthetic message 3', 'Synthetic message 4'])
+            self.assertEqual(json.loads(inbox.cursor)['seen'], seen_ids + [self.mailbox.message_id(index)
+                                                                           for index in range(3, 5)])
+            self.assertEqual(len(inbox.read()), 5)
+            self.assertEqual(len(inbox.read()), 2)
+            self.assertEqual(self.server.stats['calls']['gmail.users.messages.get'], 9)
+        finally:
+            mailstream.EXPIRED_CURSOR_CHUNK_SIZE = chunk_size
+
+    def test_unknown_message_should_not_be_found(self):
+        api = self.discovery_cache.build(httplib2.Http())
+        with self.assertRaises(mailstream.apiclient.errors.HttpError) as context:
+            api.users().messages().get(userId=self.mailbox.address, id='ffffffffffffffff').execute()
+        self.assertEqual(int(context.exception.resp.status), 404)
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""Strategies for fetching message bodies from the Gmail API
+"""
+
+from gmailtool import quota
+from gmailtool import retry
+
+import apiclient
+import Queue
+import threading
+
+
+# The maximum number of requests gmail accepts in a single batch request
+BATCH_SIZE_LIMIT = 100
+
+# The formats gmail can return a message in
+MESSAGE_FORMATS = ('raw', 'full', 'metadata', 'minimal')
+
+
+class FetchError(Exception):
+    """Raised when some messages could not be fetched
+
+    Attributes:
+        failures (dict): The exception raised for each message id which could not be fetched
+    """
+
+    def __init__(self, failures):
+        super(FetchError, self).__init__('Failed to fetch messages: ' + ', '.join(sorted(failures)))
+        self.failures = failures
+
+
+def unique(message_ids):
+    """Remove repeated message ids while keeping the original order
+
+    Args:
+        message_ids (list of str): The message ids
+
+    Returns:
+        list of str: The message ids with repeats removed
+    """
+    seen = set()
+    result = []
+    for message_id in message_ids:
+        if message_id not in seen:
+            seen.add(message_id)
+            result.append(message_id)
+    return result
+
+
+def message_get_request(api, mailbox, message_id, message_format='raw', metadata_headers=None):
+    """Create a messages.get request
+
+    Args:
+        api (Resource): The gmail api service object
+        mailbox (str): The mailbox the message belongs to
+        message_id (str): The id of the message
+        message_format (str): The format to return the message in, one of MESSAGE_FORMATS
+        metadata_headers (list of str): The headers to include with the metadata format. None for all headers
+
+    Returns:
+        HttpRequest: The request
+    """
+    assert message_format in MESSAGE_FORMATS, 'unknown message format: ' + message_format
+    return api.users().messages().get(userId=mailbox,
+                                      id=message_id,
+                                      format=message_format,
+                                      metadataHeaders=metadata_headers)
+
+
+class SerialFetcher(object):
+    """Fetch messages with one request per message
+    """
+
+    def __init__(self, executor=None):
+        """Initialize a serial fetcher
+
+        Args:
+            executor (RequestExecutor): Executes the requests. Defaults to retrying without a quota budget
+        """
+        self._executor = executor or retry.RequestExecutor()
+
+    def fetch(self, api, mailbox, message_ids, message_format='raw', metadata_headers=None):
+        """Fetch messages
+
+        Args:
+            api (Resource): The gmail api service object
+            mailbox (str): The mailbox the messages belong to
+            message_ids (list of str): The ids of the messages to fetch
+            message_format (str): The format to fetch the messages in, one of MESSAGE_FORMATS
+            metadata_headers (list of str): The headers to include with the metadata format
+
+        Returns:
+            list of dict: The gmail api message resources in the same order as message_ids
+        """
+        messages = []
+        for message_id in message_ids:
+            request = message_get_request(api, mailbox, message_id, message_format, metadata_headers)
+            messages.append(self._executor.execute(request))
+        return messages
+
+
+class BatchFetcher(object):
+    """Fetch messages in chunks using the gmail batch http endpoint
+
+    Messages which fail inside a batch with a retryable error are retried in a following batch
+    on their own, after backing off. The remainder of the batch is not requested again.
+    """
+
+    def __init__(self, batch_size=BATCH_SIZE_LIMIT, max_attempts=3, executor=None):
+        """Initialize a batch fetcher
+
+        Args:
+            batch_size (int): The number of messages to request in each batch
+            max_attempts (int): The number of times to attempt fetching a message before giving up
+            executor (RequestExecutor): Executes the batch requests and decides how long to back off
+                before retrying failed messages. Defaults to retrying without a quota budget
+        """
+        assert 0 < batch_size <= BATCH_SIZE_LIMIT, 'batch_size must be between 1 and {}'.format(BATCH_SIZE_LIMIT)
+        assert max_attempts > 0, 'max_attempts must be at least 1'
+        self._batch_size = batch_size
+        self._max_attempts = max_attempts
+        self._executor = executor or retry.RequestExecutor()
+
+    def fetch(self, api, mailbox, message_ids, message_format='raw', metadata_headers=None):
+        """Fetch messages
+
+        Args:
+            api (Resource): The gmail api service object
+            mailbox (str): The mailbox the messages belong to
+            message_ids (list of str): The ids of the messages to fetch
+            message_format (str): The format to fetch the messages in, one of MESSAGE_FORMATS
+            metadata_headers (list of str): The headers to include with the metadata format
+
+        Returns:
+            list of dict: The gmail api message resources in the same order as message_ids
+
+        Raises:
+            FetchError: Some messages still failed after max_attempts
+        """
+        results = {}
+        pending = unique(message_ids)
+        for attempt in range(1, self._max_attempts + 1):
+            failures = {}
+            for chunk_start in range(0, len(pending), self._batch_size):
+                chunk = pending[chunk_start:chunk_start + self._batch_size]
+                self._fetch_batch(api, mailbox, chunk, results, failures, message_format, metadata_headers)
+            pending = [message_id for message_id in pending if message_id not in results]
+            if len(pending) == 0:
+                break
+            if attempt == self._max_attempts or not all(retry.is_retryable(error) for error in failures.values()):
+                raise FetchError(failures)
+            self._executor.wait(attempt, max(failures.values(), key=lambda error: retry.retry_after(error) or 0.0))
+        return [results[message_id] for message_id in message_ids]
+
+    def _fetch_batch(self, api, mailbox, message_ids, results, failures, message_format, metadata_headers):
+        """Fetch a single batch of messages
+
+        Args:
+            api (Resource): The gmail api service object
+            mailbox (str): The mailbox the messages belong to
+            message_ids (list of str): The unique ids of the messages to fetch
+            results (dict): Successfully fetched messages are stored here by message id
+            failures (dict): Exceptions for messages which failed are stored here by message id
+            message_format (str): The format to fetch the messages in
+            metadata_headers (list of str): The headers to include with the metadata format
+        """
+        def callback(request_id, response, exception):
+            if exception is None:
+                results[request_id] = response
+            else:
+                failures[request_id] = exception
+
+        batch = api.new_batch_http_request(callback=callback)
+        units = 0
+        for message_id in message_ids:
+            request = message_get_request(api, mailbox, message_id, message_format, metadata_headers)
+            batch.add(request, request_id=message_id)
+            units += quota.request_quota_units(request)
+        self._executor.execute(batch, units=units)
+
+
+class ThreadedFetcher(object):
+    """Fetch messages concurrently from a pool of worker threads
+
+    httplib2 is not thread safe, so each worker thread builds its own gmail api service object
+    from its own http object. The number of requests in flight is bounded by the number of
+    workers. Messages are returned in the order they were requested.
+    """
+
+    def __init__(self, http_factory, concurrency=4, discovery_cache=None, executor=None):
+        """Initialize a threaded fetcher
+
+        Args:
+            http_factory (callable): Called with no arguments to create a new oauthed http object
+                for each worker thread
+            concurrency (int): The number of worker threads and thus the maximum number of
+                requests in flight
+            discovery_cache (DiscoveryCache): Used to build the service object of each worker thread
+            executor (RequestExecutor): Executes the requests of every worker thread. Defaults to
+                retrying without a quota budget
+        """
+        assert concurrency > 0, 'concurrency must be at least 1'
+        self._http_factory = http_factory
+        self._concurrency = concurrency
+        self._discovery_cache = discovery_cache
+        self._executor = executor or retry.RequestExecutor()
+        self._jobs = Queue.Queue()
+        self._workers = []
+        self._workers_lock = threading.Lock()
+
+    def fetch(self, api, mailbox, message_ids, message_format='raw', metadata_headers=None):
+        """Fetch messages
+
+        Args:
+            api (Resource): Not used, each worker thread uses its own service object
+            mailbox (str): The mailbox the messages belong to
+            message_ids (list of str): The ids of the messages to fetch
+            message_format (str): The format to fetch the messages in, one of MESSAGE_FORMATS
+            metadata_headers (list of str): The headers to include with the metadata format
+
+        Returns:
+            list of dict: The gmail api message resources in the same order as message_ids
+
+        Raises:
+            FetchError: Some messages could not be fetched
+        """
+        self._start_workers()
+        done = Queue.Queue()
+        for index, message_id in enumerate(message_ids):
+            self._jobs.put((mailbox, message_id, message_format, metadata_headers, index, done))
+
+        messages = [None] * len(message_ids)
+        failures = {}
+        for _ in message_ids:
+            index, message, exception = done.get()
+            if exception is None:
+                messages[index] = message
+            else:
+                failures[message_ids[index]] = exception
+        if len(failures) > 0:
+            raise FetchError(failures)
+        return messages
+
+    def close(self):
+        """Stop the worker threads"""
+        with self._workers_lock:
+            for worker in self._workers:
+                self._jobs.put(None)
+            for worker in self._workers:
+                worker.join()
+            self._workers = []
+
+    def _start_workers(self):
+        """Start the worker threads if they are not already running"""
+        with self._workers_lock:
+            while len(self._workers) < self._concurrency:
+                worker = threading.Thread(target=self._work, name='gmailtool-fetch-{}'.format(len(self._workers)))
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+
+    def _build_api(self):
+        """Build the gmail api service object for a worker thread from a new http object"""
+        http = self._http_factory()
+        if self._discovery_cache is not None:
+            return self._discovery_cache.build(http)
+        return apiclient.discovery.build('gmail', 'v1', http=http)
+
+    def _work(self):
+        """Worker thread main loop fetching messages from the job queue"""
+        api = None
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            mailbox, message_id, message_format, metadata_headers, index, done = job
+            try:
+                if api is None:
+                    api = self._build_api()
+                request = message_get_request(api, mailbox, message_id, message_format, metadata_headers)
+                message = self._executor.execute(request)
+            except Exception as exception:  # noqa: B902 the error is handed back to the fetching thread
+                done.put((index, None, exception))
+            else:
+                done.put((index, message, None))
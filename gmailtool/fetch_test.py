@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""Testing the fetch python module
+"""
+
+from gmailtool import fetch
+from gmailtool import mailstream
+from gmailtool import retry
+from gmailtool.mailstream_test import generate_mock_message
+from gmailtool.mailstream_test import get_gmail_api_descovery_json
+
+import apiclient.http
+import httplib2
+import json
+import random
+import threading
+import time
+import unittest
+
+
+def generate_mock_batch_response(parts, boundary='batch_mock_boundary'):
+    """Generate a mock multipart/mixed response of the gmail batch endpoint
+
+    Args:
+        parts (list of tuple): (request_id, status, body) of each response in the batch
+        boundary (str): The multipart boundary
+
+    Returns:
+        tuple: The (headers, content) pair for use in a HttpMockSequence
+    """
+    content = ''
+    for request_id, status, body in parts:
+        content += '--{}\r\n' \
+                   'Content-Type: application/http\r\n' \
+                   'Content-ID: <response-mock+{}>\r\n' \
+                   '\r\n' \
+                   'HTTP/1.1 {}\r\n' \
+                   'Content-Type: application/json\r\n' \
+                   '\r\n' \
+                   '{}\r\n'.format(boundary, request_id, status, body)
+    content += '--{}--\r\n'.format(boundary)
+    headers = {'status': '200', 'content-type': 'multipart/mixed; boundary="{}"'.format(boundary)}
+    return headers, content
+
+
+class MockGmailHttp(object):
+    """A mock http object answering gmail discovery and message get requests by uri
+
+    Records the thread each request was made from so tests can check http objects are not shared
+    between threads.
+    """
+
+    def __init__(self, messages, delay=0):
+        """Initialize the mock http object
+
+        Args:
+            messages (dict): The gmail api message resources by message id
+            delay (float): The maximum random delay in seconds before responding to a request
+        """
+        self.messages = messages
+        self.delay = delay
+        self.threads = set()
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=1, connection_type=None):
+        self.threads.add(threading.current_thread())
+        if '/discovery/' in uri:
+            return httplib2.Response({'status': '200'}), get_gmail_api_descovery_json()
+        time.sleep(random.random() * self.delay)
+        message_id = uri.split('?')[0].rsplit('/', 1)[1]
+        if message_id not in self.messages:
+            return httplib2.Response({'status': '404'}), '{"error": {"code": 404}}'
+        return httplib2.Response({'status': '200'}), json.dumps(self.messages[message_id])
+
+
+class TestBatchFetch(unittest.TestCase):
+    """Testing fetching the messages of a history in a single batch request"""
+
+    def setUp(self):
+        self.test_message_1 = generate_mock_message('test1234')
+        self.test_message_2 = generate_mock_message('test5432')
+        http = apiclient.http.HttpMockSequence([
+            ({'status': '200'}, get_gmail_api_descovery_json()),
+            (
+                {'status': '200'},
+                json.dumps({
+                    'history': [
+                        {'id': 2, 'messagesAdded': [{'message': self.test_message_1},
+                                                    {'message': self.test_message_2}]},
+                    ]
+                })
+            ),
+            generate_mock_batch_response([
+                ('test1234', '200 OK', json.dumps(self.test_message_1)),
+                ('test5432', '200 OK', json.dumps(self.test_message_2)),
+            ]),
+            ({'status': '403'}, 'Should never be requested'),
+        ])
+        self.inbox = mailstream.GmailMailStream(http,
+                                                'recipient@example.adamandpaul.biz',
+                                                cursor='{"last_history_id": 1}',
+                                                fetcher=fetch.BatchFetcher())
+
+    def test_read_should_fetch_all_messages_in_one_batch(self):
+        messages = self.inbox.read()
+        self.assertEqual([message['subject'] for message in messages], ['test1234', 'test5432'])
+        self.assertEqual(json.loads(self.inbox.cursor)['last_history_id'], 2, 'expected cursor to incriment to 2')
+
+
+class TestBatchFetchPartialFailure(unittest.TestCase):
+    """Testing only the failed messages of a batch are requested again"""
+
+    def setUp(self):
+        self.test_message_1 = generate_mock_message('test1234')
+        self.test_message_2 = generate_mock_message('test5432')
+        self.http = apiclient.http.HttpMockSequence([
+            ({'status': '200'}, get_gmail_api_descovery_json()),
+            generate_mock_batch_response([
+                ('test1234', '200 OK', json.dumps(self.test_message_1)),
+                ('test5432', '503 Service Unavailable', '{"error": {"code": 503}}'),
+            ]),
+            generate_mock_batch_response([
+                ('test5432', '503 Service Unavailable', '{"error": {"code": 503}}'),
+            ]),
+            generate_mock_batch_response([
+                ('test5432', '200 OK', json.dumps(self.test_message_2)),
+            ]),
+            ({'status': '403'}, 'Should never be requested'),
+        ])
+        self.api = apiclient.discovery.build('gmail', 'v1', http=self.http)
+        self.waits = []
+        self.executor = retry.RequestExecutor(random=lambda: 1.0, sleep=self.waits.append)
+
+    def test_fetch_should_retry_failed_messages(self):
+        fetcher = fetch.BatchFetcher(max_attempts=3, executor=self.executor)
+        messages = fetcher.fetch(self.api, 'recipient@example.adamandpaul.biz', ['test1234', 'test5432'])
+        self.assertEqual([message['id'] for message in messages], ['test1234', 'test5432'])
+        self.assertEqual(self.waits, [1.0, 2.0], 'expected exponential backoff between attempts')
+
+    def test_fetch_should_raise_fetch_error_after_max_attempts(self):
+        fetcher = fetch.BatchFetcher(max_attempts=2, executor=self.executor)
+        with self.assertRaises(fetch.FetchError) as context:
+            fetcher.fetch(self.api, 'recipient@example.adamandpaul.biz', ['test1234', 'test5432'])
+        self.assertEqual(list(context.exception.failures), ['test5432'])
+
+    def test_fetch_should_not_retry_messages_which_do_not_exist(self):
+        http = apiclient.http.HttpMockSequence([
+            ({'status': '200'}, get_gmail_api_descovery_json()),
+            generate_mock_batch_response([('missing', '404 Not Found', '{"error": {"code": 404}}')]),
+            ({'status': '403'}, 'Should never be requested'),
+        ])
+        api = apiclient.discovery.build('gmail', 'v1', http=http)
+        fetcher = fetch.BatchFetcher(max_attempts=3, executor=self.executor)
+        with self.assertRaises(fetch.FetchError) as context:
+            fetcher.fetch(api, 'recipient@example.adamandpaul.biz', ['missing'])
+        self.assertEqual(list(context.exception.failures), ['missing'])
+        self.assertEqual(self.waits, [])
+
+    def test_fetch_should_split_messages_into_batches_of_batch_size(self):
+        http = apiclient.http.HttpMockSequence([
+            ({'status': '200'}, get_gmail_api_descovery_json()),
+            generate_mock_batch_response([('test1234', '200 OK', json.dumps(self.test_message_1))]),
+            generate_mock_batch_response([('test5432', '200 OK', json.dumps(self.test_message_2))]),
+            ({'status': '403'}, 'Should never be requested'),
+        ])
+        api = apiclient.discovery.build('gmail', 'v1', http=http)
+        fetcher = fetch.BatchFetcher(batch_size=1)
+        messages = fetcher.fetch(api, 'recipient@example.adamandpaul.biz', ['test1234', 'test5432'])
+        self.assertEqual([message['id'] for message in messages], ['test1234', 'test5432'])
+
+
+class TestThreadedFetch(unittest.TestCase):
+    """Testing fetching messages concurrently from worker threads"""
+
+    def setUp(self):
+        self.message_ids = ['test{}'.format(index) for index in range(20)]
+        self.messages = dict((message_id, generate_mock_message(message_id)) for message_id in self.message_ids)
+        self.https = []
+        self.https_lock = threading.Lock()
+        self.fetcher = fetch.ThreadedFetcher(self.http_factory, concurrency=4)
+
+    def tearDown(self):
+        self.fetcher.close()
+
+    def http_factory(self):
+        http = MockGmailHttp(self.messages, delay=0.01)
+        with self.https_lock:
+            self.https.append(http)
+        return http
+
+    def test_fetch_should_return_messages_in_requested_order(self):
+        messages = self.fetcher.fetch(None, 'recipient@example.adamandpaul.biz', self.message_ids)
+        self.assertEqual([message['id'] for message in messages], self.message_ids)
+
+    def test_fetch_should_use_one_http_object_per_thread(self):
+        self.fetcher.fetch(None, 'recipient@example.adamandpaul.biz', self.message_ids)
+        self.assertLessEqual(len(self.https), 4, 'expected at most one http object per worker')
+        for http in self.https:
+            self.assertEqual(len(http.threads), 1, 'expected http object to be used from a single thread')
+
+    def test_fetch_should_raise_fetch_error_for_failed_messages(self):
+        with self.assertRaises(fetch.FetchError) as context:
+            self.fetcher.fetch(None, 'recipient@example.adamandpaul.biz', ['test1', 'missing'])
+        self.assertEqual(list(context.exception.failures), ['missing'])
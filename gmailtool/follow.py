@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""Follow new mail arriving in many mailboxes"""
+
+
+from gmailtool import auth
+from gmailtool import cache
+from gmailtool import config
+from gmailtool import cursorstore
+from gmailtool import discoverycache
+from gmailtool import fetch
+from gmailtool import httppool
+from gmailtool import instrumentation
+from gmailtool import mailstream
+from gmailtool import messageindex
+from gmailtool import quota
+from gmailtool import retry
+from gmailtool import scheduler
+from gmailtool import watch
+
+import argparse
+import logging
+import os
+import sys
+
+
+logger = logging.getLogger('gmailtool.follow')
+
+# The only headers fetched for the summary lines written by the follow command
+SUMMARY_HEADERS = ['Message-ID', 'Subject']
+
+
+def write_message_summaries(out, mailbox, history_id, messages):
+    """Write a tab separated summary line for each message
+
+    Args:
+        out (file): The file to write to
+        mailbox (str): The mailbox the messages were read from
+        history_id (int): The history the messages were added in
+        messages (list of email message): The messages
+    """
+    for message in messages:
+        fields = [mailbox, str(history_id), message.get('message-id', ''), message.get('subject', '')]
+        out.write('\t'.join(fields) + '\n')
+    out.flush()
+
+
+def cmd_follow(args):
+    """The follow command
+    """
+    logger.debug('Running command follow')
+
+    credential_manager = auth.get_credential_manager(args.profile_dir)
+    pool = httppool.get_connection_pool(args.profile_dir)
+    try:
+        http = credential_manager.authorize(pool.http())
+    except auth.NotAuthenticatedError as error:
+        logger.error(str(error))
+        sys.exit(1)
+    credential_manager.start()
+
+    budget = None
+    if args.requests_per_second > 0:
+        budget = quota.TokenBucket(args.requests_per_second)
+
+    def handler(mailbox, history_id, messages):
+        write_message_summaries(sys.stdout, mailbox, history_id, messages)
+
+    cursor_store_path = os.path.join(os.path.expanduser(args.profile_dir), config.cursor_storage_filename)
+    cursor_store = cursorstore.CursorStore(cursor_store_path,
+                                           checkpoint_histories=args.checkpoint_histories,
+                                           checkpoint_seconds=args.checkpoint_seconds)
+
+    if args.watch_subscription is not None:
+        # Mailboxes are read when notified of new mail, and every max interval in case a notification was lost
+        source = watch.PubSubPullSource(credential_manager.authorize(pool.http()), args.watch_subscription)
+        follower = watch.NotificationFollower(handler,
+                                              source,
+                                              budget=budget,
+                                              cursor_store=cursor_store,
+                                              topic_name=args.watch_topic,
+                                              resync_seconds=args.max_interval,
+                                              histories_per_read=args.histories_per_turn)
+    else:
+        follower = scheduler.Scheduler(handler,
+                                       budget=budget,
+                                       cursor_store=cursor_store,
+                                       min_interval=args.min_interval,
+                                       max_interval=args.max_interval,
+                                       histories_per_turn=args.histories_per_turn)
+    message_cache = None
+    if args.cache_megabytes > 0:
+        message_cache_path = os.path.join(os.path.expanduser(args.profile_dir), config.message_cache_dirname)
+        message_cache = cache.MessageCache(message_cache_path,
+                                           max_bytes=int(args.cache_megabytes * 1024 * 1024),
+                                           compress=args.cache_compress)
+
+    discovery_cache_path = os.path.join(os.path.expanduser(args.profile_dir), config.discovery_cache_filename)
+    discovery_cache = discoverycache.get_discovery_cache(discovery_cache_path)
+
+    index = None
+    metadata_headers = SUMMARY_HEADERS
+    if args.index:
+        index_path = os.path.join(os.path.expanduser(args.profile_dir), config.message_index_filename)
+        index = messageindex.MessageIndex(index_path)
+        metadata_headers = fetch.unique(SUMMARY_HEADERS + messageindex.INDEX_HEADERS)
+
+    metrics = None
+    exporters = []
+    if args.metrics_file is not None or args.metrics_port is not None:
+        metrics = instrumentation.Metrics()
+        pool.metrics = metrics
+    if args.metrics_file is not None:
+        exporters.append(instrumentation.PrometheusFileExporter(metrics, args.metrics_file))
+    if args.metrics_port is not None:
+        exporters.append(instrumentation.PrometheusHttpExporter(metrics, args.metrics_port))
+
+    for mailbox in args.mailboxes:
+        # Gmail quotas are per user, so each mailbox gets its own quota unit budget
+        quota_budget = None
+        if args.quota_units_per_second > 0:
+            quota_budget = quota.TokenBucket(args.quota_units_per_second)
+        executor = retry.RequestExecutor(budget=quota_budget, metrics=metrics)
+        stream = mailstream.GmailMailStream(http, mailbox,
+                                            discovery_cache=discovery_cache,
+                                            cursor=cursor_store.get(mailbox),
+                                            executor=executor,
+                                            fetcher=fetch.BatchFetcher(executor=executor),
+                                            cache=message_cache,
+                                            message_format='metadata',
+                                            metadata_headers=metadata_headers,
+                                            index=index,
+                                            seen_window=args.seen_window,
+                                            metrics=metrics)
+        cursor_store.set(mailbox, stream.cursor, histories=0)
+        follower.add(mailbox, stream)
+    # Save the starting position of new mailboxes so mail arriving before the first
+    # checkpoint is not skipped after a crash
+    cursor_store.checkpoint()
+    for exporter in exporters:
+        exporter.start()
+    try:
+        follower.run(until_idle=args.until_idle)
+    finally:
+        for exporter in exporters:
+            exporter.stop()
+        credential_manager.stop()
+        httppool.log_stats(pool)
+        pool.close()
+        if index is not None:
+            index.close()
+
+
+def cmd_follow_register(parsers, environ):
+    """Configure the argument parser for use with the follow command
+
+    Args:
+        parsers (Parsers): The parsers which belong to the higher level parser
+    """
+    parser = parsers.add_parser('follow', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('mailboxes', nargs='+', metavar='mailbox',
+                        help='The mailboxes to follow (e.g. example@gmail.com)')
+    parser.add_argument('--min-interval', type=float, default=10.0,
+                        help='The shortest number of seconds between polls of a busy mailbox')
+    parser.add_argument('--max-interval', type=float, default=600.0,
+                        help='The longest number of seconds between polls of an idle mailbox')
+    parser.add_argument('--histories-per-turn', type=int, default=10,
+                        help='The most histories read from one mailbox before moving on to the next')
+    parser.add_argument('--requests-per-second', type=float, default=20.0,
+                        help='The request budget shared by all mailboxes, 0 for no limit')
+    parser.add_argument('--quota-units-per-second', type=float, default=quota.USER_QUOTA_UNITS_PER_SECOND,
+                        help='The gmail api quota units each mailbox may spend per second, 0 for no limit')
+    parser.add_argument('--checkpoint-histories', type=int, default=100,
+                        help='Save cursors after this many histories have been read')
+    parser.add_argument('--checkpoint-seconds', type=float, default=30.0,
+                        help='Save cursors at least this often while new mail is arriving')
+    parser.add_argument('--cache-megabytes', type=float, default=0,
+                        help='Cache fetched messages in the profile directory up to this size, 0 to disable')
+    parser.add_argument('--cache-compress', action='store_true',
+                        help='Compress cached messages')
+    parser.add_argument('--index', action='store_true',
+                        help='Record the headers of new messages in the local index used by the search command')
+    parser.add_argument('--watch-subscription',
+                        help='Read mailboxes when gmail notifications arrive on this Cloud Pub/Sub subscription '
+                             '(e.g. projects/my-project/subscriptions/gmail) instead of polling them')
+    parser.add_argument('--watch-topic',
+                        help='Ask gmail to publish notifications for each mailbox to this Cloud Pub/Sub topic '
+                             '(e.g. projects/my-project/topics/gmail), renewing the watch daily')
+    parser.add_argument('--metrics-file',
+                        help='Write metrics in the Prometheus text format to this file every 15 seconds')
+    parser.add_argument('--metrics-port', type=int,
+                        help='Serve metrics in the Prometheus text format at http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--until-idle', action='store_true',
+                        help='Exit once every mailbox has been read up to its latest history')
+    parser.add_argument('--seen-window', type=int, default=mailstream.SEEN_WINDOW_SIZE,
+                        help='Remember this many recently read message ids per mailbox so repeats are not downloaded '
+                             'again, 0 to disable')
+    parser.set_defaults(func=cmd_follow)
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""Keep-alive http connections shared by every stream and worker in the process using a profile
+"""
+
+from gmailtool import instrumentation
+
+import httplib2
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger('gmailtool.httppool')
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_connection_pool(profile_dir):
+    """Get the connection pool of a profile, shared by everything in the process using the profile
+
+    Args:
+        profile_dir (str): The profile directory
+
+    Returns:
+        ConnectionPool: The connection pool
+    """
+    key = os.path.abspath(os.path.expanduser(profile_dir))
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool()
+        return _pools[key]
+
+
+def log_stats(pool):
+    """Log how often a pool reused an open connection
+
+    Args:
+        pool (ConnectionPool): The pool
+    """
+    stats = pool.stats
+    if stats['hits'] + stats['misses'] == 0:
+        return
+    logger.info('HTTP connections: {} requests reused an open connection, {} opened a new one '
+                '({:.0%} hit rate), {} idle connections reaped'.format(
+                    stats['hits'], stats['misses'], pool.hit_rate, stats['reaped']))
+
+
+def connection_key(uri):
+    """The key httplib2 keeps the connection for a uri under
+
+    Args:
+        uri (str): An absolute uri
+
+    Returns:
+        str: The scheme and authority of the uri, e.g. https:www.googleapis.com
+    """
+    scheme, authority, request_uri, defrag_uri = httplib2.urlnorm(httplib2.iri2uri(uri))
+    return scheme + ':' + authority
+
+
+class ConnectionPool(object):
+    """A thread safe pool of open http connections, keyed by scheme and host
+
+    A connection is lent to one request at a time and returned once the response has been read,
+    so a TLS handshake is only made when no idle connection to the host is left. The connections
+    to each host, lent or idle, are limited, and a request waits for a connection to be returned
+    once the limit is reached. Connections left idle for too long are closed.
+
+    Attributes:
+        metrics (Metrics): Records each connection lent as a hit or a miss
+    """
+
+    def __init__(self,
+                 max_per_host=10,
+                 max_idle_per_host=4,
+                 idle_seconds=60.0,
+                 metrics=instrumentation.NULL_METRICS,
+                 clock=time.time):
+        """Initialize a connection pool
+
+        Args:
+            max_per_host (int): The most connections to each host, lent or idle
+            max_idle_per_host (int): The most idle connections kept open to each host
+            idle_seconds (float): Idle connections unused for this many seconds are closed
+            metrics (Metrics): Records each connection lent as a hit or a miss
+            clock (callable): Returns the current time in seconds
+        """
+        assert max_per_host >= 1, 'max_per_host must be at least 1'
+        self._max_per_host = max_per_host
+        self._max_idle_per_host = max_idle_per_host
+        self._idle_seconds = idle_seconds
+        self.metrics = metrics
+        self._clock = clock
+        self._idle = {}
+        self._lent = {}
+        self._stats = {'hits': 0, 'misses': 0, 'reaped': 0}
+        self._returned = threading.Condition(threading.Lock())
+
+    @property
+    def stats(self):
+        """dict: The connections lent from the pool (hits) and opened by requests (misses), idle
+        connections closed (reaped), and the number of connections currently lent and idle"""
+        with self._returned:
+            stats = dict(self._stats)
+            stats['lent'] = sum(self._lent.values())
+            stats['idle'] = sum(len(idle) for idle in self._idle.values())
+        return stats
+
+    @property
+    def hit_rate(self):
+        """float: The fraction of requests which reused an open connection, None before any request"""
+        stats = self.stats
+        requests = stats['hits'] + stats['misses']
+        if requests == 0:
+            return None
+        return float(stats['hits']) / requests
+
+    def http(self, **kwargs):
+        """Create an http object which borrows its connections from the pool
+
+        The http object is thread safe, and can be authorized like any httplib2.Http.
+
+        Args:
+            **kwargs: Passed to httplib2.Http, e.g. timeout
+
+        Returns:
+            PooledHttp: The http object
+        """
+        return PooledHttp(self, **kwargs)
+
+    def checkout(self, key):
+        """Borrow a connection to a host, waiting while every connection to the host is lent
+
+        Args:
+            key (str): The connection key of the host, see connection_key
+
+        Returns:
+            connection: The most recently used idle connection, None if the caller should open one
+        """
+        with self._returned:
+            expired = self._reap(self._clock())
+            while not self._idle.get(key) and self._lent.get(key, 0) >= self._max_per_host:
+                self._returned.wait()
+            self._lent[key] = self._lent.get(key, 0) + 1
+            idle = self._idle.get(key)
+            if idle:
+                connection, last_used = idle.pop()
+                self._stats['hits'] += 1
+                result = 'hit'
+            else:
+                connection = None
+                self._stats['misses'] += 1
+                result = 'miss'
+        for expired_connection in expired:
+            expired_connection.close()
+        self.metrics.increment(instrumentation.HTTP_CONNECTIONS, labels={'result': result})
+        return connection
+
+    def checkin(self, key, connection, lent=True):
+        """Return a connection to the pool once its response has been read
+
+        Args:
+            key (str): The connection key of the host
+            connection (connection): The connection, None if the request did not open one. A
+                connection which is no longer open is dropped.
+            lent (bool): False for a connection opened without a checkout, e.g. following a redirect
+        """
+        close = None
+        with self._returned:
+            if lent:
+                self._lent[key] -= 1
+            # A connection the server closed would need a new handshake, so it is not kept
+            if connection is not None and getattr(connection, 'sock', None) is not None:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self._max_idle_per_host and \
+                        self._lent.get(key, 0) + len(idle) < self._max_per_host:
+                    idle.append((connection, self._clock()))
+                else:
+                    close = connection
+            self._returned.notify_all()
+        if close is not None:
+            close.close()
+
+    def discard(self, key, connection, lent=True):
+        """Close a connection whose request failed instead of returning it to the pool
+
+        Args:
+            key (str): The connection key of the host
+            connection (connection): The connection, None if the request did not open one
+            lent (bool): False for a connection opened without a checkout
+        """
+        if connection is not None:
+            connection.close()
+        self.checkin(key, None, lent=lent)
+
+    def reap(self):
+        """Close the idle connections unused for longer than the idle timeout
+
+        Returns:
+            int: The number of connections closed
+        """
+        with self._returned:
+            expired = self._reap(self._clock())
+        for connection in expired:
+            connection.close()
+        return len(expired)
+
+    def close(self):
+        """Close every idle connection"""
+        with self._returned:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection, last_used in connections:
+                connection.close()
+
+    def _reap(self, now):
+        """Remove the expired idle connections, the caller holds the lock and closes them
+
+        Returns:
+            list of connection: The expired connections
+        """
+        expired = []
+        for key, idle in self._idle.items():
+            fresh = [(connection, last_used) for connection, last_used in idle
+                     if now - last_used < self._idle_seconds]
+            if len(fresh) < len(idle):
+                expired.extend(connection for connection, last_used in idle
+                               if now - last_used >= self._idle_seconds)
+                self._idle[key] = fresh
+        self._stats['reaped'] += len(expired)
+        return expired
+
+
+class PooledHttp(httplib2.Http):
+    """A httplib2.Http borrowing its connections from a ConnectionPool for each request
+
+    httplib2 keeps the connections of an Http object in its connections dict. Here the dict is
+    per thread and only holds the connections of the request in progress, so one PooledHttp can
+    be used by many threads at once.
+    """
+
+    def __init__(self, pool, **kwargs):
+        """Initialize a pooled http object
+
+        Args:
+            pool (ConnectionPool): The pool the connections are borrowed from
+            **kwargs: Passed to httplib2.Http
+        """
+        self._pool = pool
+        self._local = threading.local()
+        httplib2.Http.__init__(self, **kwargs)
+
+    @property
+    def connections(self):
+        """dict: The connections of the request in progress on this thread"""
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        return connections
+
+    @connections.setter
+    def connections(self, connections):
+        self._local.connections = connections
+
+    def request(self, uri, *args, **kwargs):
+        if getattr(self._local, 'in_request', False):
+            # httplib2 follows a redirect by calling request from within the request, which uses
+            # the connections of the request in progress and opens any others it needs
+            return httplib2.Http.request(self, uri, *args, **kwargs)
+        key = connection_key(uri)
+        connection = self._pool.checkout(key)
+        connections = self.connections
+        if connection is not None:
+            connections[key] = connection
+        self._local.in_request = True
+        try:
+            result = httplib2.Http.request(self, uri, *args, **kwargs)
+        except Exception:
+            self._return_connections(key, self._pool.discard)
+            raise
+        finally:
+            self._local.in_request = False
+        self._return_connections(key, self._pool.checkin)
+        return result
+
+    def _return_connections(self, key, give_back):
+        """Give back the lent connection and any opened following redirects
+
+        Args:
+            key (str): The connection key of the lent connection
+            give_back (callable): ConnectionPool.checkin or ConnectionPool.discard
+        """
+        connections, self.connections = self.connections, {}
+        give_back(key, connections.pop(key, None))
+        for other_key, connection in connections.items():
+            give_back(other_key, connection, lent=False)
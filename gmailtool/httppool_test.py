@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""Testing the httppool python module
+"""
+
+from gmailtool import fakegmail
+from gmailtool import fetch
+from gmailtool import httppool
+from gmailtool import instrumentation
+from gmailtool import mailstream
+from gmailtool import retry
+
+import BaseHTTPServer
+import json
+import SocketServer
+import threading
+import unittest
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class RedirectingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Redirects /redirect to /target on the same host, keeping connections alive"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):  # noqa: N802 the name BaseHTTPRequestHandler dispatches to
+        if self.path == '/redirect':
+            self.send_response(302)
+            self.send_header('Location', '/target')
+            content = ''
+        else:
+            self.send_response(200)
+            content = 'target'
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    pass
+
+
+class TestConnectionPool(unittest.TestCase):
+    """Testing http connections are reused, limited per host and reaped when idle"""
+
+    def setUp(self):
+        self.mailbox = fakegmail.SyntheticMailbox('a@example.adamandpaul.biz', 8, messages_per_history=4,
+                                                  message_size=fakegmail.lognormal_sizes(1024, sigma=0))
+        self.server = fakegmail.FakeGmailServer([self.mailbox]).start()
+        self.clock = FakeClock()
+        self.metrics = instrumentation.Metrics()
+        self.pool = httppool.ConnectionPool(max_per_host=2, idle_seconds=30, metrics=self.metrics, clock=self.clock)
+        self.profile_uri = self.server.root_uri + 'gmail/v1/users/me/profile'
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.stop()
+
+    def test_connection_key_should_be_the_scheme_and_host(self):
+        self.assertEqual(httppool.connection_key('HTTPS://www.GoogleApis.com/gmail/v1?x=1'),
+                         'https:www.googleapis.com')
+
+    def test_http_objects_should_share_connections(self):
+        for _ in range(3):
+            for http in [self.pool.http(), self.pool.http()]:
+                response, content = http.request(self.profile_uri)
+                self.assertEqual(int(response.status), 200)
+        self.assertEqual(self.server.stats['connections'], 1)
+        self.assertEqual(self.pool.stats['hits'], 5)
+        self.assertEqual(self.pool.stats['misses'], 1)
+        self.assertAlmostEqual(self.pool.hit_rate, 5 / 6.0)
+        self.assertEqual(self.metrics.value(instrumentation.HTTP_CONNECTIONS, {'result': 'hit'}), 5)
+
+    def test_connections_should_be_limited_per_host(self):
+        http = self.pool.http()
+        errors = []
+
+        def request():
+            try:
+                for _ in range(5):
+                    http.request(self.profile_uri)
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=request) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertLessEqual(self.server.stats['connections'], 2)
+        self.assertEqual(self.pool.stats['lent'], 0)
+        self.assertEqual(self.pool.stats['hits'] + self.pool.stats['misses'], 30)
+
+    def test_idle_connections_should_be_reaped(self):
+        self.pool.http().request(self.profile_uri)
+        self.assertEqual(self.pool.stats['idle'], 1)
+        self.clock.now += 10
+        self.assertEqual(self.pool.reap(), 0)
+        self.clock.now += 30
+        self.assertEqual(self.pool.reap(), 1)
+        self.assertEqual(self.pool.stats['idle'], 0)
+        self.pool.http().request(self.profile_uri)
+        self.assertEqual(self.server.stats['connections'], 2)
+
+    def test_failed_request_should_not_return_its_connection(self):
+        self.server.stop()
+        with self.assertRaises(Exception):
+            self.pool.http().request(self.profile_uri)
+        self.assertEqual(self.pool.stats['lent'], 0)
+        self.assertEqual(self.pool.stats['idle'], 0)
+
+    def test_redirect_to_the_same_host_should_use_the_lent_connection(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), RedirectingHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            response, content = self.pool.http().request('http://127.0.0.1:{}/redirect'.format(server.server_port))
+            stats = self.pool.stats
+        finally:
+            # Closing the kept alive connection lets its handler thread finish
+            self.pool.close()
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(content, 'target')
+        self.assertEqual(stats['hits'] + stats['misses'], 1)
+        self.assertEqual(stats['lent'], 0)
+        self.assertEqual(stats['idle'], 1)
+
+    def test_streams_and_fetcher_workers_should_share_connections(self):
+        discovery_cache = self.server.discovery_cache()
+        executor = retry.RequestExecutor(sleep=lambda seconds: None)
+        fetcher = fetch.ThreadedFetcher(self.pool.http, concurrency=2, discovery_cache=discovery_cache,
+                                        executor=executor)
+        try:
+            for _ in range(3):
+                cursor = json.dumps({'last_history_id': self.mailbox.first_history_id})
+                stream = mailstream.GmailMailStream(self.pool.http(), self.mailbox.address,
+                                                    cursor=cursor,
+                                                    discovery_cache=discovery_cache,
+                                                    executor=executor,
+                                                    fetcher=fetcher)
+                self.assertEqual(sum(len(messages) for history_id, messages in stream.read_many(10)), 8)
+        finally:
+            fetcher.close()
+        self.assertLessEqual(self.server.stats['connections'], 2)
+        self.assertGreater(self.pool.hit_rate, 0.9)
+
+
+class TestGetConnectionPool(unittest.TestCase):
+    """Testing a pool is shared per profile"""
+
+    def test_pool_should_be_shared_by_profile(self):
+        pool = httppool.get_connection_pool('/tmp/gmailtool-profile-a')
+        self.assertIs(httppool.get_connection_pool('/tmp/gmailtool-profile-a/'), pool)
+        self.assertIsNot(httppool.get_connection_pool('/tmp/gmailtool-profile-b'), pool)
@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+"""Metrics recorded while reading mail, and exporting them in the Prometheus text format
+"""
+
+from gmailtool import cursorstore
+
+import BaseHTTPServer
+import bisect
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger('gmailtool.instrumentation')
+
+# Gmail api calls made, labelled by method (history.list, messages.get or getProfile)
+API_REQUESTS = 'gmailtool_api_requests_total'
+
+# Time spent in each stage of reading mail, labelled by stage (history_list, message_get,
+# decode or parse)
+STAGE_SECONDS = 'gmailtool_stage_seconds'
+
+# Messages fetched from gmail, labelled by mailbox
+MESSAGES = 'gmailtool_messages_total'
+
+# Encoded bytes of the messages fetched from gmail, labelled by mailbox
+MESSAGE_BYTES = 'gmailtool_message_bytes_total'
+
+# Requests retried after rate limit or server errors
+RETRIES = 'gmailtool_request_retries_total'
+
+# The number of histories a mailbox cursor was behind the latest history when history was last
+# listed, labelled by mailbox
+CURSOR_LAG = 'gmailtool_cursor_lag_histories'
+
+# Requests given a pooled http connection, labelled by result (hit when an open connection was
+# reused, miss when a new one was opened)
+HTTP_CONNECTIONS = 'gmailtool_http_connections_total'
+
+# The help text of each metric
+METRIC_HELP = {
+    API_REQUESTS: 'Gmail api calls made',
+    STAGE_SECONDS: 'Seconds spent in each stage of reading mail',
+    MESSAGES: 'Messages fetched from gmail',
+    MESSAGE_BYTES: 'Encoded bytes of the messages fetched from gmail',
+    RETRIES: 'Requests retried after rate limit or server errors',
+    CURSOR_LAG: 'Histories the cursor was behind the latest history when history was last listed',
+    HTTP_CONNECTIONS: 'Requests given a pooled http connection, by whether an open connection was reused',
+}
+
+# The upper bounds in seconds of the histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class NullMetrics(object):
+    """Metrics which record nothing, the default so uninstrumented runs pay almost nothing
+
+    Attributes:
+        enabled (bool): False, so callers can skip work which only feeds metrics
+    """
+
+    enabled = False
+
+    def increment(self, name, value=1, labels=None):
+        """Add to a counter
+
+        Args:
+            name (str): The metric name
+            value (float): The amount added
+            labels (dict): The labels of the counter
+        """
+
+    def set_gauge(self, name, value, labels=None):
+        """Set a gauge
+
+        Args:
+            name (str): The metric name
+            value (float): The value
+            labels (dict): The labels of the gauge
+        """
+
+    def observe(self, name, value, labels=None):
+        """Record a value in a histogram
+
+        Args:
+            name (str): The metric name
+            value (float): The value, usually in seconds
+            labels (dict): The labels of the histogram
+        """
+
+    def timer(self, name, labels=None):
+        """A context manager recording the seconds spent inside it in a histogram
+
+        Args:
+            name (str): The metric name
+            labels (dict): The labels of the histogram
+
+        Returns:
+            context manager: The timer
+        """
+        return _NULL_TIMER
+
+
+# The shared metrics which record nothing
+NULL_METRICS = NullMetrics()
+
+
+class Metrics(NullMetrics):
+    """Metrics recorded in memory and rendered in the Prometheus text format
+
+    Recording is thread safe, so the streams, fetchers and executors of many threads can share
+    one Metrics object.
+    """
+
+    enabled = True
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, clock=time.time):
+        """Initialize metrics
+
+        Args:
+            buckets (tuple of float): The upper bounds of the histogram buckets, in increasing order
+            clock (callable): Returns the current time in seconds, used by timers
+        """
+        self._buckets = tuple(buckets)
+        self._clock = clock
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1, labels=None):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, labels=None):
+        with self._lock:
+            self._gauges[(name, _label_key(labels))] = value
+
+    def observe(self, name, value, labels=None):
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self._buckets), 0.0, 0]
+            bucket = bisect.bisect_left(self._buckets, value)
+            if bucket < len(self._buckets):
+                histogram[0][bucket] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def timer(self, name, labels=None):
+        return _Timer(self, name, labels)
+
+    def value(self, name, labels=None):
+        """The value of a counter or gauge, or the count of a histogram
+
+        Args:
+            name (str): The metric name
+            labels (dict): The labels of the metric
+
+        Returns:
+            float: The value, None if nothing has been recorded
+        """
+        key = (name, _label_key(labels))
+        with self._lock:
+            if key in self._counters:
+                return self._counters[key]
+            if key in self._gauges:
+                return self._gauges[key]
+            if key in self._histograms:
+                return self._histograms[key][2]
+        return None
+
+    def render(self):
+        """The metrics in the Prometheus text exposition format
+
+        Returns:
+            str: The metrics
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            histograms = dict((key, (list(buckets), total, count))
+                              for key, (buckets, total, count) in self._histograms.items())
+        lines = []
+        for metric_type, samples in (('counter', counters), ('gauge', gauges)):
+            for name in sorted(set(name for name, labels in samples)):
+                lines.extend(_header(name, metric_type))
+                for (sample_name, labels), value in sorted(samples.items()):
+                    if sample_name == name:
+                        lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+        for name in sorted(set(name for name, labels in histograms)):
+            lines.extend(_header(name, 'histogram'))
+            for (sample_name, labels), (buckets, total, count) in sorted(histograms.items()):
+                if sample_name != name:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(self._buckets, buckets):
+                    cumulative += bucket_count
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _format_labels(labels + (('le', _format_value(bound)),)), cumulative))
+                lines.append('{}_bucket{} {}'.format(name, _format_labels(labels + (('le', '+Inf'),)), count))
+                lines.append('{}_sum{} {}'.format(name, _format_labels(labels), _format_value(total)))
+                lines.append('{}_count{} {}'.format(name, _format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+class PrometheusFileExporter(object):
+    """Periodically write metrics to a file, e.g. for the node exporter textfile collector
+
+    The file is replaced atomically so a collector never reads a partly written file.
+    """
+
+    def __init__(self, metrics, path, interval=15.0):
+        """Initialize a file exporter
+
+        Args:
+            metrics (Metrics): The metrics to export
+            path (str): The file to write
+            interval (float): The number of seconds between writes
+        """
+        self._metrics = metrics
+        self._path = path
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def write(self):
+        """Write the metrics now"""
+        cursorstore.atomic_write(self._path, self._metrics.render())
+
+    def start(self):
+        """Write the metrics every interval from a daemon thread until stop is called"""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='gmailtool-metrics-file')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop writing and write the final metrics"""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.write()
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            try:
+                self.write()
+            except (IOError, OSError) as error:
+                logger.warning('Could not write metrics to {}: {}'.format(self._path, error))
+
+
+class PrometheusHttpExporter(object):
+    """Serve metrics to Prometheus over http at /metrics"""
+
+    def __init__(self, metrics, port, host='127.0.0.1'):
+        """Initialize a http exporter
+
+        Args:
+            metrics (Metrics): The metrics to serve
+            port (int): The port to listen on, 0 for any free port
+            host (str): The address to listen on
+        """
+        self._metrics = metrics
+        self._address = (host, port)
+        self._httpd = None
+        self._thread = None
+
+    @property
+    def port(self):
+        """int: The port being listened on"""
+        return self._httpd.server_address[1]
+
+    def start(self):
+        """Serve from a daemon thread until stop is called"""
+        self._httpd = BaseHTTPServer.HTTPServer(self._address, _MetricsHandler)
+        self._httpd.metrics = self._metrics
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='gmailtool-metrics-http')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop serving"""
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._thread.join()
+            self._httpd = None
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers scrapes of a PrometheusHttpExporter"""
+
+    def do_GET(self):  # noqa: N802 the name BaseHTTPRequestHandler dispatches to
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        content = self.server.metrics.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class _NullTimer(object):
+    """A timer which records nothing"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+    """Records the seconds spent inside it in a histogram"""
+
+    def __init__(self, metrics, name, labels):
+        self._metrics = metrics
+        self._name = name
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = self._metrics._clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._metrics.observe(self._name, self._metrics._clock() - self._start, self._labels)
+        return False
+
+
+def _label_key(labels):
+    """tuple: Labels in a hashable, sorted form"""
+    if not labels:
+        return ()
+    return tuple(sorted(labels.items()))
+
+
+def _header(name, metric_type):
+    """list of str: The HELP and TYPE lines of a metric"""
+    lines = []
+    if name in METRIC_HELP:
+        lines.append('# HELP {} {}'.format(name, METRIC_HELP[name]))
+    lines.append('# TYPE {} {}'.format(name, metric_type))
+    return lines
+
+
+def _format_labels(labels):
+    """str: Labels in the {name="value"} form, empty when there are none"""
+    if not labels:
+        return ''
+    escaped = ('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"'))
+               for name, value in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value):
+    """str: A sample value, without a trailing .0 on whole numbers"""
+    if isinstance(value, float):
+        if value.is_integer():
+            return str(int(value))
+        return repr(value)
+    return str(value)
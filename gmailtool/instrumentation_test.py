@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""Testing the instrumentation python module
+"""
+
+from gmailtool import fakegmail
+from gmailtool import fetch
+from gmailtool import instrumentation
+from gmailtool import mailstream
+from gmailtool import retry
+
+import httplib2
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestMetrics(unittest.TestCase):
+    """Testing metrics are recorded and rendered in the Prometheus text format"""
+
+    def test_render_should_write_counters_and_gauges(self):
+        metrics = instrumentation.Metrics()
+        metrics.increment(instrumentation.API_REQUESTS, labels={'method': 'messages.get'})
+        metrics.increment(instrumentation.API_REQUESTS, 2, {'method': 'messages.get'})
+        metrics.set_gauge(instrumentation.CURSOR_LAG, 7, {'mailbox': 'a"b'})
+        text = metrics.render()
+        self.assertIn('# TYPE gmailtool_api_requests_total counter\n'
+                      'gmailtool_api_requests_total{method="messages.get"} 3\n', text)
+        self.assertIn('gmailtool_cursor_lag_histories{mailbox="a\\"b"} 7\n', text)
+
+    def test_timer_should_record_a_histogram(self):
+        clock = FakeClock()
+        metrics = instrumentation.Metrics(buckets=(0.1, 1.0), clock=clock)
+        with metrics.timer(instrumentation.STAGE_SECONDS, {'stage': 'parse'}):
+            clock.now += 0.5
+        metrics.observe(instrumentation.STAGE_SECONDS, 0.1, {'stage': 'parse'})
+        text = metrics.render()
+        self.assertIn('gmailtool_stage_seconds_bucket{stage="parse",le="0.1"} 1\n'
+                      'gmailtool_stage_seconds_bucket{stage="parse",le="1"} 2\n'
+                      'gmailtool_stage_seconds_bucket{stage="parse",le="+Inf"} 2\n'
+                      'gmailtool_stage_seconds_sum{stage="parse"} 0.6\n'
+                      'gmailtool_stage_seconds_count{stage="parse"} 2\n', text)
+
+    def test_null_metrics_should_record_nothing(self):
+        metrics = instrumentation.NULL_METRICS
+        self.assertFalse(metrics.enabled)
+        metrics.increment(instrumentation.API_REQUESTS)
+        with metrics.timer(instrumentation.STAGE_SECONDS):
+            pass
+
+
+class TestExporters(unittest.TestCase):
+    """Testing metrics are exported to a file and over http"""
+
+    def setUp(self):
+        self.metrics = instrumentation.Metrics()
+        self.metrics.increment(instrumentation.RETRIES)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_file_exporter_should_write_on_stop(self):
+        path = os.path.join(self.directory, 'gmailtool.prom')
+        exporter = instrumentation.PrometheusFileExporter(self.metrics, path, interval=60)
+        exporter.start()
+        exporter.stop()
+        with open(path) as metrics_file:
+            self.assertIn('gmailtool_request_retries_total 1\n', metrics_file.read())
+
+    def test_http_exporter_should_serve_metrics(self):
+        exporter = instrumentation.PrometheusHttpExporter(self.metrics, 0)
+        exporter.start()
+        try:
+            response, content = httplib2.Http().request('http://127.0.0.1:{}/metrics'.format(exporter.port))
+            missing, _ = httplib2.Http().request('http://127.0.0.1:{}/other'.format(exporter.port))
+        finally:
+            exporter.stop()
+        self.assertEqual(int(response.status), 200)
+        self.assertIn('gmailtool_request_retries_total 1\n', content)
+        self.assertEqual(int(missing.status), 404)
+
+
+class TestStreamMetrics(unittest.TestCase):
+    """Testing a mail stream records each stage of reading"""
+
+    def setUp(self):
+        self.mailbox = fakegmail.SyntheticMailbox('a@example.adamandpaul.biz', 4, messages_per_history=2,
+                                                  message_size=fakegmail.lognormal_sizes(1024, sigma=0))
+        self.server = fakegmail.FakeGmailServer([self.mailbox]).start()
+        self.metrics = instrumentation.Metrics()
+        self.executor = retry.RequestExecutor(sleep=lambda seconds: None, metrics=self.metrics)
+        self.inbox = mailstream.GmailMailStream(httplib2.Http(), self.mailbox.address,
+                                                cursor=json.dumps({'last_history_id': self.mailbox.first_history_id}),
+                                                discovery_cache=self.server.discovery_cache(),
+                                                executor=self.executor,
+                                                fetcher=fetch.BatchFetcher(executor=self.executor),
+                                                metrics=self.metrics)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_read_should_record_calls_stages_bytes_and_lag(self):
+        self.inbox.read()
+        labels = {'mailbox': self.mailbox.address}
+        self.assertEqual(self.metrics.value(instrumentation.CURSOR_LAG, labels), 2)
+        self.assertEqual(self.metrics.value(instrumentation.API_REQUESTS, {'method': 'history.list'}), 1)
+        self.assertEqual(self.metrics.value(instrumentation.API_REQUESTS, {'method': 'messages.get'}), 2)
+        self.assertEqual(self.metrics.value(instrumentation.MESSAGES, labels), 2)
+        self.assertGreater(self.metrics.value(instrumentation.MESSAGE_BYTES, labels), 2 * 1024)
+        for stage in ['history_list', 'message_get', 'decode', 'parse']:
+            self.assertGreater(self.metrics.value(instrumentation.STAGE_SECONDS, {'stage': stage}), 0)
+
+        self.inbox.read()
+        self.assertIsNone(self.inbox.read())
+        self.assertEqual(self.metrics.value(instrumentation.CURSOR_LAG, labels), 0)
+
+    def test_retries_should_be_counted(self):
+        self.server.rate_limit_probability = 1.0
+        with self.assertRaises(mailstream.apiclient.errors.HttpError):
+            self.inbox.read()
+        self.assertEqual(self.metrics.value(instrumentation.RETRIES), 4)
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""Turning gmail api message resources into email messages
+"""
+
+import base64
+import email
+import email.message
+import email.parser
+import re
+
+
+# Matches the blank line separating the headers of a message from its body
+_HEADER_END = re.compile(r'\r?\n\r?\n')
+
+
+def decode_raw(raw):
+    """Decode the raw field of a message resource into the bytes of the message
+
+    Gmail encodes raw messages with the url safe base64 alphabet; the standard alphabet is
+    also accepted.
+
+    Args:
+        raw (str): The base64 encoded message
+
+    Returns:
+        str: The message bytes
+    """
+    return base64.urlsafe_b64decode(str(raw))
+
+
+def from_resource(resource, lazy=False):
+    """Create an email message from a message resource fetched in any format
+
+    Messages fetched in the raw format are parsed from their raw bytes. Messages fetched in
+    the full format are rebuilt from their payload, with attachment bodies left empty as
+    gmail does not include them. Messages fetched in the metadata format only have headers
+    and messages fetched in the minimal format have neither headers nor body.
+
+    Whatever the format, the message has the gmail attributes gmail_id, thread_id, label_ids,
+    snippet, size_estimate, history_id and internal_date, which are None when gmail did not
+    return them. internal_date is the time gmail received the message in milliseconds since the epoch.
+
+    Args:
+        resource (dict): The gmail api message resource
+        lazy (bool): Return a LazyMessage for raw messages instead of parsing them straight away
+
+    Returns:
+        email message or LazyMessage: The message
+    """
+    if 'raw' in resource:
+        message = from_raw(decode_raw(resource['raw']), lazy=lazy)
+    else:
+        message = _message_from_payload(resource.get('payload', {}))
+    set_gmail_attributes(message, resource)
+    return message
+
+
+def from_raw(raw, lazy=False):
+    """Create an email message from the decoded bytes of a raw message
+
+    Args:
+        raw (str): The message bytes
+        lazy (bool): Return a LazyMessage instead of parsing the message straight away
+
+    Returns:
+        email message or LazyMessage: The message, without the gmail attributes
+    """
+    if lazy:
+        return LazyMessage(raw)
+    return email.message_from_string(raw)
+
+
+def set_gmail_attributes(message, resource):
+    """Copy the gmail attributes of a message resource onto a message object
+
+    Args:
+        message (email message or LazyMessage): The message
+        resource (dict): The gmail api message resource the message was created from
+    """
+    message.gmail_id = resource.get('id')
+    message.thread_id = resource.get('threadId')
+    message.label_ids = resource.get('labelIds')
+    message.snippet = resource.get('snippet')
+    message.size_estimate = resource.get('sizeEstimate')
+    message.history_id = resource.get('historyId')
+    internal_date = resource.get('internalDate')
+    message.internal_date = int(internal_date) if internal_date is not None else None
+
+
+def _message_from_payload(payload):
+    """Build an email message from the payload of a message resource
+
+    Part bodies in the payload are already decoded from their transfer encoding, so the
+    Content-Transfer-Encoding header is dropped to keep get_payload(decode=True) working.
+
+    Args:
+        payload (dict): The payload of a full or metadata format message resource
+
+    Returns:
+        email message: The message
+    """
+    message = email.message.Message()
+    for header in payload.get('headers', []):
+        if header['name'].lower() != 'content-transfer-encoding':
+            message[header['name']] = header['value']
+    parts = payload.get('parts')
+    if parts:
+        for part in parts:
+            message.attach(_message_from_payload(part))
+    else:
+        data = payload.get('body', {}).get('data')
+        if data is not None:
+            message.set_payload(decode_raw(data))
+    return message
+
+
+class LazyMessage(object):
+    """An email message which is only parsed as far as it is used
+
+    Only the raw bytes are held until a header is accessed, at which point the header block
+    alone is parsed. The full MIME tree, including bodies and attachments, is built the first
+    time .message is accessed.
+
+    Attributes:
+        raw (str): The bytes of the message
+    """
+
+    def __init__(self, raw):
+        """Initialize a lazy message
+
+        Args:
+            raw (str): The bytes of the message
+        """
+        self.raw = raw
+        self._headers = None
+        self._message = None
+
+    @property
+    def headers(self):
+        """email message: The headers of the message without a body"""
+        if self._message is not None:
+            return self._message
+        if self._headers is None:
+            header_end = _HEADER_END.search(self.raw)
+            header_block = self.raw if header_end is None else self.raw[:header_end.end()]
+            self._headers = email.parser.HeaderParser().parsestr(header_block, headersonly=True)
+        return self._headers
+
+    @property
+    def message(self):
+        """email message: The fully parsed message"""
+        if self._message is None:
+            self._message = email.message_from_string(self.raw)
+            self._headers = None
+        return self._message
+
+    def __getitem__(self, name):
+        return self.headers[name]
+
+    def __contains__(self, name):
+        return name in self.headers
+
+    def get(self, name, failobj=None):
+        """Get a header value, see email.message.Message.get"""
+        return self.headers.get(name, failobj)
+
+    def get_all(self, name, failobj=None):
+        """Get all values of a header, see email.message.Message.get_all"""
+        return self.headers.get_all(name, failobj)
+
+    def keys(self):
+        """Get the header names, see email.message.Message.keys"""
+        return self.headers.keys()
+
+    def items(self):
+        """Get the header names and values, see email.message.Message.items"""
+        return self.headers.items()
+
+    def as_string(self):
+        """str: The bytes of the message exactly as they were received"""
+        return self.raw
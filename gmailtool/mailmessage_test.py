@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""Testing the mailmessage python module
+"""
+
+from gmailtool import mailmessage
+from gmailtool import mailstream
+from gmailtool.mailstream_test import generate_mock_message
+from gmailtool.mailstream_test import get_gmail_api_descovery_json
+
+import apiclient.http
+import base64
+import json
+import unittest
+
+
+MULTIPART_MESSAGE = 'From: sender@example.adamandpaul.biz\r\n' \
+                    'Subject: With attachment\r\n' \
+                    'Content-Type: multipart/mixed; boundary="part"\r\n' \
+                    '\r\n' \
+                    '--part\r\n' \
+                    'Content-Type: text/plain\r\n' \
+                    '\r\n' \
+                    'Hello\r\n' \
+                    '--part\r\n' \
+                    'Content-Type: application/octet-stream\r\n' \
+                    'Content-Disposition: attachment; filename="data.bin"\r\n' \
+                    '\r\n' \
+                    'Subject: not a header\r\n' \
+                    '--part--\r\n'
+
+
+class TestDecodeRaw(unittest.TestCase):
+    """Testing decoding the raw field of message resources"""
+
+    def test_url_safe_alphabet_should_be_decoded(self):
+        data = '\xfb\xff\xfe message'
+        self.assertEqual(mailmessage.decode_raw(base64.urlsafe_b64encode(data)), data)
+
+    def test_standard_alphabet_should_be_decoded(self):
+        data = '\xfb\xff\xfe message'
+        self.assertEqual(mailmessage.decode_raw(base64.encodestring(data)), data)
+
+
+class TestLazyMessage(unittest.TestCase):
+    """Testing headers are available without parsing the message body"""
+
+    def setUp(self):
+        self.message = mailmessage.LazyMessage(MULTIPART_MESSAGE)
+
+    def test_headers_should_be_parsed_without_parsing_the_body(self):
+        self.assertEqual(self.message['subject'], 'With attachment')
+        self.assertIn('from', self.message)
+        self.assertFalse(self.message.headers.is_multipart(), 'expected body not to be parsed')
+
+    def test_message_should_be_fully_parsed_on_access(self):
+        parts = self.message.message.get_payload()
+        self.assertEqual(len(parts), 2)
+        self.assertEqual(parts[1].get_filename(), 'data.bin')
+        self.assertEqual(self.message['subject'], 'With attachment')
+
+    def test_as_string_should_return_the_raw_bytes(self):
+        self.assertEqual(self.message.as_string(), MULTIPART_MESSAGE)
+
+
+class TestLazyRead(unittest.TestCase):
+    """Testing reading lazy messages from a GmailMailStream"""
+
+    def test_read_should_return_lazy_messages(self):
+        test_message = generate_mock_message('test1234')
+        http = apiclient.http.HttpMockSequence([
+            ({'status': '200'}, get_gmail_api_descovery_json()),
+            ({'status': '200'}, json.dumps({'history': [{'id': 2, 'messagesAdded': [{'message': test_message}]}]})),
+            ({'status': '200'}, json.dumps(test_message)),
+            ({'status': '403'}, 'Should never be requested'),
+        ])
+        inbox = mailstream.GmailMailStream(http,
+                                           'recipient@example.adamandpaul.biz',
+                                           cursor='{"last_history_id": 1}',
+                                           lazy=True)
+        message = inbox.read()[0]
+        self.assertIsInstance(message, mailmessage.LazyMessage)
+        self.assertEqual(message['subject'], 'test1234')
+        self.assertIn('Content of mock email test1234', message.raw)
+
+
+class TestFromResource(unittest.TestCase):
+    """Testing messages fetched in formats other than raw"""
+
+    def test_full_format_should_rebuild_message_from_payload(self):
+        resource = {
+            'id': 'test1234',
+            'threadId': 'thread1',
+            'labelIds': ['INBOX'],
+            'sizeEstimate': 512,
+            'payload': {
+                'mimeType': 'multipart/mixed',
+                'headers': [
+                    {'name': 'Subject', 'value': 'Full format'},
+                    {'name': 'Content-Type', 'value': 'multipart/mixed; boundary="part"'},
+                ],
+                'parts': [
+                    {
+                        'mimeType': 'text/plain',
+                        'headers': [
+                            {'name': 'Content-Type', 'value': 'text/plain'},
+                            {'name': 'Content-Transfer-Encoding', 'value': 'base64'},
+                        ],
+                        'body': {'data': base64.urlsafe_b64encode('Hello')},
+                    },
+                    {
+                        'mimeType': 'application/pdf',
+                        'filename': 'data.pdf',
+                        'headers': [{'name': 'Content-Type', 'value': 'application/pdf'}],
+                        'body': {'attachmentId': 'attachment1', 'size': 2048},
+                    },
+                ],
+            },
+        }
+        message = mailmessage.from_resource(resource)
+        self.assertEqual(message['subject'], 'Full format')
+        self.assertEqual(message.get_payload(0).get_payload(decode=True), 'Hello')
+        self.assertEqual(message.gmail_id, 'test1234')
+        self.assertEqual(message.thread_id, 'thread1')
+        self.assertEqual(message.label_ids, ['INBOX'])
+        self.assertEqual(message.size_estimate, 512)
+
+    def test_minimal_format_should_have_gmail_attributes_only(self):
+        message = mailmessage.from_resource({'id': 'test1234', 'labelIds': ['INBOX']})
+        self.assertEqual(message.keys(), [])
+        self.assertEqual(message.gmail_id, 'test1234')
+
+    def test_raw_format_should_have_gmail_attributes(self):
+        message = mailmessage.from_resource(generate_mock_message('test1234'), lazy=True)
+        self.assertEqual(message.gmail_id, 'test1234')
+        self.assertIsNone(message.thread_id)
+
+
+class RecordingHttpMockSequence(apiclient.http.HttpMockSequence):
+    """A HttpMockSequence which records the uri of each request"""
+
+    def __init__(self, iterable):
+        super(RecordingHttpMockSequence, self).__init__(iterable)
+        self.uris = []
+
+    def request(self, uri, *args, **kwargs):
+        self.uris.append(uri)
+        return super(RecordingHttpMockSequence, self).request(uri, *args, **kwargs)
+
+
+class TestMetadataRead(unittest.TestCase):
+    """Testing reading header only messages from a GmailMailStream"""
+
+    def test_read_should_request_metadata_format_with_header_whitelist(self):
+        test_message = {
+            'id': 'test1234',
+            'payload': {'headers': [{'name': 'Subject', 'value': 'test1234'}]},
+        }
+        http = RecordingHttpMockSequence([
+            ({'status': '200'}, get_gmail_api_descovery_json()),
+            ({'status': '200'}, json.dumps({'history': [{'id': 2, 'messagesAdded': [{'message': test_message}]}]})),
+            ({'status': '200'}, json.dumps(test_message)),
+            ({'status': '403'}, 'Should never be requested'),
+        ])
+        inbox = mailstream.GmailMailStream(http,
+                                           'recipient@example.adamandpaul.biz',
+                                           cursor='{"last_history_id": 1}',
+                                           message_format='metadata',
+                                           metadata_headers=['Subject'])
+        message = inbox.read()[0]
+        self.assertEqual(message['subject'], 'test1234')
+        self.assertIn('format=metadata', http.uris[-1])
+        self.assertIn('metadataHeaders=Subject', http.uris[-1])
@@ -2,38 +2,283 @@
 """The mailstream module
 """
 
+from gmailtool import backfill
+from gmailtool import changes
+from gmailtool import fetch
+from gmailtool import instrumentation
+from gmailtool import mailmessage
+from gmailtool import retry
+from gmailtool import seen
+from gmailtool import spool
+
 import apiclient
-import email
+import apiclient.errors
+import collections
+import functools
+import itertools
 import json
+import logging
+import Queue
+import threading
+import time
+
+
+logger = logging.getLogger('gmailtool.mailstream')
+
+# The largest page of history gmail will return from a single history list request
+HISTORY_PAGE_SIZE = 500
+
+# How far before the time an expired cursor was last read the recovery backfill starts, in
+# seconds, allowing for messages whose date is earlier than when they arrived
+EXPIRED_CURSOR_MARGIN = 24 * 60 * 60
+
+# The number of messages downloaded at a time when recovering from an expired cursor
+EXPIRED_CURSOR_CHUNK_SIZE = fetch.BATCH_SIZE_LIMIT
+
+# The number of recently read message ids a stream remembers by default
+SEEN_WINDOW_SIZE = 100
+
+
+class CursorExpiredError(Exception):
+    """Raised when gmail no longer has the history after a cursor, which happens after about a week
+
+    Attributes:
+        mailbox (str): The mailbox the cursor belongs to
+        history_id (int): The expired history id
+    """
+
+    def __init__(self, mailbox, history_id):
+        super(CursorExpiredError, self).__init__('History after {} has expired for {}'.format(history_id, mailbox))
+        self.mailbox = mailbox
+        self.history_id = history_id
+
+
+def parse_resource(resource, lazy=False, spool_directory=None, metrics=instrumentation.NULL_METRICS):
+    """Turn a message resource into a message
+
+    This is a module level function so it can be run in a process pool, see GmailMailStream.parser.
+
+    Args:
+        resource (dict): The gmail api message resource
+        lazy (bool): Return a LazyMessage for raw messages, see mailmessage.from_resource
+        spool_directory (str): Write the attachments of raw messages to files in this directory
+        metrics (Metrics): Records the time spent decoding and parsing
+
+    Returns:
+        email message or LazyMessage: The message
+    """
+    if spool_directory is not None and 'raw' in resource:
+        with metrics.timer(instrumentation.STAGE_SECONDS, {'stage': 'parse'}):
+            message = spool.spool_message(resource['raw'], spool_directory, prefix=resource.get('id', 'attachment'))
+        mailmessage.set_gmail_attributes(message, resource)
+        return message
+    if not metrics.enabled:
+        return mailmessage.from_resource(resource, lazy=lazy)
+    if 'raw' not in resource:
+        with metrics.timer(instrumentation.STAGE_SECONDS, {'stage': 'parse'}):
+            return mailmessage.from_resource(resource, lazy=lazy)
+    with metrics.timer(instrumentation.STAGE_SECONDS, {'stage': 'decode'}):
+        raw = mailmessage.decode_raw(resource['raw'])
+    with metrics.timer(instrumentation.STAGE_SECONDS, {'stage': 'parse'}):
+        message = mailmessage.from_raw(raw, lazy=lazy)
+    mailmessage.set_gmail_attributes(message, resource)
+    return message
+
+
+def resource_bytes(resource):
+    """The encoded size of the message content in a message resource, roughly the bytes gmail sent
+
+    Args:
+        resource (dict): The gmail api message resource
+
+    Returns:
+        int: The length of the raw message, or of the headers and body data of the payload
+    """
+    if 'raw' in resource:
+        return len(resource['raw'])
+    size = 0
+    parts = [resource.get('payload', {})]
+    while len(parts) > 0:
+        part = parts.pop()
+        size += sum(len(header['name']) + len(header['value']) for header in part.get('headers', []))
+        size += len(part.get('body', {}).get('data', ''))
+        parts.extend(part.get('parts', []))
+    return size
 
 
 class GmailMailStream(object):
     """Present the Gmail API as a mail stream which can be sequentially accessed by .read()
     """
 
-    def __init__(self, http, mailbox, cursor=None):
+    def __init__(self,
+                 http,
+                 mailbox,
+                 cursor=None,
+                 fetcher=None,
+                 cache=None,
+                 lazy=False,
+                 message_format='raw',
+                 metadata_headers=None,
+                 spool_directory=None,
+                 discovery_cache=None,
+                 executor=None,
+                 recover_expired_cursor=True,
+                 index=None,
+                 seen_window=SEEN_WINDOW_SIZE,
+                 metrics=None,
+                 clock=time.time):
         """Initialize a Gmail mail stream object
 
         Args:
             http (http): An oauthed http object from the google oauth system
             mailbox (str): The mailbox to read (e.g. example@gmail.com)
             cursor (str): The cursor data to load the current position in the inbox
+            fetcher (object): The strategy used to fetch message bodies (e.g. fetch.BatchFetcher).
+                Defaults to fetching one message per request
+            cache (MessageCache): A cache consulted before fetching message bodies from gmail
+            lazy (bool): Return LazyMessage objects which hold the raw message bytes and only parse
+                as much of the message as is used, instead of fully parsed email messages
+            message_format (str): The format to fetch messages in: raw, full, metadata or minimal.
+                Formats other than raw transfer less data but return messages without some or
+                all of their content, see mailmessage.from_resource
+            metadata_headers (list of str): The only headers to fetch with the metadata format
+            spool_directory (str): Write the attachments of raw messages to files in this directory
+                while parsing, see spool.spool_message
+            discovery_cache (DiscoveryCache): Builds the gmail api service object from a cached discovery
+                document instead of fetching the document
+            executor (RequestExecutor): Executes gmail api requests within a quota budget, retrying
+                rate limit and server errors. The default fetcher uses it too. Defaults to retrying
+                without a quota budget
+            recover_expired_cursor (bool): When the history after the cursor has expired, backfill the
+                messages since the cursor was last read instead of raising CursorExpiredError
+            index (MessageIndex): Record the headers of every message read in a local search index
+            seen_window (int): The number of recently read message ids remembered in the cursor. A
+                message added again in a later history, or in a history read again after a restart,
+                is neither downloaded nor returned again while it is remembered. 0 to disable
+            metrics (Metrics): Records api calls, the time spent in each stage of reading, the messages
+                and bytes fetched and the cursor lag, see instrumentation. Defaults to recording nothing
+            clock (callable): Returns the current time in seconds
         """
-        self._api = apiclient.discovery.build('gmail', 'v1', http=http)
+        self._discovery_cache = discovery_cache
+        self._api = self._build_api(http)
         self._mailbox = mailbox
+        self._executor = executor or retry.RequestExecutor()
+        self._fetcher = fetcher or fetch.SerialFetcher(executor=self._executor)
+        self._cache = cache
+        self._lazy = lazy
+        assert message_format in fetch.MESSAGE_FORMATS, 'unknown message format: ' + message_format
+        self._message_format = message_format
+        self._metadata_headers = metadata_headers
+        self._spool_directory = spool_directory
+        self._recover_expired_cursor = recover_expired_cursor
+        self._index = index
+        self._metrics = metrics or instrumentation.NULL_METRICS
+        self._clock = clock
+        # Message ids already delivered by a backfill, skipped in history up to _skip_until_history_id
+        self._skip_ids = set()
+        self._skip_until_history_id = None
+        # The messages still to be recovered after an expired cursor, see _recover_expired_history
+        self._recovery = None
+        self._seen = seen.SeenWindow(seen_window) if seen_window > 0 else None
+        # The (history id, time) of the latest history listing which reached the head of the mailbox
+        self._listed_head = None
+        # The checked time before the cursor last moved, restored if acknowledge moves the cursor back
+        self._checked_time_before_move = None
 
         if cursor is None:
-            profile = self._api.users().getProfile(userId=mailbox).execute()
-            self._cursor_last_history_id = int(profile['historyId'])
+            self._cursor_checked_time = self._clock()
+            self._cursor_last_history_id = self._get_profile_history_id()
         else:
             cursor_dict = json.loads(cursor)
             self._cursor_last_history_id = cursor_dict['last_history_id']
+            self._cursor_checked_time = cursor_dict.get('checked_time')
+            if self._seen is not None:
+                for message_id in cursor_dict.get('seen', []):
+                    self._seen.add(message_id, self._cursor_last_history_id)
 
     @property
     def cursor(self):
         """str: JSON representation of the inbox cursor"""
-        cursor_data = json.dumps({'last_history_id': self._cursor_last_history_id})
-        return cursor_data
+        cursor_dict = {'last_history_id': self._cursor_last_history_id,
+                       'checked_time': self._cursor_checked_time}
+        if self._seen is not None:
+            # Only ids up to the cursor, a restored stream must still return the messages after it
+            cursor_dict['seen'] = self._seen.ids_up_to(self._cursor_last_history_id)
+        return json.dumps(cursor_dict)
+
+    @property
+    def history_id(self):
+        """int: The last history read, where the cursor is"""
+        return self._cursor_last_history_id
+
+    @property
+    def parser(self):
+        """callable: Turns a message resource into a message the way the stream does. It can be
+        pickled, so resources can be parsed in a process pool"""
+        return functools.partial(parse_resource, lazy=self._lazy, spool_directory=self._spool_directory)
+
+    def read_resources_after(self, history_id, max_histories=None):
+        """Read the message resources of the histories after a history without parsing them
+
+        The cursor is not moved, call acknowledge once the messages of a history have been handled.
+        This is the fetch stage of a pipeline.Pipeline.
+
+        Args:
+            history_id (int): The history to read after
+            max_histories (int): The maximum number of histories to read. None reads
+                all histories up to the latest history.
+
+        Returns:
+            List of (int, list of dict): A list of history id and message resource pairs in
+            history order, empty if there is no history after history_id
+        """
+        return self._read_histories_after(history_id, max_histories, parse=False)
+
+    def index_messages(self, messages):
+        """Record messages parsed outside the stream in the stream's index, if it has one
+
+        Args:
+            messages (list of email message): The messages
+        """
+        if self._index is not None:
+            for message in messages:
+                self._index.add(self._mailbox, message)
+            self._index.flush()
+
+    def acknowledge(self, history_id):
+        """Move the cursor past a history whose messages have been handled
+
+        Args:
+            history_id (int): The history
+        """
+        if history_id < self._cursor_last_history_id:
+            self._cursor_checked_time = self._checked_time_before_move
+        self._move_cursor(history_id)
+
+    def watch(self, topic_name, label_ids=None):
+        """Ask gmail to publish a notification to a Cloud Pub/Sub topic whenever the mailbox changes
+
+        The watch expires after about a week, call watch again at least daily to renew it.
+
+        Args:
+            topic_name (str): The topic, e.g. projects/my-project/topics/gmail. Gmail must be allowed
+                to publish to it
+            label_ids (list of str): Only notify of changes to messages with these labels. None for
+                every change
+
+        Returns:
+            dict: The watch response holding the current historyId of the mailbox and the
+            expiration of the watch in milliseconds since the epoch
+        """
+        body = {'topicName': topic_name}
+        if label_ids is not None:
+            body['labelIds'] = label_ids
+            body['labelFilterAction'] = 'include'
+        return self._executor.execute(self._api.users().watch(userId=self._mailbox, body=body))
+
+    def stop_watch(self):
+        """Stop the notifications asked for by watch"""
+        self._executor.execute(self._api.users().stop(userId=self._mailbox))
 
     def read(self):
         """Read a bunch of messages from gmail.
@@ -51,25 +296,653 @@ class GmailMailStream(object):
             List of email message or None: A list of email messasges in the next page of history.
             Returns None if we are already at the latest history and can not read any more
         """
-
-        history_list = self._api.users().history().list(userId=self._mailbox,
-                                                        historyTypes='messageAdded',
-                                                        maxResults=1,
-                                                        startHistoryId=self._cursor_last_history_id).execute()
-        histories = history_list.get('history', [])
+        histories = self._read_histories_after(self._cursor_last_history_id, max_histories=1, record_progress=True)
         if len(histories) > 0:
-            next_history = histories[0]
-            next_history_id = int(next_history['id'])
-            messages = []
-            for message_info in next_history.get('messagesAdded', []):
-                message_id = message_info['message']['id']
-                message_info_raw = self._api.users().messages().get(userId=self._mailbox,
-                                                                    id=message_id,
-                                                                    format='raw').execute()
-                message_raw = message_info_raw['raw'].decode('base64')
-                message = email.message_from_string(message_raw)
-                messages.append(message)
-            self._cursor_last_history_id = next_history_id
+            next_history_id, messages = histories[0]
+            self._move_cursor(next_history_id)
             return messages
         else:
+            self._move_cursor(self._cursor_last_history_id)
+            return None
+
+    def read_many(self, max_histories=None):
+        """Read messages from many histories at once.
+
+        Full pages of history are requested from gmail and ``nextPageToken`` is followed
+        until ``max_histories`` histories have been read or the latest history is reached.
+        The cursor is only advanced once every message of every returned history has been
+        fetched, so an error part way through leaves the cursor where it was.
+
+        Args:
+            max_histories (int): The maximum number of histories to read. None reads
+                all histories up to the latest history.
+
+        Returns:
+            List of (int, list of email message) or None: A list of history id and email message
+            pairs in history order. Returns None if we are already at the latest history and can
+            not read any more
+        """
+        histories = self._read_histories_after(self._cursor_last_history_id, max_histories, record_progress=True)
+        if len(histories) > 0:
+            self._move_cursor(histories[-1][0])
+            return histories
+        else:
+            self._move_cursor(self._cursor_last_history_id)
+            return None
+
+    def read_changes(self, max_histories=None, fetch_messages=True):
+        """Read every kind of change to the mailbox: added and deleted messages and added and removed labels
+
+        Only added messages are downloaded. Label changes and deletions are described by the history
+        list alone, and messages which are deleted again within the histories read are not
+        downloaded at all. Messages deleted in a later history, before they could be downloaded,
+        are left out of the added messages.
+
+        If the history after the cursor has expired and recovery is enabled, the messages which
+        arrived since the cursor was last read are returned as added messages, a chunk per call.
+        Deletions and label changes made in the expired history are not recovered.
+
+        Args:
+            max_histories (int): The maximum number of histories to read. None reads all histories
+                up to the latest history.
+            fetch_messages (bool): Download added messages. False returns only their ids and labels
+
+        Returns:
+            list of ChangeEvent or None: The changes in history order. Returns None if we are already
+            at the latest history and can not read any more
+        """
+        try:
+            if self._recovering(self._cursor_last_history_id):
+                raise CursorExpiredError(self._mailbox, self._cursor_last_history_id)
+            histories = self._list_histories(self._cursor_last_history_id, max_histories, changes.HISTORY_TYPES)
+        except CursorExpiredError:
+            [(history_id, messages)] = self._recover_expired_history(self._cursor_last_history_id,
+                                                                     record_progress=True)
+            self._move_cursor(history_id)
+            return [changes.ChangeEvent(history_id, changes.MESSAGE_ADDED, message.gmail_id, message.thread_id,
+                                        message.label_ids, message)
+                    for message in messages]
+        if len(histories) == 0:
+            self._move_cursor(self._cursor_last_history_id)
             return None
+
+        self._forget_seen_after(self._cursor_last_history_id)
+        events = []
+        added_ids = set()
+        for history in histories:
+            history_events = changes.events_from_history(history)
+            message_ids = [event.message_id for event in history_events if event.change_type == changes.MESSAGE_ADDED]
+            kept_ids = set(self._unseen(self._skip_backfilled(int(history['id']), message_ids))) - added_ids
+            for event in history_events:
+                if event.change_type == changes.MESSAGE_ADDED:
+                    if event.message_id not in kept_ids:
+                        continue
+                    kept_ids.discard(event.message_id)
+                    added_ids.add(event.message_id)
+                events.append(event)
+        added = [event for event in events if event.change_type == changes.MESSAGE_ADDED]
+        if fetch_messages:
+            deleted_ids = set(event.message_id for event in events if event.change_type == changes.MESSAGE_DELETED)
+            fetched = [event for event in added if event.message_id not in deleted_ids]
+            resources = self._fetch_existing_messages([event.message_id for event in fetched])
+            # A message deleted in a later history than those read no longer exists to download
+            gone_ids = set(event.message_id for event in fetched if event.message_id not in resources)
+            events = [event for event in events if event.message_id not in gone_ids or
+                      event.change_type != changes.MESSAGE_ADDED]
+            fetched = [event for event in fetched if event.message_id not in gone_ids]
+            messages = self._parse_resources([resources[event.message_id] for event in fetched])
+            self._flush_index()
+            for event, message in zip(fetched, messages):
+                event.message = message
+        for event in added:
+            self._remember_seen(event.history_id, [event.message_id])
+        self._move_cursor(int(histories[-1]['id']))
+        return events
+
+    def iter_messages(self, follow=False, poll_interval=10.0, prefetch_histories=10):
+        """Iterate over messages one at a time as they are added to the mailbox.
+
+        A background thread reads the next histories while the caller processes the current
+        ones, so downloading and processing overlap. The cursor is advanced past a history
+        only once the caller asks for the message after the history's last message, so the
+        cursor may be saved between any two messages and, when restored, will not skip a
+        message which was yielded but not yet processed.
+
+        Do not call the other read methods of the stream while iterating.
+
+        Args:
+            follow (bool): Keep waiting for new messages once the latest history is reached
+                instead of stopping
+            poll_interval (float): The number of seconds between checks for new history when following
+            prefetch_histories (int): The maximum number of histories read ahead of the caller
+
+        Yields:
+            (int, email message): The history id and message of each added message in history order
+        """
+        pages = Queue.Queue(maxsize=1)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def produce():
+            history_id = self._cursor_last_history_id
+            try:
+                while not stop.is_set():
+                    histories = self._read_histories_after(history_id, prefetch_histories)
+                    if len(histories) > 0:
+                        history_id = histories[-1][0]
+                        if not put((histories, None)):
+                            return
+                    elif follow:
+                        stop.wait(poll_interval)
+                    else:
+                        put((None, None))
+                        return
+            except Exception as exception:  # noqa: B902 the error is re-raised in the iterating thread
+                put((None, exception))
+
+        producer = threading.Thread(target=produce, name='gmailtool-prefetch-' + self._mailbox)
+        producer.daemon = True
+        producer.start()
+        try:
+            while True:
+                histories, exception = pages.get()
+                if exception is not None:
+                    raise exception
+                if histories is None:
+                    return
+                for history_id, messages in histories:
+                    for message in messages:
+                        yield history_id, message
+                    self._move_cursor(history_id)
+        finally:
+            stop.set()
+            producer.join()
+
+    def backfill(self, query=None, after=None, before=None, shards=1, http_factory=None, concurrency=4,
+                 chunk_size=fetch.BATCH_SIZE_LIMIT, skip_ids=None):
+        """Read the messages already in the mailbox, then continue from the history the backfill started at
+
+        Message ids are listed with users.messages.list, optionally split into date shards which
+        are listed in parallel, and downloaded a chunk at a time while listing continues. Each
+        message is returned once even if it is listed more than once.
+
+        The history id of the mailbox is taken before listing starts and the cursor is moved to
+        it once every message has been yielded, so reading on from the cursor returns mail which
+        arrived during the backfill. Messages the backfill already returned are skipped when
+        they turn up in that history. If iteration stops early the cursor is left where it was.
+
+        Args:
+            query (str): A gmail search query limiting the messages read (e.g. "label:inbox"). None
+                reads every message
+            after (float): Only read messages from this time on, in seconds since the epoch
+            before (float): Only read messages from before this time, in seconds since the epoch
+            shards (int): The number of date shards to split the time range into
+            http_factory (callable): Called with no arguments to create an oauthed http object for each
+                thread listing shards. Without one shards are listed one after the other
+            concurrency (int): The number of shards listed at once when there is a http_factory
+            chunk_size (int): The number of messages downloaded at a time
+            skip_ids (set of str): The ids of messages an interrupted backfill already returned.
+                They are not downloaded again, and are skipped in the history after the backfill too
+
+        Yields:
+            list of email message: The messages a chunk at a time
+        """
+        start_time = self._clock()
+        start_history_id = self._get_profile_history_id()
+        seen = set(skip_ids or ())
+        for messages in self._iter_backfill_chunks(seen, query, after, before, shards, http_factory, concurrency,
+                                                   chunk_size):
+            yield messages
+        self._finish_backfill(seen)
+        self._cursor_last_history_id = start_history_id
+        self._cursor_checked_time = start_time
+
+    def _iter_backfill_chunks(self, seen, query, after, before, shards, http_factory, concurrency, chunk_size):
+        """Download the listed messages a chunk at a time, see backfill
+
+        Args:
+            seen (set): The ids of the messages already yielded, updated as messages are yielded
+
+        Yields:
+            list of email message: The messages a chunk at a time
+        """
+        if http_factory is None:
+            lister = backfill.MessageLister(self._mailbox, lambda: self._api, executor=self._executor)
+        else:
+            lister = backfill.MessageLister(self._mailbox,
+                                            lambda: self._build_api(http_factory()),
+                                            executor=self._executor,
+                                            concurrency=concurrency)
+        chunk = []
+        for message_ids in lister.iter_pages(query, after, before, shards):
+            for message_id in message_ids:
+                if message_id not in seen:
+                    seen.add(message_id)
+                    chunk.append(message_id)
+            while len(chunk) >= chunk_size:
+                messages = self._parse_resources(self._fetch_messages(chunk[:chunk_size]))
+                self._flush_index()
+                yield messages
+                chunk = chunk[chunk_size:]
+        if len(chunk) > 0:
+            messages = self._parse_resources(self._fetch_messages(chunk))
+            self._flush_index()
+            yield messages
+
+    def _finish_backfill(self, seen):
+        """Skip the backfilled messages when they turn up in the history added during the backfill
+
+        Args:
+            seen (set): The ids of the backfilled messages
+        """
+        self._skip_ids = seen
+        self._skip_until_history_id = self._get_profile_history_id()
+
+    def _recovering(self, start_history_id):
+        """bool: Whether the messages since an expired history are part way through being recovered"""
+        return self._recovery is not None and self._recovery.start_history_id == start_history_id
+
+    def _recover_expired_history(self, start_history_id, parse=True, record_progress=False):
+        """Backfill the messages which arrived since an expired cursor was last read, a chunk at a time
+
+        The ids of the messages since the cursor was last read are listed once, then each call
+        downloads the next chunk of them, oldest first, leaving out the messages read recently.
+        Until the last chunk the chunks are
+        returned under the expired history id, so the cursor stays put and the next read carries
+        on with the recovery. The last chunk is returned under the history id the recovery
+        started at.
+
+        Args:
+            start_history_id (int): The expired history id
+            parse (bool): Return messages rather than message resources
+            record_progress (bool): The caller handles the messages before reading again, so the
+                checked time of the cursor is moved past each chunk. A cursor saved part way
+                through then resumes the recovery from about that chunk
+
+        Returns:
+            List of (int, list of email message): A single pseudo history holding the next chunk of
+            backfilled messages
+
+        Raises:
+            CursorExpiredError: Recovery is disabled or the time the cursor was read is unknown
+        """
+        recovery = self._recovery
+        if not self._recovering(start_history_id):
+            if not self._recover_expired_cursor or self._cursor_checked_time is None:
+                raise CursorExpiredError(self._mailbox, start_history_id)
+            after = self._cursor_checked_time - EXPIRED_CURSOR_MARGIN
+            logger.warning('History after {} has expired for {}, backfilling messages since {}'.format(
+                start_history_id, self._mailbox, time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(after))))
+            start_time = self._clock()
+            backfill_history_id = self._get_profile_history_id()
+            lister = backfill.MessageLister(self._mailbox, lambda: self._api, executor=self._executor)
+            message_ids = []
+            listed = set()
+            for page in lister.iter_pages(after=after):
+                message_ids.extend(message_id for message_id in page if message_id not in listed)
+                listed.update(page)
+            # Messages are listed newest first and recovered oldest first
+            message_ids.reverse()
+            recovery = self._recovery = _ExpiredCursorRecovery(start_history_id, backfill_history_id, start_time,
+                                                               message_ids)
+
+        chunk = list(itertools.islice(recovery.remaining, EXPIRED_CURSOR_CHUNK_SIZE))
+        message_ids = self._unseen(chunk)
+        resources = self._fetch_existing_messages(message_ids)
+        messages = [resources[message_id] for message_id in message_ids if message_id in resources]
+        # Only dropped once downloaded, so a failed chunk is downloaded again by the next read
+        for _ in chunk:
+            recovery.remaining.popleft()
+        # Remembered under the history the cursor is saved at once the caller has handled them
+        self._remember_seen(start_history_id if record_progress else recovery.backfill_history_id, message_ids)
+        if len(recovery.remaining) == 0:
+            self._recovery = None
+            self._finish_backfill(recovery.message_ids)
+            self._cursor_checked_time = recovery.start_time
+            history_id = recovery.backfill_history_id
+        else:
+            logger.info('Recovered {} of {} messages since the expired cursor of {}'.format(
+                len(recovery.message_ids) - len(recovery.remaining), len(recovery.message_ids), self._mailbox))
+            if record_progress:
+                received_times = [int(resource['internalDate']) / 1000.0
+                                  for resource in messages if 'internalDate' in resource]
+                if len(received_times) > 0:
+                    self._cursor_checked_time = min(max(received_times), recovery.start_time)
+            history_id = start_history_id
+        if parse:
+            messages = self._parse_resources(messages)
+            self._flush_index()
+        return [(history_id, messages)]
+
+    def _get_profile_history_id(self):
+        """int: The latest history id of the mailbox"""
+        self._metrics.increment(instrumentation.API_REQUESTS, labels={'method': 'getProfile'})
+        profile = self._executor.execute(self._api.users().getProfile(userId=self._mailbox))
+        return int(profile['historyId'])
+
+    def _build_api(self, http):
+        """Build a gmail api service object like the one the stream uses for another http object"""
+        if self._discovery_cache is not None:
+            return self._discovery_cache.build(http)
+        return apiclient.discovery.build('gmail', 'v1', http=http)
+
+    def _read_histories_after(self, start_history_id, max_histories=None, parse=True, record_progress=False):
+        """Read the histories after a history without moving the cursor
+
+        If the history has expired and recovery is enabled, the messages which arrived since the
+        cursor was last read are backfilled and returned a chunk at a time as single histories
+        instead, see _recover_expired_history.
+
+        Args:
+            start_history_id (int): The history to read after
+            max_histories (int): The maximum number of histories to read. None reads
+                all histories up to the latest history.
+            parse (bool): Return messages rather than message resources
+            record_progress (bool): The caller handles the returned messages before reading again
+
+        Returns:
+            List of (int, list of email message): A list of history id and email message
+            pairs in history order, empty if there is no history after start_history_id
+        """
+        try:
+            if self._recovering(start_history_id):
+                raise CursorExpiredError(self._mailbox, start_history_id)
+            histories = self._list_histories(start_history_id, max_histories, 'messageAdded')
+        except CursorExpiredError:
+            return self._recover_expired_history(start_history_id, parse, record_progress)
+        self._forget_seen_after(start_history_id)
+        if not parse:
+            return [(int(history['id']), self._fetch_history_resources(history)) for history in histories]
+        result = [(int(history['id']), self._parse_resources(self._fetch_history_resources(history)))
+                  for history in histories]
+        self._flush_index()
+        return result
+
+    def _move_cursor(self, history_id):
+        """Move the cursor to a history
+
+        The checked time only moves forward once the cursor reaches the head of the mailbox as last
+        listed, as every message received before the listing is then behind the cursor.
+
+        Args:
+            history_id (int): The history
+        """
+        self._checked_time_before_move = self._cursor_checked_time
+        self._cursor_last_history_id = history_id
+        listed_head = self._listed_head
+        if listed_head is not None and history_id >= listed_head[0]:
+            listed_time = listed_head[1]
+            if self._cursor_checked_time is None or listed_time > self._cursor_checked_time:
+                self._cursor_checked_time = listed_time
+
+    def _list_histories(self, start_history_id, max_histories, history_types):
+        """List the history records after a history
+
+        A listing which reaches the latest history is remembered, see _move_cursor.
+
+        Args:
+            start_history_id (int): The history to list after
+            max_histories (int): The maximum number of histories to list. None lists all histories
+                up to the latest history.
+            history_types (str or list of str): The history types to list, see changes.HISTORY_TYPES
+
+        Returns:
+            list of dict: The history records in history order
+
+        Raises:
+            CursorExpiredError: Gmail no longer has the history after start_history_id
+        """
+        histories = []
+        page_token = None
+        while max_histories is None or len(histories) < max_histories:
+            page_size = HISTORY_PAGE_SIZE
+            if max_histories is not None:
+                page_size = min(page_size, max_histories - len(histories))
+            request = self._api.users().history().list(userId=self._mailbox,
+                                                       historyTypes=history_types,
+                                                       maxResults=page_size,
+                                                       pageToken=page_token,
+                                                       startHistoryId=start_history_id)
+            self._metrics.increment(instrumentation.API_REQUESTS, labels={'method': 'history.list'})
+            try:
+                with self._metrics.timer(instrumentation.STAGE_SECONDS, {'stage': 'history_list'}):
+                    history_list = self._executor.execute(request)
+            except apiclient.errors.HttpError as error:
+                if int(error.resp.status) != 404:
+                    raise
+                raise CursorExpiredError(self._mailbox, start_history_id)
+            listed_time = self._clock()
+            if page_token is None and 'historyId' in history_list:
+                self._metrics.set_gauge(instrumentation.CURSOR_LAG,
+                                        int(history_list['historyId']) - int(start_history_id),
+                                        {'mailbox': self._mailbox})
+            histories.extend(history_list.get('history', []))
+            page_token = history_list.get('nextPageToken')
+            if page_token is None:
+                if max_histories is None or len(histories) <= max_histories:
+                    head_history_id = int(histories[-1]['id']) if len(histories) > 0 else int(start_history_id)
+                    self._listed_head = (head_history_id, listed_time)
+                break
+        if max_histories is not None:
+            histories = histories[:max_histories]
+        return histories
+
+    def _flush_index(self):
+        """Write the messages added to the index since the last flush"""
+        if self._index is not None:
+            self._index.flush()
+
+    def _fetch_history_resources(self, history):
+        """Fetch the resources of the messages added in a history record
+
+        Messages deleted again before they could be downloaded are left out.
+
+        Args:
+            history (dict): A history record from the gmail history list
+
+        Returns:
+            List of dict: The message resources of the messages added in the history
+        """
+        history_id = int(history['id'])
+        message_ids = [message_info['message']['id'] for message_info in history.get('messagesAdded', [])]
+        message_ids = self._unseen(self._skip_backfilled(history_id, message_ids))
+        resources = self._fetch_existing_messages(message_ids)
+        self._remember_seen(history_id, message_ids)
+        return [resources[message_id] for message_id in message_ids if message_id in resources]
+
+    def _unseen(self, message_ids):
+        """Remove the recently read messages, and repeats, from the messages added in a history
+
+        Args:
+            message_ids (list of str): The ids of the added messages
+
+        Returns:
+            list of str: The ids of the messages not read recently, each once
+        """
+        if self._seen is None:
+            return message_ids
+        unseen = []
+        kept = set()
+        for message_id in message_ids:
+            if message_id not in kept and message_id not in self._seen:
+                kept.add(message_id)
+                unseen.append(message_id)
+        return unseen
+
+    def _remember_seen(self, history_id, message_ids):
+        """Remember messages once they have been read in a history"""
+        if self._seen is not None:
+            for message_id in message_ids:
+                self._seen.add(message_id, history_id)
+
+    def _forget_seen_after(self, history_id):
+        """Forget messages remembered by an earlier read of the histories after a history which
+        failed part way through, so reading them again returns them"""
+        if self._seen is not None:
+            self._seen.discard_after(history_id)
+
+    def _skip_backfilled(self, history_id, message_ids):
+        """Remove the messages a backfill already returned from the messages added in a history
+
+        Args:
+            history_id (int): The history the messages were added in
+            message_ids (list of str): The ids of the added messages
+
+        Returns:
+            list of str: The ids of the messages the backfill did not return
+        """
+        if len(self._skip_ids) == 0:
+            return message_ids
+        if history_id > self._skip_until_history_id:
+            self._skip_ids = set()
+            return message_ids
+        return [message_id for message_id in message_ids if message_id not in self._skip_ids]
+
+    def _parse_resources(self, message_infos):
+        """Parse message resources, adding the messages to the index
+
+        Args:
+            message_infos (list of dict): The message resources. Each is replaced by None
+                once it is parsed, so it can be freed
+
+        Returns:
+            List of email message: The messages
+        """
+        parser = self.parser
+        if self._metrics.enabled:
+            parser = functools.partial(parser, metrics=self._metrics)
+        messages = []
+        for index, message_info_raw in enumerate(message_infos):
+            message = parser(message_info_raw)
+            if self._index is not None:
+                self._index.add(self._mailbox, message)
+            messages.append(message)
+            # Let the encoded message be freed as soon as it has been parsed
+            message_infos[index] = None
+        return messages
+
+    def _fetch_messages(self, message_ids):
+        """Fetch raw message resources, using the cache when there is one
+
+        Args:
+            message_ids (list of str): The ids of the messages to fetch
+
+        Returns:
+            list of dict: The gmail api message resources in the same order as message_ids
+        """
+        if self._cache is None:
+            return self._fetch_from_gmail(message_ids)
+
+        cached = {}
+        for message_id in message_ids:
+            message_info_raw = self._cache.get(self._cache_key(message_id))
+            if message_info_raw is not None:
+                cached[message_id] = message_info_raw
+        missing_ids = fetch.unique([message_id for message_id in message_ids if message_id not in cached])
+        if len(missing_ids) > 0:
+            fetched = self._fetch_from_gmail(missing_ids)
+            for message_id, message_info_raw in zip(missing_ids, fetched):
+                self._cache.put(self._cache_key(message_id), message_info_raw)
+                cached[message_id] = message_info_raw
+        return [cached[message_id] for message_id in message_ids]
+
+    def _fetch_existing_messages(self, message_ids):
+        """Fetch message resources, leaving out the messages gmail no longer has
+
+        Args:
+            message_ids (list of str): The ids of the messages to fetch
+
+        Returns:
+            dict: The gmail api message resources of the messages which still exist, by message id
+        """
+        if len(message_ids) == 0:
+            return {}
+        try:
+            return dict(zip(message_ids, self._fetch_messages(message_ids)))
+        except fetch.FetchError as error:
+            if not all(_is_not_found(failure) for failure in error.failures.values()):
+                raise
+            gone_ids = set(error.failures)
+        except apiclient.errors.HttpError as error:
+            if not _is_not_found(error):
+                raise
+            if len(message_ids) > 1:
+                # The error does not say which message is gone, so each is fetched on its own
+                resources = {}
+                for message_id in message_ids:
+                    resources.update(self._fetch_existing_messages([message_id]))
+                return resources
+            gone_ids = set(message_ids)
+        logger.info('Skipping {} messages deleted from {} before they were downloaded'.format(
+            len(gone_ids), self._mailbox))
+        return self._fetch_existing_messages([message_id for message_id in message_ids if message_id not in gone_ids])
+
+    def _fetch_from_gmail(self, message_ids):
+        """Fetch message resources with the fetcher, recording metrics
+
+        Args:
+            message_ids (list of str): The ids of the messages to fetch
+
+        Returns:
+            list of dict: The gmail api message resources in the same order as message_ids
+        """
+        if not self._metrics.enabled or len(message_ids) == 0:
+            return self._fetcher.fetch(self._api, self._mailbox, message_ids,
+                                       self._message_format, self._metadata_headers)
+        self._metrics.increment(instrumentation.API_REQUESTS, len(message_ids), {'method': 'messages.get'})
+        with self._metrics.timer(instrumentation.STAGE_SECONDS, {'stage': 'message_get'}):
+            resources = self._fetcher.fetch(self._api, self._mailbox, message_ids,
+                                            self._message_format, self._metadata_headers)
+        labels = {'mailbox': self._mailbox}
+        self._metrics.increment(instrumentation.MESSAGES, len(resources), labels)
+        self._metrics.increment(instrumentation.MESSAGE_BYTES, sum(resource_bytes(resource) for resource in resources),
+                                labels)
+        return resources
+
+    def _cache_key(self, message_id):
+        """The key a message is cached under, distinguishing the formats messages are fetched in
+
+        Args:
+            message_id (str): The gmail message id
+
+        Returns:
+            str: The cache key
+        """
+        if self._message_format == 'raw':
+            return message_id
+        key = message_id + '.' + self._message_format
+        if self._message_format == 'metadata' and self._metadata_headers is not None:
+            key += '.' + '.'.join(sorted(header.lower() for header in self._metadata_headers))
+        return key
+
+
+def _is_not_found(error):
+    """bool: Whether a request failed because the message no longer exists"""
+    return isinstance(error, apiclient.errors.HttpError) and int(error.resp.status) == 404
+
+
+class _ExpiredCursorRecovery(object):
+    """The progress of recovering the messages since an expired cursor
+
+    Attributes:
+        start_history_id (int): The expired history id
+        backfill_history_id (int): The latest history id when the recovery started
+        start_time (float): The time the recovery started
+        message_ids (set of str): The ids of every message being recovered
+        remaining (deque of str): The ids of the messages not recovered yet, oldest first
+    """
+
+    def __init__(self, start_history_id, backfill_history_id, start_time, message_ids):
+        self.start_history_id = start_history_id
+        self.backfill_history_id = backfill_history_id
+        self.start_time = start_time
+        self.message_ids = set(message_ids)
+        self.remaining = collections.deque(message_ids)
@@ -4,6 +4,7 @@
 
 from gmailtool import mailstream
 
+import apiclient.errors
 import apiclient.http
 import json
 import os
@@ -66,7 +67,8 @@ class TestInitializing(unittest.TestCase):
             ({'status': '403'}, 'Should never be requested'),
         ])
         inbox = mailstream.GmailMailStream(http, 'email@example.adamandpaul.biz')
-        self.assertIn('12345', inbox.cursor, 'expected history id of 12345 to be contained in cursor value')
+        self.assertEqual(json.loads(inbox.cursor)['last_history_id'], 12345,
+                         'expected history id of 12345 to be contained in cursor value')
 
     def test_new_stream_should_init_with_pre_saved_history_id(self):
         http = apiclient.http.HttpMockSequence([
@@ -74,7 +76,8 @@ class TestInitializing(unittest.TestCase):
             ({'status': '403'}, 'Should never be requested'),
         ])
         inbox = mailstream.GmailMailStream(http, 'email@example.adamandpaul.biz', cursor='{"last_history_id":7474}')
-        self.assertIn('7474', inbox.cursor, 'expected history id of 7474 not contained in cursor value')
+        self.assertEqual(json.loads(inbox.cursor)['last_history_id'], 7474,
+                         'expected history id of 7474 not contained in cursor value')
 
 
 class TestNewEmailInInbox(unittest.TestCase):
@@ -112,7 +115,7 @@ class TestNewEmailInInbox(unittest.TestCase):
         self.assertEqual(len(messages), 1, 'expected exactly one email')
         message = messages[0]
         self.assertEqual(message['subject'], self.test_message_id, 'expected email with subject ' + self.test_message_id)
-        self.assertIn('2', inbox.cursor, 'expected cursor to incriment to 2')
+        self.assertEqual(json.loads(inbox.cursor)['last_history_id'], 2, 'expected cursor to incriment to 2')
 
 
 class TestNoNewEmail(unittest.TestCase):
@@ -140,7 +143,7 @@ class TestNoNewEmail(unittest.TestCase):
         inbox = self.inbox
         messages = inbox.read()
         self.assertIsNone(messages, 'No more messages in inbox, read should return None')
-        self.assertIn('1', inbox.cursor, 'Expected cursor to remain at 1')
+        self.assertEqual(json.loads(inbox.cursor)['last_history_id'], 1, 'Expected cursor to remain at 1')
 
 
 class TestMultipleEmailsInSingleHistory(unittest.TestCase):
@@ -188,4 +191,176 @@ class TestMultipleEmailsInSingleHistory(unittest.TestCase):
         self.assertEqual(message_2['subject'],
                          self.test_message_2_id,
                          'expected email with subject ' + self.test_message_2_id)
-        self.assertIn('2', inbox.cursor, 'expected cursor to incriment to 2')
+        self.assertEqual(json.loads(inbox.cursor)['last_history_id'], 2, 'expected cursor to incriment to 2')
+
+
+class TestReadManyHistories(unittest.TestCase):
+    """Testing reading many histories across pages of history with read_many()
+    """
+
+    def setUp(self):
+        self.test_message_1 = generate_mock_message('test1234')
+        self.test_message_2 = generate_mock_message('test5432')
+        self.test_message_3 = generate_mock_message('test9876')
+        http = apiclient.http.HttpMockSequence([
+            ({'status': '200'}, get_gmail_api_descovery_json()),
+            (
+                {'status': '200'},
+                json.dumps({
+                    'history': [
+                        {'id': 2, 'messagesAdded': [{'message': self.test_message_1},
+                                                    {'message': self.test_message_2}]},
+                        {'id': 3},
+                    ],
+                    'nextPageToken': 'page2',
+                })
+            ),
+            (
+                {'status': '200'},
+                json.dumps({
+                    'history': [
+                        {'id': 4, 'messagesAdded': [{'message': self.test_message_3}]},
+                    ],
+                })
+            ),
+            ({'status': '200'}, json.dumps(self.test_message_1)),
+            ({'status': '200'}, json.dumps(self.test_message_2)),
+            ({'status': '200'}, json.dumps(self.test_message_3)),
+            ({'status': '403'}, 'Should never be requested'),
+        ])
+        self.inbox = mailstream.GmailMailStream(http,
+                                                'recipient@example.adamandpaul.biz',
+                                                cursor='{"last_history_id": 1}')
+
+    def test_read_many_should_follow_pages_and_group_messages_by_history(self):
+        inbox = self.inbox
+        histories = inbox.read_many()
+        self.assertEqual([history_id for history_id, messages in histories], [2, 3, 4])
+        self.assertEqual([message['subject'] for message in histories[0][1]], ['test1234', 'test5432'])
+        self.assertEqual(histories[1][1], [], 'expected history without added messages to be empty')
+        self.assertEqual([message['subject'] for message in histories[2][1]], ['test9876'])
+        self.assertEqual(json.loads(inbox.cursor)['last_history_id'], 4, 'expected cursor to incriment to 4')
+
+
+class TestReadManyLimitedHistories(unittest.TestCase):
+    """Testing read_many() stops after max_histories and returns None at the latest history
+    """
+
+    def setUp(self):
+        self.test_message = generate_mock_message('test1234')
+        http = apiclient.http.HttpMockSequence([
+            ({'status': '200'}, get_gmail_api_descovery_json()),
+            (
+                {'status': '200'},
+                json.dumps({
+                    'history': [
+                        {'id': 2, 'messagesAdded': [{'message': self.test_message}]},
+                    ],
+                    'nextPageToken': 'page2',
+                })
+            ),
+            ({'status': '200'}, json.dumps(self.test_message)),
+            ({'status': '200'}, json.dumps({'history': []})),
+            ({'status': '403'}, 'Should never be requested'),
+        ])
+        self.inbox = mailstream.GmailMailStream(http,
+                                                'recipient@example.adamandpaul.biz',
+                                                cursor='{"last_history_id": 1}')
+
+    def test_read_many_should_stop_at_max_histories(self):
+        inbox = self.inbox
+        histories = inbox.read_many(max_histories=1)
+        self.assertEqual(len(histories), 1, 'expected exactly one history')
+        self.assertEqual(json.loads(inbox.cursor)['last_history_id'], 2, 'expected cursor to incriment to 2')
+        self.assertIsNone(inbox.read_many(), 'No more histories, read_many should return None')
+        self.assertEqual(json.loads(inbox.cursor)['last_history_id'], 2, 'Expected cursor to remain at 2')
+
+
+class TestDeletedBeforeDownload(unittest.TestCase):
+    """Testing messages deleted before they could be downloaded do not stop the stream
+    """
+
+    def setUp(self):
+        self.test_message = generate_mock_message('test1234')
+        http = apiclient.http.HttpMockSequence([
+            ({'status': '200'}, get_gmail_api_descovery_json()),
+            (
+                {'status': '200'},
+                json.dumps({
+                    'history': [
+                        {'id': 2, 'messagesAdded': [{'message': {'id': 'draft1'}}]},
+                        {'id': 3, 'messagesAdded': [{'message': self.test_message}]},
+                    ],
+                })
+            ),
+            ({'status': '404'}, '{"error": {"code": 404}}'),
+            ({'status': '200'}, json.dumps(self.test_message)),
+            ({'status': '403'}, 'Should never be requested'),
+        ])
+        self.inbox = mailstream.GmailMailStream(http,
+                                                'recipient@example.adamandpaul.biz',
+                                                cursor='{"last_history_id": 1}')
+
+    def test_read_many_should_skip_messages_which_are_not_found(self):
+        histories = self.inbox.read_many()
+        self.assertEqual([(history_id, [message['subject'] for message in messages])
+                          for history_id, messages in histories], [(2, []), (3, ['test1234'])])
+        self.assertEqual(json.loads(self.inbox.cursor)['last_history_id'], 3, 'expected cursor to incriment to 3')
+
+
+class TestIterMessages(unittest.TestCase):
+    """Testing iterating over messages one at a time with iter_messages()
+    """
+
+    def create_inbox(self, responses):
+        http = apiclient.http.HttpMockSequence([
+            ({'status': '200'}, get_gmail_api_descovery_json()),
+        ] + responses + [
+            ({'status': '403'}, 'Should never be requested'),
+        ])
+        return mailstream.GmailMailStream(http,
+                                          'recipient@example.adamandpaul.biz',
+                                          cursor='{"last_history_id": 1}')
+
+    def test_cursor_should_only_advance_after_a_history_is_consumed(self):
+        test_message_1 = generate_mock_message('test1234')
+        test_message_2 = generate_mock_message('test5432')
+        inbox = self.create_inbox([
+            (
+                {'status': '200'},
+                json.dumps({
+                    'history': [
+                        {'id': 2, 'messagesAdded': [{'message': test_message_1}, {'message': test_message_2}]},
+                        {'id': 3},
+                    ]
+                })
+            ),
+            ({'status': '200'}, json.dumps(test_message_1)),
+            ({'status': '200'}, json.dumps(test_message_2)),
+            ({'status': '200'}, json.dumps({'history': []})),
+        ])
+        seen = []
+        for history_id, message in inbox.iter_messages():
+            seen.append((history_id, message['subject'], json.loads(inbox.cursor)['last_history_id']))
+        self.assertEqual(seen, [(2, 'test1234', 1), (2, 'test5432', 1)])
+        self.assertEqual(json.loads(inbox.cursor)['last_history_id'], 3)
+
+    def test_follow_should_wait_for_new_history(self):
+        test_message = generate_mock_message('test1234')
+        inbox = self.create_inbox([
+            ({'status': '200'}, json.dumps({'history': []})),
+            ({'status': '200'}, json.dumps({'history': [{'id': 2, 'messagesAdded': [{'message': test_message}]}]})),
+            ({'status': '200'}, json.dumps(test_message)),
+        ])
+        messages = inbox.iter_messages(follow=True, poll_interval=0, prefetch_histories=1)
+        history_id, message = next(messages)
+        messages.close()
+        self.assertEqual((history_id, message['subject']), (2, 'test1234'))
+
+    def test_errors_should_be_raised_to_the_caller(self):
+        inbox = self.create_inbox([
+            ({'status': '400'}, '{"error": {"code": 400}}'),
+        ])
+        with self.assertRaises(apiclient.errors.HttpError):
+            list(inbox.iter_messages())
+        self.assertEqual(json.loads(inbox.cursor)['last_history_id'], 1, 'Expected cursor to remain at 1')
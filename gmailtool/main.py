@@ -2,8 +2,8 @@
 """Main entry point for gmailtool"""
 
 import argparse
-import gmailtool.argument_parser
-import gmailtool.auth
+import functools
+import importlib
 import logging
 import os
 import sys
@@ -11,18 +11,69 @@ import sys
 
 logger = logging.getLogger('gmailtool')
 
+# The sub commands as (name, help, module, register function name). A sub command's module is
+# only imported when the sub command is run, keeping the google client libraries out of
+# invocations like --help, so the help listing the sub commands is kept here rather than in
+# their modules.
+SUB_COMMANDS = [
+    ('auth', 'Authenticate and save credentials for future invocations of gmailtool', 'gmailtool.auth',
+     'cmd_auth_register'),
+    ('follow', 'Follow new mail arriving in one or more mailboxes', 'gmailtool.follow', 'cmd_follow_register'),
+    ('export', 'Export a mailbox to an mbox file or Maildir', 'gmailtool.export', 'cmd_export_register'),
+    ('search', 'Search the headers of indexed messages without contacting gmail', 'gmailtool.search',
+     'cmd_search_register'),
+]
+
 
 def register_sub_commands(parsers, environ):
     """Register sub commands
 
-    This function calls the register commands fucntion associated with
-    each sub command.
+    This function registers a lazy placeholder for each sub command in SUB_COMMANDS.
 
     Args:
         parsers (Arguement Parsers Object): Object to use to add parsers for commands
         environ (dict): The environment dictionary
     """
-    gmailtool.auth.cmd_auth_register(parsers, environ)
+    for name, help_text, module_name, register_name in SUB_COMMANDS:
+        register_lazy_sub_command(parsers, environ, name, help_text, module_name, register_name)
+
+
+def register_lazy_sub_command(parsers, environ, name, help_text, module_name, register_name):
+    """Register a placeholder parser for a sub command whose module is imported only when it runs
+
+    The placeholder accepts any arguments. Once the sub command has been chosen, main calls
+    load_sub_command which imports the module, registers the real parser of the sub command
+    with the module's register function and parses the sub command's arguments with it.
+
+    Args:
+        parsers (Arguement Parsers Object): Object to use to add parsers for commands
+        environ (dict): The environment dictionary
+        name (str): The name of the sub command
+        help_text (str): The help shown for the sub command in the list of sub commands
+        module_name (str): The module implementing the sub command
+        register_name (str): The name of the register function in the module
+    """
+    parser = parsers.add_parser(name, help=help_text, add_help=False)
+    parser.set_defaults(load_sub_command=functools.partial(load_sub_command, environ, name, module_name, register_name))
+
+
+def load_sub_command(environ, name, module_name, register_name, args, sub_command_argv):
+    """Import a lazily registered sub command and parse its arguments into args
+
+    Args:
+        environ (dict): The environment dictionary
+        name (str): The name of the sub command
+        module_name (str): The module implementing the sub command
+        register_name (str): The name of the register function in the module
+        args (Namespace): The application args, updated with the sub command's args
+        sub_command_argv (list of str): The arguments following the sub command
+    """
+    logger.debug('Loading sub command {} from {}'.format(name, module_name))
+    module = importlib.import_module(module_name)
+    parser = argparse.ArgumentParser(prog=args.executable_name)
+    sub_parsers = parser.add_subparsers(title='command')
+    getattr(module, register_name)(sub_parsers, environ)
+    parser.parse_args([name] + sub_command_argv, namespace=args)
 
 
 def configure_logging(verbosity):
@@ -88,8 +139,12 @@ def main(argv=None, environ=None, callback_register_sub_commands=None):
     sub_parsers = parser.add_subparsers(title='command', help='gmailtool subcommands')
     callback_register_sub_commands(sub_parsers, environ)
 
-    # Parse
-    parser.parse_args(argv[1:], namespace=args)
+    # Parse, loading the sub command to parse its own arguments if it was registered lazily
+    args, sub_command_argv = parser.parse_known_args(argv[1:], namespace=args)
+    if getattr(args, 'load_sub_command', None) is not None:
+        args.load_sub_command(args, sub_command_argv)
+    elif len(sub_command_argv) > 0:
+        parser.error('unrecognized arguments: ' + ' '.join(sub_command_argv))
 
     # Run Initialization Code
     configure_logging(args.verbose)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""Testing the main python module
+"""
+
+from gmailtool import main
+
+import argparse
+import importlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+
+# Modules which are slow to import and must only be imported by the sub commands which use them
+HEAVY_MODULES = ['apiclient', 'googleapiclient', 'httplib2', 'oauth2client']
+
+IMPORTED_MODULES_SCRIPT = """
+import json
+import sys
+from gmailtool import main
+try:
+    main.main(sys.argv[1:])
+except SystemExit:
+    pass
+sys.stdout.write('\\n' + json.dumps(sorted(sys.modules)))
+"""
+
+called_args = []
+
+
+def cmd_fake(args):
+    called_args.append(args)
+
+
+def cmd_fake_register(parsers, environ):
+    parser = parsers.add_parser('fake')
+    parser.add_argument('values', nargs='*')
+    parser.add_argument('--option', default=environ.get('FAKE_OPTION'))
+    parser.set_defaults(func=cmd_fake)
+
+
+class TestImportTime(unittest.TestCase):
+    """Testing the cli does not import the google client libraries until a sub command needs them
+
+    Each check runs in a new interpreter so modules imported by other tests do not count.
+    """
+
+    def imported_modules(self, argv):
+        profile_dir = tempfile.mkdtemp()
+        try:
+            output = subprocess.check_output([sys.executable, '-c', IMPORTED_MODULES_SCRIPT, 'gmailtool'] + argv,
+                                             env=dict(os.environ, PROFILE_DIR=profile_dir),
+                                             stderr=open(os.devnull, 'w'))
+        finally:
+            shutil.rmtree(profile_dir)
+        return set(module_name.split('.')[0] for module_name in json.loads(output.splitlines()[-1]))
+
+    def test_importing_main_should_not_import_heavy_modules(self):
+        imported = self.imported_modules([])
+        self.assertEqual(imported.intersection(HEAVY_MODULES), set())
+
+    def test_help_should_not_import_heavy_modules(self):
+        imported = self.imported_modules(['--help'])
+        self.assertEqual(imported.intersection(HEAVY_MODULES), set())
+
+    def test_sub_command_should_import_its_modules(self):
+        imported = self.imported_modules(['follow', '--help'])
+        self.assertIn('apiclient', imported)
+
+
+class TestLazySubCommand(unittest.TestCase):
+    """Testing lazily registered sub commands parse their own arguments"""
+
+    def setUp(self):
+        self.profile_dir = tempfile.mkdtemp()
+        del called_args[:]
+
+    def tearDown(self):
+        shutil.rmtree(self.profile_dir)
+
+    def register_sub_commands(self, parsers, environ):
+        main.register_lazy_sub_command(parsers, environ, 'fake', 'A fake command', 'gmailtool.main_test',
+                                       'cmd_fake_register')
+
+    def test_sub_command_should_receive_its_arguments(self):
+        main.main(['gmailtool', '--profile-dir', self.profile_dir, 'fake', 'a', 'c', '--option', 'b'],
+                  environ={'FAKE_OPTION': 'default'},
+                  callback_register_sub_commands=self.register_sub_commands)
+        args = called_args[0]
+        self.assertEqual(args.values, ['a', 'c'])
+        self.assertEqual(args.option, 'b')
+        self.assertEqual(args.profile_dir, self.profile_dir)
+
+    def test_sub_command_should_receive_the_environment(self):
+        main.main(['gmailtool', '--profile-dir', self.profile_dir, 'fake'],
+                  environ={'FAKE_OPTION': 'default'},
+                  callback_register_sub_commands=self.register_sub_commands)
+        self.assertEqual(called_args[0].option, 'default')
+
+    def test_unknown_arguments_should_be_rejected_by_the_sub_command(self):
+        with self.assertRaises(SystemExit):
+            main.main(['gmailtool', '--profile-dir', self.profile_dir, 'fake', '--unknown'],
+                      environ={},
+                      callback_register_sub_commands=self.register_sub_commands)
+        self.assertEqual(called_args, [])
+
+
+class TestSubCommands(unittest.TestCase):
+    """Testing every sub command module can be registered"""
+
+    def test_sub_commands_should_register(self):
+        parser = argparse.ArgumentParser()
+        sub_parsers = parser.add_subparsers()
+        for name, _, module_name, register_name in main.SUB_COMMANDS:
+            module = importlib.import_module(module_name)
+            getattr(module, register_name)(sub_parsers, {})
+            self.assertIn(name, sub_parsers.choices)
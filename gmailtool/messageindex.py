@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""A local SQLite full text index of message headers
+"""
+
+import email.errors
+import email.header
+import logging
+import sqlite3
+import threading
+
+
+logger = logging.getLogger('gmailtool.messageindex')
+
+# The headers recorded in the index
+INDEX_HEADERS = ['Message-ID', 'Date', 'From', 'To', 'Cc', 'Subject']
+
+# The columns of the full text table. Search queries can be limited to a column, e.g. "sender:alice"
+TEXT_COLUMNS = ['sender', 'recipients', 'subject', 'snippet', 'labels']
+
+_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS messages ('
+    ' id INTEGER PRIMARY KEY,'
+    ' mailbox TEXT NOT NULL,'
+    ' gmail_id TEXT NOT NULL,'
+    ' thread_id TEXT,'
+    ' history_id INTEGER,'
+    ' internal_date INTEGER,'
+    ' size_estimate INTEGER,'
+    ' label_ids TEXT,'
+    ' message_id TEXT,'
+    ' date TEXT,'
+    ' sender TEXT,'
+    ' recipients TEXT,'
+    ' subject TEXT,'
+    ' snippet TEXT,'
+    ' UNIQUE (mailbox, gmail_id))',
+    'CREATE INDEX IF NOT EXISTS messages_internal_date ON messages (internal_date)',
+]
+
+_ROW_COLUMNS = ['mailbox', 'gmail_id', 'thread_id', 'history_id', 'internal_date', 'size_estimate', 'label_ids',
+                'message_id', 'date', 'sender', 'recipients', 'subject', 'snippet']
+
+
+def full_text_module(connection):
+    """The best full text search module the sqlite library supports
+
+    Args:
+        connection (Connection): A sqlite connection
+
+    Returns:
+        str: fts5, or fts4 where fts5 is not compiled in
+    """
+    for module in ('fts5', 'fts4'):
+        try:
+            connection.execute('CREATE VIRTUAL TABLE temp.fts_probe USING {}(text)'.format(module))
+        except sqlite3.OperationalError:
+            continue
+        connection.execute('DROP TABLE temp.fts_probe')
+        return module
+    raise sqlite3.NotSupportedError('sqlite has neither fts5 nor fts4')
+
+
+def decode_header(value):
+    """Decode a header value into unicode, undoing any RFC 2047 encoded words
+
+    Args:
+        value (str): The header value
+
+    Returns:
+        unicode or None: The decoded value, None if value is None
+    """
+    if value is None:
+        return None
+    if isinstance(value, unicode):
+        return value
+    try:
+        parts = email.header.decode_header(value)
+    except email.errors.HeaderParseError:
+        parts = [(value, None)]
+    decoded = []
+    for part, charset in parts:
+        try:
+            decoded.append(part.decode(charset or 'utf-8', 'replace'))
+        except LookupError:
+            decoded.append(part.decode('utf-8', 'replace'))
+    return u' '.join(decoded)
+
+
+def message_row(mailbox, message):
+    """The index row of a message
+
+    Args:
+        mailbox (str): The mailbox the message belongs to
+        message (email message or LazyMessage): A message with gmail attributes
+
+    Returns:
+        dict: The row keyed by column
+    """
+    recipients = [decode_header(value) for value in (message.get_all('to', []) + message.get_all('cc', []))]
+    return {
+        'mailbox': mailbox,
+        'gmail_id': message.gmail_id,
+        'thread_id': message.thread_id,
+        'history_id': int(message.history_id) if message.history_id is not None else None,
+        'internal_date': getattr(message, 'internal_date', None),
+        'size_estimate': message.size_estimate,
+        'label_ids': u' '.join(message.label_ids or []),
+        'message_id': decode_header(message.get('message-id')),
+        'date': decode_header(message.get('date')),
+        'sender': decode_header(message.get('from')),
+        'recipients': u', '.join(recipients),
+        'subject': decode_header(message.get('subject')),
+        'snippet': message.snippet,
+    }
+
+
+class MessageIndex(object):
+    """A sqlite database of message headers with a full text index
+
+    Messages are added in batches, each batch in a single transaction. Adding a message already
+    in the index replaces it. The index may be used from any thread.
+    """
+
+    def __init__(self, path, batch_size=500):
+        """Initialize a message index, creating the database if it does not exist
+
+        Args:
+            path (str): The sqlite database file
+            batch_size (int): The number of messages added in each transaction
+        """
+        self._batch_size = batch_size
+        self._pending = []
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        with self._connection:
+            for statement in _SCHEMA:
+                self._connection.execute(statement)
+            if not self._table_exists('messages_text'):
+                module = full_text_module(self._connection)
+                logger.debug('Creating message index using ' + module)
+                self._connection.execute('CREATE VIRTUAL TABLE messages_text USING {}({})'.format(
+                    module, ', '.join(TEXT_COLUMNS)))
+
+    def add(self, mailbox, message):
+        """Add a message, writing the pending batch if it is full
+
+        Args:
+            mailbox (str): The mailbox the message belongs to
+            message (email message or LazyMessage): A message with gmail attributes
+        """
+        row = message_row(mailbox, message)
+        with self._lock:
+            self._pending.append(row)
+            if len(self._pending) >= self._batch_size:
+                self._write_pending()
+
+    def flush(self):
+        """Write the pending messages"""
+        with self._lock:
+            self._write_pending()
+
+    def close(self):
+        """Write the pending messages and close the database"""
+        self.flush()
+        self._connection.close()
+
+    def search(self, query=None, mailbox=None, label=None, after=None, before=None, limit=50):
+        """Find messages, newest first
+
+        Args:
+            query (str): A full text query, see the sqlite fts documentation. Terms can be limited
+                to a column of TEXT_COLUMNS, e.g. "sender:alice subject:invoice". None matches every message
+            mailbox (str): Only find messages in this mailbox
+            label (str): Only find messages with this label id
+            after (float): Only find messages received from this time on, in seconds since the epoch
+            before (float): Only find messages received before this time, in seconds since the epoch
+            limit (int): The maximum number of messages to return
+
+        Returns:
+            list of dict: The matching rows keyed by column
+        """
+        conditions = []
+        parameters = []
+        if query:
+            conditions.append('messages.id IN (SELECT rowid FROM messages_text WHERE messages_text MATCH ?)')
+            parameters.append(query)
+        if mailbox is not None:
+            conditions.append('messages.mailbox = ?')
+            parameters.append(mailbox)
+        if label is not None:
+            conditions.append("instr(' ' || messages.label_ids || ' ', ?) > 0")
+            parameters.append(' ' + label + ' ')
+        if after is not None:
+            conditions.append('messages.internal_date >= ?')
+            parameters.append(int(after * 1000))
+        if before is not None:
+            conditions.append('messages.internal_date < ?')
+            parameters.append(int(before * 1000))
+        sql = 'SELECT {} FROM messages'.format(', '.join(_ROW_COLUMNS))
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY messages.internal_date DESC LIMIT ?'
+        parameters.append(limit)
+        with self._lock:
+            return [dict(zip(row.keys(), row)) for row in self._connection.execute(sql, parameters)]
+
+    def _table_exists(self, name):
+        """Whether a table exists in the database"""
+        cursor = self._connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,))
+        return cursor.fetchone() is not None
+
+    def _write_pending(self):
+        """Write the pending messages in one transaction. Must be called with the lock held"""
+        if len(self._pending) == 0:
+            return
+        insert_row = 'INSERT INTO messages ({}) VALUES ({})'.format(', '.join(_ROW_COLUMNS),
+                                                                    ', '.join('?' * len(_ROW_COLUMNS)))
+        insert_text = 'INSERT INTO messages_text (rowid, {}) VALUES (?, {})'.format(
+            ', '.join(TEXT_COLUMNS), ', '.join('?' * len(TEXT_COLUMNS)))
+        with self._connection:
+            for row in self._pending:
+                existing = self._connection.execute('SELECT id FROM messages WHERE mailbox = ? AND gmail_id = ?',
+                                                    (row['mailbox'], row['gmail_id'])).fetchone()
+                if existing is not None:
+                    self._connection.execute('DELETE FROM messages WHERE id = ?', (existing[0],))
+                    self._connection.execute('DELETE FROM messages_text WHERE rowid = ?', (existing[0],))
+                row_id = self._connection.execute(insert_row, [row[column] for column in _ROW_COLUMNS]).lastrowid
+                text = dict(row, labels=row['label_ids'])
+                self._connection.execute(insert_text, [row_id] + [text[column] for column in TEXT_COLUMNS])
+        logger.debug('Indexed {} messages'.format(len(self._pending)))
+        self._pending = []
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""Testing the messageindex python module
+"""
+
+from gmailtool import mailmessage
+from gmailtool import mailstream
+from gmailtool import messageindex
+from gmailtool.mailstream_test import generate_mock_message
+from gmailtool.mailstream_test import get_gmail_api_descovery_json
+
+import apiclient.http
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+
+def make_resource(message_id, sender, subject, label_ids=('INBOX',), internal_date=0):
+    return {
+        'id': message_id,
+        'threadId': 'thread-' + message_id,
+        'historyId': '7',
+        'labelIds': list(label_ids),
+        'snippet': 'Snippet of ' + message_id,
+        'sizeEstimate': 1024,
+        'internalDate': str(internal_date),
+        'payload': {'headers': [
+            {'name': 'From', 'value': sender},
+            {'name': 'To', 'value': 'recipient@example.adamandpaul.biz'},
+            {'name': 'Subject', 'value': subject},
+        ]},
+    }
+
+
+class TestMessageIndex(unittest.TestCase):
+    """Testing messages are indexed in batches and found by search"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'message-index.sqlite')
+        self.index = messageindex.MessageIndex(self.path, batch_size=2)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.directory)
+
+    def add(self, *args, **kwargs):
+        self.index.add('recipient@example.adamandpaul.biz', mailmessage.from_resource(make_resource(*args, **kwargs)))
+
+    def test_messages_should_be_written_in_batches(self):
+        self.add('m1', 'alice@example.com', 'Hello')
+        self.assertEqual(self.index.search(), [])
+        self.add('m2', 'bob@example.com', 'Hello')
+        self.assertEqual(len(self.index.search()), 2)
+
+    def test_search_should_match_fields(self):
+        self.add('m1', 'Alice <alice@example.com>', 'Invoice for March', internal_date=1000)
+        self.add('m2', 'Bob <bob@example.com>', 'Invoice for April', internal_date=2000)
+        self.add('m3', 'Alice <alice@example.com>', 'Lunch', label_ids=['INBOX', 'UNREAD'], internal_date=3000)
+        self.index.flush()
+        self.assertEqual([row['gmail_id'] for row in self.index.search('invoice')], ['m2', 'm1'])
+        self.assertEqual([row['gmail_id'] for row in self.index.search('sender:alice')], ['m3', 'm1'])
+        self.assertEqual([row['gmail_id'] for row in self.index.search('sender:alice subject:invoice')], ['m1'])
+        self.assertEqual([row['gmail_id'] for row in self.index.search(label='UNREAD')], ['m3'])
+        self.assertEqual([row['gmail_id'] for row in self.index.search(after=2, before=3)], ['m2'])
+
+    def test_rows_should_record_gmail_attributes(self):
+        self.add('m1', 'alice@example.com', 'Hello', internal_date=1000)
+        self.index.flush()
+        row = self.index.search()[0]
+        self.assertEqual(row['thread_id'], 'thread-m1')
+        self.assertEqual(row['history_id'], 7)
+        self.assertEqual(row['size_estimate'], 1024)
+        self.assertEqual(row['label_ids'], 'INBOX')
+        self.assertEqual(row['recipients'], 'recipient@example.adamandpaul.biz')
+
+    def test_adding_a_message_again_should_replace_it(self):
+        self.add('m1', 'alice@example.com', 'Before')
+        self.add('m1', 'alice@example.com', 'After')
+        self.index.flush()
+        self.assertEqual([row['subject'] for row in self.index.search()], ['After'])
+        self.assertEqual(self.index.search('before'), [])
+
+    def test_encoded_headers_should_be_decoded(self):
+        self.add('m1', 'alice@example.com', '=?utf-8?q?Caf=C3=A9?=')
+        self.index.flush()
+        self.assertEqual(self.index.search(u'café')[0]['subject'], u'Café')
+
+
+class TestStreamIndex(unittest.TestCase):
+    """Testing the mail stream records the messages it reads in an index"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.index = messageindex.MessageIndex(os.path.join(self.directory, 'message-index.sqlite'))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.directory)
+
+    def test_read_messages_should_be_indexed(self):
+        test_message = generate_mock_message('test1234')
+        http = apiclient.http.HttpMockSequence([
+            ({'status': '200'}, get_gmail_api_descovery_json()),
+            ({'status': '200'}, json.dumps({'history': [{'id': 2, 'messagesAdded': [{'message': test_message}]}]})),
+            ({'status': '200'}, json.dumps(test_message)),
+            ({'status': '400'}, 'Should never be requested'),
+        ])
+        inbox = mailstream.GmailMailStream(http,
+                                           'recipient@example.adamandpaul.biz',
+                                           cursor='{"last_history_id": 1}',
+                                           index=self.index)
+        inbox.read()
+        self.assertEqual([row['subject'] for row in self.index.search('subject:test1234')], ['test1234'])
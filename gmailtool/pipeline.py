@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""Run the fetch, parse and sink stages of a mail stream concurrently
+"""
+
+import logging
+import multiprocessing
+import Queue
+import threading
+
+
+logger = logging.getLogger('gmailtool.pipeline')
+
+# Marks the end of the items passed between stages
+_END = object()
+
+
+class Pipeline(object):
+    """Fetch, parse and handle the messages of a mail stream in separate stages
+
+    The fetch stage reads message resources, the parse stage turns them into messages and the
+    sink stage hands each history to the sink. Stages are connected by bounded queues, so a slow
+    stage holds back the stages before it instead of letting unhandled messages pile up in
+    memory. Parsing is CPU bound and can be spread over a pool of processes.
+
+    The fetch and parse stages run in background threads and the sink runs in the thread
+    calling run. The stream cursor is only moved past a history once the sink has returned
+    for it, so the cursor never gets ahead of the messages which have been handled.
+    """
+
+    def __init__(self,
+                 stream,
+                 sink,
+                 parse_processes=0,
+                 queue_size=2,
+                 histories_per_fetch=10,
+                 on_acknowledge=None):
+        """Initialize a pipeline
+
+        Args:
+            stream (GmailMailStream): The stream to read
+            sink (callable): Called as sink(history_id, messages) for each history in history order
+            parse_processes (int): The number of processes messages are parsed in. 0 parses them in
+                the parse stage thread
+            queue_size (int): The number of fetched or parsed batches of histories which may wait
+                for the next stage
+            histories_per_fetch (int): The maximum number of histories read by each fetch
+            on_acknowledge (callable): Called with the stream cursor each time it moves past a history
+        """
+        assert parse_processes >= 0, 'parse_processes must not be negative'
+        assert queue_size > 0, 'queue_size must be at least 1'
+        self._stream = stream
+        self._sink = sink
+        self._parse_processes = parse_processes
+        self._queue_size = queue_size
+        self._histories_per_fetch = histories_per_fetch
+        self._on_acknowledge = on_acknowledge
+
+    def run(self, follow=False, poll_interval=10.0):
+        """Run the pipeline
+
+        Args:
+            follow (bool): Keep waiting for new history once the latest history is reached
+                instead of returning
+            poll_interval (float): The number of seconds between checks for new history when following
+
+        Returns:
+            int: The number of histories handled
+
+        Raises:
+            Exception: The first error raised by any stage
+        """
+        fetched = Queue.Queue(maxsize=self._queue_size)
+        parsed = Queue.Queue(maxsize=self._queue_size)
+        stop = threading.Event()
+        pool = None
+        if self._parse_processes > 0:
+            pool = multiprocessing.Pool(self._parse_processes)
+
+        stages = [
+            threading.Thread(target=self._fetch_stage, args=(fetched, stop, follow, poll_interval),
+                             name='gmailtool-pipeline-fetch'),
+            threading.Thread(target=self._parse_stage, args=(fetched, parsed, stop, pool),
+                             name='gmailtool-pipeline-parse'),
+        ]
+        for stage in stages:
+            stage.daemon = True
+            stage.start()
+        try:
+            return self._sink_stage(parsed)
+        finally:
+            stop.set()
+            for stage in stages:
+                stage.join()
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    def _fetch_stage(self, fetched, stop, follow, poll_interval):
+        """Read message resources until the latest history, or forever when following"""
+        try:
+            history_id = self._stream.history_id
+            while not stop.is_set():
+                histories = self._stream.read_resources_after(history_id, self._histories_per_fetch)
+                if len(histories) > 0:
+                    history_id = histories[-1][0]
+                    _put(fetched, histories, stop)
+                elif follow:
+                    stop.wait(poll_interval)
+                else:
+                    _put(fetched, _END, stop)
+                    return
+        except Exception as exception:  # noqa: B902 the error is re-raised by the sink stage
+            _put(fetched, exception, stop)
+
+    def _parse_stage(self, fetched, parsed, stop, pool):
+        """Turn the message resources of each fetched batch of histories into messages"""
+        parser = self._stream.parser
+        try:
+            while not stop.is_set():
+                try:
+                    histories = fetched.get(timeout=0.1)
+                except Queue.Empty:
+                    continue
+                if histories is _END or isinstance(histories, Exception):
+                    _put(parsed, histories, stop)
+                    return
+                batch = []
+                for history_id, resources in histories:
+                    if pool is not None:
+                        messages = pool.map(parser, resources)
+                    else:
+                        messages = [parser(resource) for resource in resources]
+                    batch.append((history_id, messages))
+                self._stream.index_messages([message for _, batch_messages in batch for message in batch_messages])
+                _put(parsed, batch, stop)
+        except Exception as exception:  # noqa: B902 the error is re-raised by the sink stage
+            _put(parsed, exception, stop)
+
+    def _sink_stage(self, parsed):
+        """Hand each history to the sink and acknowledge it
+
+        Returns:
+            int: The number of histories handled
+        """
+        handled = 0
+        while True:
+            batch = parsed.get()
+            if batch is _END:
+                return handled
+            if isinstance(batch, Exception):
+                raise batch
+            for history_id, messages in batch:
+                self._sink(history_id, messages)
+                self._stream.acknowledge(history_id)
+                handled += 1
+                if self._on_acknowledge is not None:
+                    self._on_acknowledge(self._stream.cursor)
+
+
+def _put(queue, item, stop):
+    """Put an item on a bounded queue, giving up if the pipeline is stopped while waiting
+
+    Returns:
+        bool: True if the item was put on the queue
+    """
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Queue.Full:
+            pass
+    return False
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""Testing the pipeline python module
+"""
+
+from gmailtool import mailstream
+from gmailtool import pipeline
+from gmailtool.mailstream_test import generate_mock_message
+from gmailtool.mailstream_test import get_gmail_api_descovery_json
+
+import apiclient.http
+import json
+import threading
+import time
+import unittest
+
+
+class EndlessStream(object):
+    """A stand in for GmailMailStream with a new history holding one message every time it is read"""
+
+    def __init__(self):
+        self.history_id = 0
+        self.reads = 0
+        self.parser = mailstream.parse_resource
+
+    def read_resources_after(self, history_id, max_histories=None):
+        self.reads += 1
+        return [(history_id + 1, [generate_mock_message('test{}'.format(history_id + 1))])]
+
+    def index_messages(self, messages):
+        pass
+
+    def acknowledge(self, history_id):
+        self.history_id = history_id
+
+    @property
+    def cursor(self):
+        return str(self.history_id)
+
+
+class TestPipeline(unittest.TestCase):
+    """Testing histories flow through the pipeline stages and are acknowledged in order"""
+
+    def create_inbox(self):
+        self.test_messages = [generate_mock_message('test{}'.format(index)) for index in range(3)]
+        http = apiclient.http.HttpMockSequence([
+            ({'status': '200'}, get_gmail_api_descovery_json()),
+            ({'status': '200'}, json.dumps({'history': [
+                {'id': 2, 'messagesAdded': [{'message': self.test_messages[0]}, {'message': self.test_messages[1]}]},
+                {'id': 3, 'messagesAdded': [{'message': self.test_messages[2]}]},
+            ]})),
+            ({'status': '200'}, json.dumps(self.test_messages[0])),
+            ({'status': '200'}, json.dumps(self.test_messages[1])),
+            ({'status': '200'}, json.dumps(self.test_messages[2])),
+            ({'status': '200'}, json.dumps({'history': []})),
+            ({'status': '400'}, 'Should never be requested'),
+        ])
+        return mailstream.GmailMailStream(http, 'recipient@example.adamandpaul.biz', cursor='{"last_history_id": 1}')
+
+    def run_pipeline(self, **kwargs):
+        inbox = self.create_inbox()
+        handled = []
+        cursors = []
+
+        def sink(history_id, messages):
+            handled.append((history_id, [message['subject'] for message in messages]))
+
+        def on_acknowledge(cursor):
+            cursors.append(json.loads(cursor)['last_history_id'])
+
+        count = pipeline.Pipeline(inbox, sink, on_acknowledge=on_acknowledge, **kwargs).run()
+        self.assertEqual(count, 2)
+        self.assertEqual(handled, [(2, ['test0', 'test1']), (3, ['test2'])])
+        self.assertEqual(cursors, [2, 3])
+
+    def test_histories_should_be_handled_in_order(self):
+        self.run_pipeline()
+
+    def test_messages_should_be_parsed_in_a_process_pool(self):
+        self.run_pipeline(parse_processes=2)
+
+    def test_cursor_should_not_pass_a_history_the_sink_failed_on(self):
+        inbox = self.create_inbox()
+
+        def sink(history_id, messages):
+            if history_id == 3:
+                raise ValueError('sink failed')
+
+        with self.assertRaises(ValueError):
+            pipeline.Pipeline(inbox, sink).run()
+        self.assertEqual(json.loads(inbox.cursor)['last_history_id'], 2)
+
+    def test_fetching_should_wait_for_a_slow_sink(self):
+        stream = EndlessStream()
+        release = threading.Event()
+
+        def sink(history_id, messages):
+            if history_id == 5:
+                raise ValueError('stop')
+            release.wait()
+
+        def release_later():
+            time.sleep(0.3)
+            self.reads_while_blocked = stream.reads
+            release.set()
+
+        releaser = threading.Thread(target=release_later)
+        releaser.start()
+        with self.assertRaises(ValueError):
+            pipeline.Pipeline(stream, sink, queue_size=1, histories_per_fetch=1).run()
+        releaser.join()
+        # One history in the sink, one waiting in each queue, one being parsed and one being put
+        self.assertLessEqual(self.reads_while_blocked, 5)
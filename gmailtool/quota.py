@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""Request budgeting to stay within Gmail API quotas
+"""
+
+import threading
+import time
+
+
+# The number of Gmail API quota units charged for each method, by method id
+QUOTA_UNITS = {
+    'gmail.users.getProfile': 1,
+    'gmail.users.history.list': 2,
+    'gmail.users.labels.list': 1,
+    'gmail.users.messages.get': 5,
+    'gmail.users.messages.list': 5,
+    'gmail.users.stop': 50,
+    'gmail.users.threads.get': 10,
+    'gmail.users.watch': 100,
+}
+
+# The number of quota units assumed for methods missing from QUOTA_UNITS
+DEFAULT_QUOTA_UNITS = 5
+
+# The number of quota units gmail allows each user to spend per second
+USER_QUOTA_UNITS_PER_SECOND = 250
+
+# Token shortfalls smaller than this are rounding errors from refilling, not a reason to wait
+_TOKEN_TOLERANCE = 1e-9
+
+
+def request_quota_units(request):
+    """The number of quota units gmail charges for a request
+
+    Args:
+        request (HttpRequest): The gmail api request
+
+    Returns:
+        int: The quota units of the request method
+    """
+    return QUOTA_UNITS.get(getattr(request, 'methodId', None), DEFAULT_QUOTA_UNITS)
+
+
+class TokenBucket(object):
+    """A thread safe token bucket used as a request budget
+
+    Tokens are added at a fixed rate up to a capacity. Taking tokens which are not available
+    either waits for them (acquire) or puts the bucket into debt (consume), which later callers
+    of acquire will wait out.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.time, sleep=time.sleep):
+        """Initialize a token bucket
+
+        Args:
+            rate (float): The number of tokens added per second
+            capacity (float): The maximum number of tokens in the bucket. Defaults to rate, i.e.
+                one seconds worth of tokens
+            clock (callable): Returns the current time in seconds
+            sleep (callable): Sleeps for the given number of seconds
+        """
+        assert rate > 0, 'rate must be positive'
+        self._rate = float(rate)
+        self._capacity = float(capacity if capacity is not None else rate)
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = self._capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    @property
+    def tokens(self):
+        """float: The number of tokens currently available, negative when in debt"""
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+    def consume(self, units=1):
+        """Take tokens from the bucket without waiting, possibly going into debt
+
+        Args:
+            units (float): The number of tokens to take
+        """
+        with self._lock:
+            self._refill()
+            self._tokens -= units
+
+    def acquire(self, units=1):
+        """Wait until tokens are available then take them from the bucket
+
+        Args:
+            units (float): The number of tokens to take
+
+        Returns:
+            float: The number of seconds spent waiting
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens + _TOKEN_TOLERANCE >= min(units, self._capacity):
+                    self._tokens -= units
+                    return waited
+                wait = (min(units, self._capacity) - self._tokens) / self._rate
+            self._sleep(wait)
+            waited += wait
+
+    def _refill(self):
+        """Add the tokens accrued since the last update. Must be called with the lock held"""
+        now = self._clock()
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""Testing the quota python module
+"""
+
+from gmailtool import quota
+from gmailtool.scheduler_test import FakeClock
+
+import unittest
+
+
+class TestTokenBucket(unittest.TestCase):
+    """Testing taking tokens from a token bucket"""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.bucket = quota.TokenBucket(10, capacity=20, clock=self.clock.time, sleep=self.clock.sleep)
+
+    def test_acquire_should_not_wait_while_tokens_are_available(self):
+        self.assertEqual(self.bucket.acquire(20), 0)
+
+    def test_acquire_should_wait_for_tokens_to_refill(self):
+        self.bucket.acquire(20)
+        waited = self.bucket.acquire(5)
+        self.assertAlmostEqual(waited, 0.5)
+
+    def test_consume_should_put_bucket_into_debt(self):
+        self.bucket.consume(30)
+        self.assertAlmostEqual(self.bucket.tokens, -10)
+        waited = self.bucket.acquire(10)
+        self.assertAlmostEqual(waited, 2.0)
+
+    def test_bucket_should_not_fill_past_capacity(self):
+        self.clock.sleep(100)
+        self.assertAlmostEqual(self.bucket.tokens, 20)
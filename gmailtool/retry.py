@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""Executing Gmail API requests within quota, retrying rate limit and server errors
+"""
+
+from gmailtool import instrumentation
+from gmailtool import quota
+
+import apiclient.errors
+import email.utils
+import json
+import logging
+import random
+import socket
+import threading
+import time
+
+
+logger = logging.getLogger('gmailtool.retry')
+
+# The 403 error reasons gmail uses to signal a rate limit rather than a permission problem
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+
+def error_reasons(error):
+    """The reasons given in the body of a gmail api error response
+
+    Args:
+        error (HttpError): The error
+
+    Returns:
+        list of str: The reasons, empty if the body does not give any
+    """
+    try:
+        errors = json.loads(error.content)['error']['errors']
+        return [item['reason'] for item in errors if 'reason' in item]
+    except (ValueError, KeyError, TypeError):
+        return []
+
+
+def is_retryable(error):
+    """Whether a failed request may succeed if it is made again later
+
+    Rate limit errors (429 and 403 with a rate limit reason), server errors and network errors
+    are retryable. Other client errors are not.
+
+    Args:
+        error (Exception): The error raised by the request
+
+    Returns:
+        bool: True if the request should be retried
+    """
+    if isinstance(error, apiclient.errors.HttpError):
+        status = int(error.resp.status)
+        if status == 429 or status >= 500:
+            return True
+        if status == 403:
+            return any(reason in RATE_LIMIT_REASONS for reason in error_reasons(error))
+        return False
+    return isinstance(error, socket.error)
+
+
+def retry_after(error, clock=time.time):
+    """The number of seconds a Retry-After header of an error response asks to wait
+
+    Args:
+        error (Exception): The error raised by the request
+        clock (callable): Returns the current time in seconds, used for Retry-After dates
+
+    Returns:
+        float or None: The number of seconds to wait, None if there is no Retry-After header
+    """
+    resp = getattr(error, 'resp', None)
+    if resp is None or resp.get('retry-after') is None:
+        return None
+    value = resp.get('retry-after').strip()
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        date = email.utils.parsedate_tz(value)
+        if date is None:
+            return None
+        return max(email.utils.mktime_tz(date) - clock(), 0.0)
+
+
+class RequestExecutor(object):
+    """Execute gmail api requests, pacing them within a quota budget and retrying transient errors
+
+    Before each request the quota units of its method are taken from the budget, so requests
+    slow down before gmail starts refusing them. Retryable errors are retried with full jitter
+    exponential backoff, waiting at least as long as any Retry-After header asks.
+    """
+
+    def __init__(self,
+                 budget=None,
+                 max_attempts=5,
+                 initial_delay=1.0,
+                 max_delay=64.0,
+                 random=random.random,
+                 clock=time.time,
+                 sleep=time.sleep,
+                 metrics=None):
+        """Initialize a request executor
+
+        Args:
+            budget (TokenBucket): A budget of quota units taken by each request. None for no limit
+            max_attempts (int): The number of times a request is made before its error is raised
+            initial_delay (float): The upper bound in seconds of the wait before the first retry
+            max_delay (float): The largest upper bound in seconds of the wait before a retry
+            random (callable): Returns a random float between 0 and 1
+            clock (callable): Returns the current time in seconds
+            sleep (callable): Sleeps for the given number of seconds
+            metrics (Metrics): Counts the retries, see instrumentation
+        """
+        assert max_attempts > 0, 'max_attempts must be at least 1'
+        self._budget = budget
+        self._max_attempts = max_attempts
+        self._initial_delay = initial_delay
+        self._max_delay = max_delay
+        self._random = random
+        self._clock = clock
+        self._sleep = sleep
+        self._retries = 0
+        self._retries_lock = threading.Lock()
+        self._metrics = metrics or instrumentation.NULL_METRICS
+
+    @property
+    def retries(self):
+        """int: The number of times a request has been retried"""
+        return self._retries
+
+    def execute(self, request, units=None):
+        """Execute a request
+
+        Args:
+            request (HttpRequest or BatchHttpRequest): The request
+            units (int): The quota units the request costs. Defaults to the units of the request method
+
+        Returns:
+            object: The result of the request
+
+        Raises:
+            HttpError: The request failed with an error which is not retryable or failed max_attempts times
+        """
+        if units is None:
+            units = quota.request_quota_units(request)
+        attempt = 1
+        while True:
+            if self._budget is not None:
+                self._budget.acquire(units)
+            try:
+                return request.execute()
+            except (apiclient.errors.HttpError, socket.error) as error:
+                if attempt >= self._max_attempts or not is_retryable(error):
+                    raise
+                self.wait(attempt, error)
+                attempt += 1
+
+    def delay(self, attempt, error=None):
+        """The number of seconds to wait before retrying
+
+        Args:
+            attempt (int): The number of attempts made so far
+            error (Exception): The error of the last attempt
+
+        Returns:
+            float: The number of seconds to wait
+        """
+        delay = self._random() * min(self._max_delay, self._initial_delay * 2 ** (attempt - 1))
+        requested = retry_after(error, self._clock) if error is not None else None
+        if requested is not None:
+            delay = max(delay, requested)
+        return delay
+
+    def wait(self, attempt, error=None):
+        """Wait before retrying
+
+        Args:
+            attempt (int): The number of attempts made so far
+            error (Exception): The error of the last attempt
+        """
+        delay = self.delay(attempt, error)
+        with self._retries_lock:
+            self._retries += 1
+        self._metrics.increment(instrumentation.RETRIES)
+        logger.warning('Retrying in {:.2f} seconds after attempt {}: {}'.format(delay, attempt, error))
+        self._sleep(delay)
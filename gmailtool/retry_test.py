@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""Testing the retry python module
+"""
+
+from gmailtool import mailstream
+from gmailtool import quota
+from gmailtool import retry
+from gmailtool.mailstream_test import generate_mock_message
+from gmailtool.mailstream_test import get_gmail_api_descovery_json
+from gmailtool.scheduler_test import FakeClock
+
+import apiclient.errors
+import apiclient.http
+import json
+import unittest
+
+
+RATE_LIMIT_CONTENT = json.dumps({
+    'error': {'code': 403, 'errors': [{'reason': 'userRateLimitExceeded'}]},
+})
+
+PERMISSION_CONTENT = json.dumps({
+    'error': {'code': 403, 'errors': [{'reason': 'insufficientPermissions'}]},
+})
+
+
+class TestRequestExecutor(unittest.TestCase):
+    """Testing requests are retried with backoff and paced by quota units"""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.waits = []
+
+    def sleep(self, seconds):
+        self.waits.append(seconds)
+        self.clock.sleep(seconds)
+
+    def create_inbox(self, responses, **kwargs):
+        http = apiclient.http.HttpMockSequence([
+            ({'status': '200'}, get_gmail_api_descovery_json()),
+        ] + responses + [
+            ({'status': '400'}, 'Should never be requested'),
+        ])
+        kwargs.setdefault('random', lambda: 1.0)
+        executor = retry.RequestExecutor(clock=self.clock.time, sleep=self.sleep, **kwargs)
+        inbox = mailstream.GmailMailStream(http,
+                                           'recipient@example.adamandpaul.biz',
+                                           cursor='{"last_history_id": 1}',
+                                           executor=executor)
+        return inbox, executor
+
+    def test_rate_limited_requests_should_be_retried_with_exponential_backoff(self):
+        test_message = generate_mock_message('test1234')
+        inbox, executor = self.create_inbox([
+            ({'status': '429'}, '{"error": {"code": 429}}'),
+            ({'status': '403'}, RATE_LIMIT_CONTENT),
+            ({'status': '503'}, '{"error": {"code": 503}}'),
+            ({'status': '200'}, json.dumps({'history': [{'id': 2, 'messagesAdded': [{'message': test_message}]}]})),
+            ({'status': '429'}, '{"error": {"code": 429}}'),
+            ({'status': '200'}, json.dumps(test_message)),
+        ])
+        messages = inbox.read()
+        self.assertEqual([message['subject'] for message in messages], ['test1234'])
+        self.assertEqual(self.waits, [1.0, 2.0, 4.0, 1.0])
+        self.assertEqual(executor.retries, 4)
+
+    def test_retry_after_should_be_honoured(self):
+        inbox, executor = self.create_inbox([
+            ({'status': '429', 'retry-after': '30'}, '{"error": {"code": 429}}'),
+            ({'status': '200'}, json.dumps({'history': []})),
+        ])
+        self.assertIsNone(inbox.read())
+        self.assertEqual(self.waits, [30.0])
+
+    def test_backoff_should_be_jittered(self):
+        inbox, executor = self.create_inbox([
+            ({'status': '429'}, '{"error": {"code": 429}}'),
+            ({'status': '429'}, '{"error": {"code": 429}}'),
+            ({'status': '200'}, json.dumps({'history': []})),
+        ], random=lambda: 0.25)
+        inbox.read()
+        self.assertEqual(self.waits, [0.25, 0.5])
+
+    def test_errors_should_be_raised_after_max_attempts(self):
+        inbox, executor = self.create_inbox([
+            ({'status': '429'}, '{"error": {"code": 429}}'),
+            ({'status': '429'}, '{"error": {"code": 429}}'),
+        ], max_attempts=2)
+        with self.assertRaises(apiclient.errors.HttpError):
+            inbox.read()
+        self.assertEqual(len(self.waits), 1)
+
+    def test_permission_errors_should_not_be_retried(self):
+        inbox, executor = self.create_inbox([
+            ({'status': '403'}, PERMISSION_CONTENT),
+        ])
+        with self.assertRaises(apiclient.errors.HttpError):
+            inbox.read()
+        self.assertEqual(self.waits, [])
+
+    def test_requests_should_be_paced_by_quota_units(self):
+        test_message = generate_mock_message('test1234')
+        budget = quota.TokenBucket(5, clock=self.clock.time, sleep=self.sleep)
+        inbox, executor = self.create_inbox([
+            ({'status': '200'}, json.dumps({'history': [{'id': 2, 'messagesAdded': [{'message': test_message}]}]})),
+            ({'status': '200'}, json.dumps(test_message)),
+        ], budget=budget)
+        inbox.read()
+        # history.list takes 2 of the 5 units, messages.get needs 5 so waits for 2 more to refill
+        self.assertEqual(self.waits, [0.4])
+
+
+class TestRetryAfter(unittest.TestCase):
+    """Testing Retry-After headers are understood"""
+
+    def error(self, headers):
+        headers = dict(headers, status='429')
+        return apiclient.errors.HttpError(apiclient.http.httplib2.Response(headers), '')
+
+    def test_seconds(self):
+        self.assertEqual(retry.retry_after(self.error({'retry-after': '12'})), 12.0)
+
+    def test_http_date(self):
+        error = self.error({'retry-after': 'Thu, 01 Jan 1970 00:01:00 GMT'})
+        self.assertEqual(retry.retry_after(error, clock=lambda: 30), 30.0)
+
+    def test_missing(self):
+        self.assertIsNone(retry.retry_after(self.error({})))
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""Follow many mailboxes at once from a single thread
+"""
+
+import collections
+import logging
+import time
+
+
+logger = logging.getLogger('gmailtool.scheduler')
+
+
+class FollowedMailbox(object):
+    """The scheduling state of a single followed mailbox
+
+    Attributes:
+        mailbox (str): The mailbox being followed
+        stream (GmailMailStream): The stream reading the mailbox
+        interval (float): The current number of seconds between polls
+        next_poll (float): The time the mailbox is next due to be polled
+        caught_up (bool): True when the last poll reached the latest history of the mailbox
+    """
+
+    def __init__(self, mailbox, stream, interval, next_poll):
+        self.mailbox = mailbox
+        self.stream = stream
+        self.interval = interval
+        self.next_poll = next_poll
+        self.caught_up = False
+
+
+class Scheduler(object):
+    """Poll many mail streams fairly within a shared request budget
+
+    Mailboxes are visited in round robin order and each poll reads at most histories_per_turn
+    histories, so a busy mailbox can not starve the others. Mailboxes with no new history are
+    polled less often, backing off up to max_interval. Mailboxes with new history go back to
+    min_interval, and are polled again in the next round if more history is waiting. A mailbox
+    whose poll fails is logged and polled again after max_interval, without holding up the others.
+    """
+
+    def __init__(self,
+                 handler,
+                 budget=None,
+                 cursor_store=None,
+                 min_interval=10.0,
+                 max_interval=600.0,
+                 backoff=2.0,
+                 histories_per_turn=10,
+                 clock=time.time,
+                 sleep=time.sleep):
+        """Initialize a scheduler
+
+        Args:
+            handler (callable): Called as handler(mailbox, history_id, messages) for each history read
+            budget (TokenBucket): A request budget shared by all mailboxes. None for no limit
+            cursor_store (CursorStore): Records each cursor once the handler has been called for its histories
+            min_interval (float): The shortest number of seconds between polls of a mailbox
+            max_interval (float): The longest number of seconds between polls of a mailbox
+            backoff (float): The factor the interval grows by each time a mailbox has no new history
+            histories_per_turn (int): The maximum number of histories read from a mailbox per poll
+            clock (callable): Returns the current time in seconds
+            sleep (callable): Sleeps for the given number of seconds
+        """
+        assert 0 < min_interval <= max_interval, 'min_interval must be positive and no more than max_interval'
+        assert backoff >= 1, 'backoff must be at least 1'
+        assert histories_per_turn > 0, 'histories_per_turn must be at least 1'
+        self._handler = handler
+        self._budget = budget
+        self._cursor_store = cursor_store
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._backoff = backoff
+        self._histories_per_turn = histories_per_turn
+        self._clock = clock
+        self._sleep = sleep
+        self._followed = collections.OrderedDict()
+        self._order = collections.deque()
+
+    def add(self, mailbox, stream):
+        """Start following a mailbox
+
+        Args:
+            mailbox (str): The mailbox to follow
+            stream (GmailMailStream): The stream reading the mailbox
+        """
+        assert mailbox not in self._followed, 'mailbox is already followed: ' + mailbox
+        self._followed[mailbox] = FollowedMailbox(mailbox, stream, self._min_interval, self._clock())
+        self._order.append(mailbox)
+
+    @property
+    def followed(self):
+        """list of FollowedMailbox: The state of every followed mailbox in the order they were added"""
+        return list(self._followed.values())
+
+    @property
+    def cursors(self):
+        """dict: The cursor of every followed mailbox keyed by mailbox"""
+        return dict((mailbox, followed.stream.cursor) for mailbox, followed in self._followed.items())
+
+    def poll_due(self, force=False):
+        """Run one round robin round, polling every mailbox which is due
+
+        Args:
+            force (bool): Poll every mailbox which is not caught up regardless of when it is due
+
+        Returns:
+            int: The number of mailboxes polled
+        """
+        polled = 0
+        for mailbox in list(self._order):
+            followed = self._followed[mailbox]
+            if force:
+                due = not followed.caught_up
+            else:
+                due = followed.next_poll <= self._clock()
+            if due:
+                self._poll(followed)
+                polled += 1
+        self._order.rotate(-1)
+        return polled
+
+    def run(self, until_idle=False):
+        """Follow the mailboxes
+
+        Args:
+            until_idle (bool): Return once every mailbox has been read up to its latest history
+                instead of following forever
+        """
+        try:
+            while len(self._followed) > 0:
+                if until_idle:
+                    if self.poll_due(force=True) == 0:
+                        return
+                else:
+                    self.poll_due()
+                    if self._cursor_store is not None:
+                        self._cursor_store.checkpoint_if_due()
+                    wait = min(followed.next_poll for followed in self._followed.values()) - self._clock()
+                    if wait > 0:
+                        self._sleep(wait)
+        finally:
+            if self._cursor_store is not None:
+                self._cursor_store.checkpoint()
+
+    def _poll(self, followed):
+        """Read the next histories of a mailbox and reschedule it, backing off if the read fails
+
+        Args:
+            followed (FollowedMailbox): The mailbox to poll
+        """
+        try:
+            self._read(followed)
+        except Exception as error:  # noqa: B902 one failing mailbox must not stop the others
+            followed.caught_up = True
+            followed.interval = self._max_interval
+            followed.next_poll = self._clock() + followed.interval
+            logger.error('Failed to read {}, next poll in {} seconds: {}'.format(
+                followed.mailbox, followed.interval, error))
+
+    def _read(self, followed):
+        """Read the next histories of a mailbox, hand them to the handler and reschedule it
+
+        Args:
+            followed (FollowedMailbox): The mailbox to poll
+        """
+        if self._budget is not None:
+            self._budget.acquire()
+        handled_history_id = followed.stream.history_id
+        histories = followed.stream.read_many(max_histories=self._histories_per_turn)
+        now = self._clock()
+        if histories is None:
+            followed.caught_up = True
+            followed.interval = min(followed.interval * self._backoff, self._max_interval)
+            followed.next_poll = now + followed.interval
+            logger.debug('No new history for {}, next poll in {} seconds'.format(followed.mailbox, followed.interval))
+            return
+
+        for history_id, messages in histories:
+            if self._budget is not None:
+                self._budget.consume(len(messages))
+            try:
+                self._handler(followed.mailbox, history_id, messages)
+            except Exception:  # noqa: B902 the error is re-raised
+                # The histories the handler did not finish are read again by the next poll
+                followed.stream.acknowledge(handled_history_id)
+                raise
+            handled_history_id = history_id
+        if self._cursor_store is not None:
+            self._cursor_store.set(followed.mailbox, followed.stream.cursor, histories=len(histories))
+        followed.interval = self._min_interval
+        if len(histories) < self._histories_per_turn:
+            followed.caught_up = True
+            followed.next_poll = now + followed.interval
+        else:
+            followed.caught_up = False
+            followed.next_poll = now
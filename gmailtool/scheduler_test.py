@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""Testing the scheduler python module
+"""
+
+from gmailtool import quota
+from gmailtool import scheduler
+
+import json
+import unittest
+
+
+class FakeClock(object):
+    """A clock which only advances when slept on"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeStream(object):
+    """A stand in for GmailMailStream serving a scripted list of histories"""
+
+    def __init__(self, history_ids, error=None):
+        self.history_ids = list(history_ids)
+        self.error = error
+        self.last_history_id = 0
+        self.reads = 0
+
+    @property
+    def cursor(self):
+        return json.dumps({'last_history_id': self.last_history_id})
+
+    @property
+    def history_id(self):
+        return self.last_history_id
+
+    def acknowledge(self, history_id):
+        self.last_history_id = history_id
+
+    def read_many(self, max_histories=None):
+        self.reads += 1
+        if self.error is not None:
+            raise self.error
+        history_ids = [history_id for history_id in self.history_ids if history_id > self.last_history_id]
+        if len(history_ids) == 0:
+            return None
+        histories = [(history_id, ['message-{}'.format(history_id)]) for history_id in history_ids[:max_histories]]
+        self.last_history_id = histories[-1][0]
+        return histories
+
+
+class TestRoundRobin(unittest.TestCase):
+    """Testing a busy mailbox can not starve a quiet one"""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.handled = []
+        self.scheduler = scheduler.Scheduler(self.handler,
+                                             histories_per_turn=2,
+                                             clock=self.clock.time,
+                                             sleep=self.clock.sleep)
+        self.busy = FakeStream(range(1, 11))
+        self.quiet = FakeStream([1])
+        self.scheduler.add('busy@example.adamandpaul.biz', self.busy)
+        self.scheduler.add('quiet@example.adamandpaul.biz', self.quiet)
+
+    def handler(self, mailbox, history_id, messages):
+        self.handled.append((mailbox, history_id))
+
+    def test_quiet_mailbox_should_be_read_in_first_round(self):
+        self.scheduler.poll_due()
+        self.assertIn(('quiet@example.adamandpaul.biz', 1), self.handled)
+        self.assertEqual(len(self.handled), 3, 'expected two histories from busy and one from quiet')
+
+    def test_run_until_idle_should_read_every_history(self):
+        self.scheduler.run(until_idle=True)
+        self.assertEqual(len(self.handled), 11)
+        self.assertEqual(json.loads(self.scheduler.cursors['busy@example.adamandpaul.biz'])['last_history_id'], 10)
+
+
+class TestAdaptiveInterval(unittest.TestCase):
+    """Testing idle mailboxes back off and busy mailboxes return to the minimum interval"""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.scheduler = scheduler.Scheduler(lambda *args: None,
+                                             min_interval=10,
+                                             max_interval=40,
+                                             backoff=2,
+                                             clock=self.clock.time,
+                                             sleep=self.clock.sleep)
+        self.stream = FakeStream([])
+        self.scheduler.add('idle@example.adamandpaul.biz', self.stream)
+        self.followed = self.scheduler.followed[0]
+
+    def test_idle_mailbox_should_back_off_up_to_max_interval(self):
+        intervals = []
+        for _ in range(4):
+            self.clock.now = self.followed.next_poll
+            self.scheduler.poll_due()
+            intervals.append(self.followed.interval)
+        self.assertEqual(intervals, [20, 40, 40, 40])
+
+    def test_mailbox_should_not_be_polled_before_it_is_due(self):
+        self.scheduler.poll_due()
+        self.assertEqual(self.scheduler.poll_due(), 0, 'expected mailbox not to be due yet')
+        self.assertEqual(self.stream.reads, 1)
+
+    def test_new_history_should_reset_interval(self):
+        self.scheduler.poll_due()
+        self.stream.history_ids = [5]
+        self.clock.now = self.followed.next_poll
+        self.scheduler.poll_due()
+        self.assertEqual(self.followed.interval, 10)
+
+
+class TestSharedBudget(unittest.TestCase):
+    """Testing polls wait on the shared request budget"""
+
+    def test_polls_should_wait_for_budget(self):
+        clock = FakeClock()
+        budget = quota.TokenBucket(1, clock=clock.time, sleep=clock.sleep)
+        follower = scheduler.Scheduler(lambda *args: None,
+                                       budget=budget,
+                                       histories_per_turn=1,
+                                       clock=clock.time,
+                                       sleep=clock.sleep)
+        follower.add('a@example.adamandpaul.biz', FakeStream([1, 2]))
+        follower.add('b@example.adamandpaul.biz', FakeStream([1, 2]))
+        follower.poll_due()
+        self.assertAlmostEqual(clock.now - 1000.0, 2,
+                               msg='expected second read to wait out the first read and its message')
+
+
+class TestFailingMailbox(unittest.TestCase):
+    """Testing a mailbox which fails to be read does not stop the others being followed"""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.handled = []
+        self.scheduler = scheduler.Scheduler(self.handler,
+                                             max_interval=600,
+                                             histories_per_turn=2,
+                                             clock=self.clock.time,
+                                             sleep=self.clock.sleep)
+
+    def handler(self, mailbox, history_id, messages):
+        if mailbox == 'handler@example.adamandpaul.biz' and history_id == 2:
+            raise IOError('handler failed')
+        self.handled.append((mailbox, history_id))
+
+    def test_failing_mailbox_should_back_off_while_the_others_are_read(self):
+        failing = FakeStream([1], error=RuntimeError('403 Forbidden'))
+        self.scheduler.add('failing@example.adamandpaul.biz', failing)
+        self.scheduler.add('healthy@example.adamandpaul.biz', FakeStream([1, 2, 3]))
+        self.scheduler.run(until_idle=True)
+        self.assertEqual(self.handled, [('healthy@example.adamandpaul.biz', history_id) for history_id in [1, 2, 3]])
+        followed = self.scheduler.followed[0]
+        self.assertEqual(followed.interval, 600)
+        self.assertEqual(followed.next_poll, 1600)
+        self.assertEqual(failing.last_history_id, 0, 'expected the cursor of the failing mailbox not to move')
+
+    def test_histories_the_handler_failed_on_should_be_read_again(self):
+        stream = FakeStream([1, 2, 3])
+        self.scheduler.add('handler@example.adamandpaul.biz', stream)
+        self.scheduler.poll_due()
+        self.assertEqual(self.handled, [('handler@example.adamandpaul.biz', 1)])
+        self.assertEqual(stream.last_history_id, 1, 'expected the cursor to stay at the last handled history')
+        self.assertEqual(self.scheduler.followed[0].next_poll, 1600)
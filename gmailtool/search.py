@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""Search the local message index"""
+
+
+from gmailtool import config
+from gmailtool import messageindex
+
+import argparse
+import calendar
+import datetime
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+
+logger = logging.getLogger('gmailtool.search')
+
+
+def parse_date(value):
+    """Parse a YYYY-MM-DD date given on the command line
+
+    Args:
+        value (str): The date
+
+    Returns:
+        float: The start of the day in UTC as seconds since the epoch
+    """
+    try:
+        return calendar.timegm(datetime.datetime.strptime(value, '%Y-%m-%d').timetuple())
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected a date like 2016-01-31: ' + value)
+
+
+def write_search_results(out, rows):
+    """Write a tab separated line for each found message
+
+    Args:
+        out (file): The file to write to
+        rows (list of dict): The rows found in the message index
+    """
+    for row in rows:
+        received = ''
+        if row['internal_date'] is not None:
+            received = time.strftime('%Y-%m-%d %H:%M', time.gmtime(row['internal_date'] / 1000.0))
+        fields = [row['mailbox'], row['gmail_id'], received, row['sender'] or u'', row['subject'] or u'']
+        out.write(u'\t'.join(fields).encode('utf-8') + '\n')
+    out.flush()
+
+
+def cmd_search(args):
+    """The search command
+    """
+    logger.debug('Running command search')
+
+    index_path = os.path.join(os.path.expanduser(args.profile_dir), config.message_index_filename)
+    if not os.path.exists(index_path):
+        logger.error('No message index in ' + args.profile_dir + ', run follow or export with --index first')
+        sys.exit(1)
+    index = messageindex.MessageIndex(index_path)
+    try:
+        rows = index.search(' '.join(args.query) or None,
+                            mailbox=args.mailbox,
+                            label=args.label,
+                            after=args.after,
+                            before=args.before,
+                            limit=args.limit)
+    except sqlite3.OperationalError as error:
+        logger.error('Invalid search query: ' + str(error))
+        sys.exit(1)
+    finally:
+        index.close()
+    write_search_results(sys.stdout, rows)
+
+
+def cmd_search_register(parsers, environ):
+    """Configure the argument parser for use with the search command
+
+    Args:
+        parsers (Parsers): The parsers which belong to the higher level parser
+    """
+    parser = parsers.add_parser('search', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('query', nargs='*',
+                        help='Full text search terms, optionally limited to a field '
+                             '(e.g. sender:alice subject:invoice). Fields: ' + ', '.join(messageindex.TEXT_COLUMNS))
+    parser.add_argument('--mailbox', help='Only find messages in this mailbox')
+    parser.add_argument('--label', help='Only find messages with this label id (e.g. INBOX)')
+    parser.add_argument('--after', type=parse_date,
+                        help='Only find messages received on or after this date (YYYY-MM-DD)')
+    parser.add_argument('--before', type=parse_date,
+                        help='Only find messages received before this date (YYYY-MM-DD)')
+    parser.add_argument('--limit', type=int, default=50, help='The most messages to show, newest first')
+    parser.set_defaults(func=cmd_search)
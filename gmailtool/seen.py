@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""Remembering recently read message ids to suppress duplicate deliveries
+"""
+
+import collections
+import threading
+
+
+class SeenWindow(object):
+    """A bounded window of the most recently read message ids
+
+    Each id is remembered with the history it was read in, so the window can be saved in a
+    cursor without including messages after the cursor. Once capacity ids are remembered, the
+    oldest are forgotten. The window is thread safe, so a background reader can add ids while
+    the cursor is being saved.
+    """
+
+    def __init__(self, capacity=100):
+        """Initialize a seen window
+
+        Args:
+            capacity (int): The number of message ids remembered
+        """
+        assert capacity > 0, 'capacity must be at least 1'
+        self._capacity = capacity
+        self._order = collections.deque()
+        self._history_ids = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._order)
+
+    def __contains__(self, message_id):
+        with self._lock:
+            return message_id in self._history_ids
+
+    def add(self, message_id, history_id):
+        """Remember a message id, forgetting the oldest id if the window is full
+
+        Ids must be added in history order.
+
+        Args:
+            message_id (str): The gmail message id
+            history_id (int): The history the message was read in
+        """
+        with self._lock:
+            if message_id in self._history_ids:
+                return
+            self._order.append(message_id)
+            self._history_ids[message_id] = history_id
+            while len(self._order) > self._capacity:
+                del self._history_ids[self._order.popleft()]
+
+    def discard_after(self, history_id):
+        """Forget the ids read in histories after a history, e.g. after a read failed part way through
+
+        Args:
+            history_id (int): The last history to keep ids of
+        """
+        with self._lock:
+            while len(self._order) > 0 and self._history_ids[self._order[-1]] > history_id:
+                del self._history_ids[self._order.pop()]
+
+    def ids_up_to(self, history_id):
+        """The remembered ids read in a history up to and including a history, oldest first
+
+        Args:
+            history_id (int): The last history to include ids of
+
+        Returns:
+            list of str: The message ids
+        """
+        with self._lock:
+            return [message_id for message_id in self._order if self._history_ids[message_id] <= history_id]
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""Testing the seen python module
+"""
+
+from gmailtool import mailstream
+from gmailtool import seen
+from gmailtool.mailmessage_test import RecordingHttpMockSequence
+from gmailtool.mailstream_test import generate_mock_message
+from gmailtool.mailstream_test import get_gmail_api_descovery_json
+
+import apiclient.errors
+import json
+import unittest
+
+
+class TestSeenWindow(unittest.TestCase):
+    """Testing the window remembers a bounded number of ids"""
+
+    def test_oldest_ids_should_be_forgotten(self):
+        window = seen.SeenWindow(capacity=2)
+        window.add('a', 1)
+        window.add('b', 2)
+        window.add('c', 3)
+        self.assertEqual(len(window), 2)
+        self.assertNotIn('a', window)
+        self.assertIn('c', window)
+
+    def test_ids_up_to_should_leave_out_later_histories(self):
+        window = seen.SeenWindow()
+        window.add('a', 1)
+        window.add('b', 2)
+        window.add('c', 3)
+        self.assertEqual(window.ids_up_to(2), ['a', 'b'])
+
+    def test_discard_after_should_forget_later_histories(self):
+        window = seen.SeenWindow()
+        window.add('a', 1)
+        window.add('b', 2)
+        window.add('c', 3)
+        window.discard_after(1)
+        self.assertEqual(window.ids_up_to(3), ['a'])
+
+
+class TestDuplicateMessages(unittest.TestCase):
+    """Testing messages already read are neither downloaded nor returned again"""
+
+    def create_inbox(self, responses, cursor='{"last_history_id": 1}', **kwargs):
+        self.http = RecordingHttpMockSequence([
+            ({'status': '200'}, get_gmail_api_descovery_json()),
+        ] + responses + [
+            ({'status': '400'}, 'Should never be requested'),
+        ])
+        return mailstream.GmailMailStream(self.http, 'recipient@example.adamandpaul.biz', cursor=cursor, **kwargs)
+
+    def message_gets(self):
+        return [uri for uri in self.http.uris if '/messages/' in uri]
+
+    def test_message_added_in_two_histories_should_be_returned_once(self):
+        inbox = self.create_inbox([
+            ({'status': '200'}, json.dumps({'history': [
+                {'id': 2, 'messagesAdded': [{'message': {'id': 'test1234'}}]},
+                {'id': 3, 'messagesAdded': [{'message': {'id': 'test1234'}}, {'message': {'id': 'test5678'}}]},
+            ]})),
+            ({'status': '200'}, json.dumps(generate_mock_message('test1234'))),
+            ({'status': '200'}, json.dumps(generate_mock_message('test5678'))),
+        ])
+        histories = inbox.read_many()
+        self.assertEqual([(history_id, [message['subject'] for message in messages])
+                          for history_id, messages in histories],
+                         [(2, ['test1234']), (3, ['test5678'])])
+        self.assertEqual(len(self.message_gets()), 2)
+
+    def test_history_read_again_after_restart_should_not_be_downloaded(self):
+        first = self.create_inbox([
+            ({'status': '200'}, json.dumps({'history': [
+                {'id': 2, 'messagesAdded': [{'message': {'id': 'test1234'}}]},
+            ]})),
+            ({'status': '200'}, json.dumps(generate_mock_message('test1234'))),
+        ])
+        self.assertEqual(len(first.read()), 1)
+        cursor = json.loads(first.cursor)
+        self.assertEqual(cursor['seen'], ['test1234'])
+
+        # The restarted stream is given a cursor saved before history 2 was handled
+        cursor['last_history_id'] = 1
+        restarted = self.create_inbox([
+            ({'status': '200'}, json.dumps({'history': [
+                {'id': 2, 'messagesAdded': [{'message': {'id': 'test1234'}}]},
+            ]})),
+        ], cursor=json.dumps(cursor))
+        self.assertEqual(restarted.read(), [])
+        self.assertEqual(self.message_gets(), [])
+
+    def test_failed_read_should_not_mark_messages_seen(self):
+        inbox = self.create_inbox([
+            ({'status': '200'}, json.dumps({'history': [
+                {'id': 2, 'messagesAdded': [{'message': {'id': 'test1234'}}]},
+                {'id': 3, 'messagesAdded': [{'message': {'id': 'test5678'}}]},
+            ]})),
+            ({'status': '200'}, json.dumps(generate_mock_message('test1234'))),
+            ({'status': '400'}, 'Bad request'),
+            ({'status': '200'}, json.dumps({'history': [
+                {'id': 2, 'messagesAdded': [{'message': {'id': 'test1234'}}]},
+                {'id': 3, 'messagesAdded': [{'message': {'id': 'test5678'}}]},
+            ]})),
+            ({'status': '200'}, json.dumps(generate_mock_message('test1234'))),
+            ({'status': '200'}, json.dumps(generate_mock_message('test5678'))),
+        ])
+        with self.assertRaises(apiclient.errors.HttpError):
+            inbox.read_many()
+        self.assertEqual(json.loads(inbox.cursor)['seen'], [])
+        histories = inbox.read_many()
+        self.assertEqual([len(messages) for history_id, messages in histories], [1, 1])
+
+    def test_cursor_should_only_hold_ids_up_to_the_cursor(self):
+        inbox = self.create_inbox([
+            ({'status': '200'}, json.dumps({'history': [
+                {'id': 2, 'messagesAdded': [{'message': {'id': 'test1234'}}]},
+                {'id': 3, 'messagesAdded': [{'message': {'id': 'test5678'}}]},
+            ]})),
+            ({'status': '200'}, json.dumps(generate_mock_message('test1234'))),
+            ({'status': '200'}, json.dumps(generate_mock_message('test5678'))),
+        ])
+        inbox.read_resources_after(1)
+        inbox.acknowledge(2)
+        self.assertEqual(json.loads(inbox.cursor)['seen'], ['test1234'])
+
+    def test_disabled_window_should_return_duplicates(self):
+        inbox = self.create_inbox([
+            ({'status': '200'}, json.dumps({'history': [
+                {'id': 2, 'messagesAdded': [{'message': {'id': 'test1234'}}]},
+                {'id': 3, 'messagesAdded': [{'message': {'id': 'test1234'}}]},
+            ]})),
+            ({'status': '200'}, json.dumps(generate_mock_message('test1234'))),
+            ({'status': '200'}, json.dumps(generate_mock_message('test1234'))),
+        ], seen_window=0)
+        histories = inbox.read_many()
+        self.assertEqual([len(messages) for history_id, messages in histories], [1, 1])
+        self.assertNotIn('seen', json.loads(inbox.cursor))
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""Parse messages while streaming attachments to files in a spool directory
+"""
+
+from gmailtool import mailmessage
+
+import binascii
+import email.feedparser
+import email.parser
+import os
+import re
+import tempfile
+
+
+# The header added to attachment parts giving the path of the spooled attachment
+SPOOL_PATH_HEADER = 'X-Gmailtool-Spool-Path'
+
+# The number of base64 characters decoded at a time
+DECODE_CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = re.compile(r'\s+')
+_UNSAFE_FILENAME_CHARACTERS = re.compile(r'[^A-Za-z0-9._-]')
+
+
+def iter_decoded_lines(raw, chunk_size=DECODE_CHUNK_SIZE):
+    """Decode a base64 encoded message a chunk at a time, yielding the lines of the message
+
+    Args:
+        raw (str): The base64 encoded message in the url safe or standard alphabet
+        chunk_size (int): The number of encoded characters decoded at a time
+
+    Yields:
+        str: Each line of the decoded message including its line ending
+    """
+    encoded = ''
+    partial_line = ''
+    for start in range(0, len(raw), chunk_size):
+        encoded += _WHITESPACE.sub('', str(raw[start:start + chunk_size]))
+        decodable = len(encoded) - len(encoded) % 4
+        decoded = partial_line + mailmessage.decode_raw(encoded[:decodable])
+        encoded = encoded[decodable:]
+        lines = decoded.split('\n')
+        partial_line = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    partial_line += mailmessage.decode_raw(encoded + '=' * (-len(encoded) % 4))
+    if partial_line:
+        yield partial_line
+
+
+class SpoolWriter(object):
+    """Write the body of an attachment part to a file, undoing its transfer encoding
+
+    The line ending before a multipart boundary belongs to the boundary, so the line ending of
+    the most recent line is held back until another line is written.
+    """
+
+    def __init__(self, fout, transfer_encoding):
+        """Initialize a spool writer
+
+        Args:
+            fout (file): The file the attachment is written to
+            transfer_encoding (str): The Content-Transfer-Encoding of the part
+        """
+        self._fout = fout
+        self._transfer_encoding = transfer_encoding
+        self._encoded = ''
+        self._pending_line_ending = ''
+
+    def write(self, line):
+        """Write a line of the encoded part body
+
+        Args:
+            line (str): The line including its line ending
+        """
+        if self._transfer_encoding == 'base64':
+            self._encoded += _WHITESPACE.sub('', line)
+            decodable = len(self._encoded) - len(self._encoded) % 4
+            self._fout.write(binascii.a2b_base64(self._encoded[:decodable]))
+            self._encoded = self._encoded[decodable:]
+        else:
+            content = line.rstrip('\r\n')
+            line_ending = line[len(content):]
+            if self._transfer_encoding == 'quoted-printable':
+                # A soft line break, a line ending in =, is not part of the decoded content
+                if content.endswith('='):
+                    line_ending = ''
+                content = binascii.a2b_qp(content)
+            self._fout.write(self._pending_line_ending + content)
+            self._pending_line_ending = line_ending
+
+    def close(self):
+        """Finish writing the attachment and close the file"""
+        if self._encoded:
+            self._fout.write(binascii.a2b_base64(self._encoded))
+        self._fout.close()
+
+
+def spool_message(raw, directory, prefix='attachment'):
+    """Parse a raw message, writing attachment bodies to files instead of holding them in memory
+
+    The message is decoded and parsed a line at a time. The body of each part with an
+    attachment Content-Disposition or a filename is written to its own file in directory, and
+    the part is left in the returned message with an empty body and a X-Gmailtool-Spool-Path
+    header giving the path of the file.
+
+    Args:
+        raw (str): The base64 encoded message from the raw field of a message resource
+        directory (str): The spool directory attachments are written to
+        prefix (str): The start of the file name of each attachment (e.g. the gmail message id)
+
+    Returns:
+        email message: The message with attachment parts referring to spooled files
+    """
+    parser = email.feedparser.FeedParser()
+    boundaries = []
+    in_headers = True
+    header_lines = []
+    attachment = None
+    part_number = 0
+
+    for line in iter_decoded_lines(raw):
+        content = line.rstrip('\r\n')
+        if not in_headers and len(boundaries) > 0 and content.startswith('--'):
+            delimiter = content.rstrip()
+            depth = None
+            for index in range(len(boundaries) - 1, -1, -1):
+                boundary = '--' + boundaries[index]
+                if delimiter in (boundary, boundary + '--'):
+                    depth = index
+                    closing = delimiter == boundary + '--'
+                    break
+            if depth is not None:
+                if attachment is not None:
+                    attachment.close()
+                    attachment = None
+                parser.feed(line)
+                if closing:
+                    del boundaries[depth:]
+                else:
+                    del boundaries[depth + 1:]
+                    in_headers = True
+                    header_lines = []
+                continue
+
+        if in_headers:
+            header_lines.append(line)
+            if content != '':
+                continue
+            in_headers = False
+            headers = email.parser.HeaderParser().parsestr(''.join(header_lines), headersonly=True)
+            if headers.get_content_maintype() == 'multipart' and headers.get_param('boundary'):
+                boundaries.append(headers.get_param('boundary'))
+                parser.feed(''.join(header_lines))
+            elif len(boundaries) > 0 and _is_attachment(headers):
+                part_number += 1
+                path = _create_spool_file(directory, prefix, part_number, headers.get_filename())
+                transfer_encoding = headers.get('content-transfer-encoding', '7bit').strip().lower()
+                attachment = SpoolWriter(open(path, 'wb'), transfer_encoding)
+                line_ending = line[len(content):]
+                parser.feed(''.join(header_lines[:-1]))
+                parser.feed(SPOOL_PATH_HEADER + ': ' + path + line_ending + line_ending)
+            else:
+                parser.feed(''.join(header_lines))
+            continue
+
+        if attachment is not None:
+            attachment.write(line)
+        else:
+            parser.feed(line)
+
+    if attachment is not None:
+        attachment.close()
+    if in_headers:
+        parser.feed(''.join(header_lines))
+    return parser.close()
+
+
+def spooled_attachments(message):
+    """Find the spooled attachments of a message returned by spool_message
+
+    Args:
+        message (email message): The message
+
+    Returns:
+        list of (email message, str): Each attachment part and the path of its spooled file
+    """
+    return [(part, part[SPOOL_PATH_HEADER]) for part in message.walk() if SPOOL_PATH_HEADER in part]
+
+
+def _is_attachment(headers):
+    """Whether a part should be spooled
+
+    Args:
+        headers (email message): The headers of the part
+
+    Returns:
+        bool: True if the part is an attachment
+    """
+    disposition = headers.get('content-disposition', '').split(';')[0].strip().lower()
+    return disposition == 'attachment' or headers.get_filename() is not None
+
+
+def _create_spool_file(directory, prefix, part_number, filename):
+    """Create a new uniquely named file in the spool directory
+
+    Args:
+        directory (str): The spool directory
+        prefix (str): The start of the file name
+        part_number (int): The number of the attachment within the message
+        filename (str): The file name of the attachment if it has one
+
+    Returns:
+        str: The path of the created file
+    """
+    suffix = '-' + _UNSAFE_FILENAME_CHARACTERS.sub('_', filename) if filename else ''
+    safe_prefix = _UNSAFE_FILENAME_CHARACTERS.sub('_', prefix)
+    file_handle, path = tempfile.mkstemp(prefix='{}-{}-'.format(safe_prefix, part_number),
+                                         suffix=suffix,
+                                         dir=directory)
+    os.close(file_handle)
+    return path
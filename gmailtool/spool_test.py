@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""Testing the spool python module
+"""
+
+from gmailtool import mailstream
+from gmailtool import spool
+from gmailtool.mailstream_test import get_gmail_api_descovery_json
+
+import apiclient.http
+import base64
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+
+ATTACHMENT_DATA = ''.join(chr(index % 256) for index in range(5000))
+
+MESSAGE = 'From: sender@example.adamandpaul.biz\r\n' \
+          'Subject: Attachments\r\n' \
+          'Content-Type: multipart/mixed; boundary="outer"\r\n' \
+          '\r\n' \
+          '--outer\r\n' \
+          'Content-Type: multipart/alternative; boundary="inner"\r\n' \
+          '\r\n' \
+          '--inner\r\n' \
+          'Content-Type: text/plain\r\n' \
+          '\r\n' \
+          'Hello plain\r\n' \
+          '--inner\r\n' \
+          'Content-Type: text/html\r\n' \
+          '\r\n' \
+          '<p>Hello html</p>\r\n' \
+          '--inner--\r\n' \
+          '--outer\r\n' \
+          'Content-Type: application/octet-stream\r\n' \
+          'Content-Transfer-Encoding: base64\r\n' \
+          'Content-Disposition: attachment; filename="data.bin"\r\n' \
+          '\r\n' \
+          + base64.encodestring(ATTACHMENT_DATA).replace('\n', '\r\n') + \
+          '--outer\r\n' \
+          'Content-Type: text/plain\r\n' \
+          'Content-Transfer-Encoding: quoted-printable\r\n' \
+          'Content-Disposition: attachment; filename="../notes.txt"\r\n' \
+          '\r\n' \
+          'caf=C3=A9 notes=\r\n' \
+          ' continued\r\n' \
+          '--outer\r\n' \
+          'Content-Type: text/csv; name="table.csv"\r\n' \
+          '\r\n' \
+          'a,b\r\n' \
+          '1,2\r\n' \
+          '--outer--\r\n'
+
+
+class TestSpoolMessage(unittest.TestCase):
+    """Testing attachments are written to the spool directory"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        raw = base64.urlsafe_b64encode(MESSAGE)
+        self.message = spool.spool_message(raw, self.directory, prefix='test1234')
+        self.attachments = spool.spooled_attachments(self.message)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, path):
+        with open(path, 'rb') as fin:
+            return fin.read()
+
+    def test_non_attachment_parts_should_be_parsed_normally(self):
+        self.assertEqual(self.message['subject'], 'Attachments')
+        alternative = self.message.get_payload(0)
+        self.assertEqual(alternative.get_payload(0).get_payload(), 'Hello plain')
+        self.assertEqual(alternative.get_payload(1).get_payload(), '<p>Hello html</p>')
+
+    def test_attachments_should_be_written_to_files(self):
+        self.assertEqual(len(self.attachments), 3)
+        self.assertEqual(self.read(self.attachments[0][1]), ATTACHMENT_DATA)
+        self.assertEqual(self.read(self.attachments[1][1]), 'caf\xc3\xa9 notes continued')
+        self.assertEqual(self.read(self.attachments[2][1]), 'a,b\r\n1,2')
+
+    def test_attachment_parts_should_have_empty_bodies(self):
+        for part, path in self.attachments:
+            self.assertEqual(part.get_payload(), '')
+            self.assertEqual(os.path.dirname(path), self.directory)
+        self.assertEqual(self.attachments[0][0].get_filename(), 'data.bin')
+
+    def test_spool_file_names_should_stay_in_the_spool_directory(self):
+        self.assertTrue(os.path.basename(self.attachments[1][1]).startswith('test1234-2-'))
+        self.assertTrue(self.attachments[1][1].endswith('.._notes.txt'))
+
+
+class TestSpoolWriter(unittest.TestCase):
+    """Testing transfer encodings are undone without the line ending of the boundary"""
+
+    def test_quoted_printable_should_keep_hard_line_breaks_only(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'notes.txt')
+            writer = spool.SpoolWriter(open(path, 'wb'), 'quoted-printable')
+            for line in ['first line\r\n', 'soft=\r\n', 'ly broken =3D\r\n', 'last\r\n']:
+                writer.write(line)
+            writer.close()
+            with open(path, 'rb') as fin:
+                self.assertEqual(fin.read(), 'first line\r\nsoftly broken =\r\nlast')
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestDecodedLines(unittest.TestCase):
+    """Testing decoding a message in chunks"""
+
+    def test_lines_should_not_depend_on_chunk_size(self):
+        raw = base64.urlsafe_b64encode(MESSAGE).rstrip('=')
+        for chunk_size in [1, 3, 7, 64, 10000]:
+            self.assertEqual(''.join(spool.iter_decoded_lines(raw, chunk_size=chunk_size)), MESSAGE)
+
+
+class TestSpoolRead(unittest.TestCase):
+    """Testing reading messages with spooled attachments from a GmailMailStream"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_read_should_spool_attachments(self):
+        test_message = {'id': 'test1234', 'threadId': 'thread1', 'raw': base64.urlsafe_b64encode(MESSAGE)}
+        http = apiclient.http.HttpMockSequence([
+            ({'status': '200'}, get_gmail_api_descovery_json()),
+            ({'status': '200'}, json.dumps({'history': [{'id': 2, 'messagesAdded': [{'message': test_message}]}]})),
+            ({'status': '200'}, json.dumps(test_message)),
+            ({'status': '403'}, 'Should never be requested'),
+        ])
+        inbox = mailstream.GmailMailStream(http,
+                                           'recipient@example.adamandpaul.biz',
+                                           cursor='{"last_history_id": 1}',
+                                           spool_directory=self.directory)
+        message = inbox.read()[0]
+        self.assertEqual(message.thread_id, 'thread1')
+        self.assertEqual(len(spool.spooled_attachments(message)), 3)
+        self.assertEqual(len(os.listdir(self.directory)), 3)
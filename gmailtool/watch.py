@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+"""Read mailboxes when gmail notifies that they changed, instead of polling them
+"""
+
+import apiclient.errors
+import base64
+import collections
+import json
+import logging
+import Queue
+import time
+
+
+logger = logging.getLogger('gmailtool.watch')
+
+# The root url of the Cloud Pub/Sub api
+PUBSUB_URI = 'https://pubsub.googleapis.com/v1/'
+
+
+class Notification(object):
+    """A notification that a mailbox changed
+
+    Attributes:
+        mailbox (str): The email address of the mailbox
+        history_id (int): The latest history id of the mailbox when the notification was sent
+    """
+
+    __slots__ = ('mailbox', 'history_id')
+
+    def __init__(self, mailbox, history_id):
+        self.mailbox = mailbox
+        self.history_id = history_id
+
+    def __repr__(self):
+        return '<Notification {} {}>'.format(self.mailbox, self.history_id)
+
+
+def parse_notification_data(data):
+    """Parse the data gmail publishes to a Pub/Sub topic for a watched mailbox
+
+    Args:
+        data (str): The base64 encoded message data, holding the emailAddress and historyId as json
+
+    Returns:
+        Notification: The notification
+    """
+    fields = json.loads(base64.b64decode(data))
+    return Notification(fields['emailAddress'], int(fields['historyId']))
+
+
+class QueueNotificationSource(object):
+    """Notifications published within the process, e.g. by tests or the fake gmail server"""
+
+    def __init__(self):
+        self._queue = Queue.Queue()
+
+    def publish(self, mailbox, history_id):
+        """Publish a notification
+
+        Args:
+            mailbox (str): The email address of the changed mailbox
+            history_id (int): The latest history id of the mailbox
+        """
+        self._queue.put(Notification(mailbox, history_id))
+
+    def get(self, timeout=None):
+        """Wait for the next notification
+
+        Args:
+            timeout (float): The longest number of seconds to wait. 0 returns straight away, None waits forever
+
+        Returns:
+            Notification: The notification, None if none arrived in time
+        """
+        try:
+            if timeout is not None and timeout <= 0:
+                return self._queue.get(block=False)
+            return self._queue.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+
+
+class PubSubPullSource(object):
+    """Notifications pulled from a Cloud Pub/Sub subscription to the topic gmail publishes to
+
+    Messages are acknowledged as soon as they are pulled. A lost notification only delays
+    reading until the next notification or resync of the mailbox.
+    """
+
+    def __init__(self, http, subscription, max_messages=100, root_uri=PUBSUB_URI):
+        """Initialize a Pub/Sub pull source
+
+        Args:
+            http (http): An http object authorized with the pubsub scope
+            subscription (str): The subscription, e.g. projects/my-project/subscriptions/gmail
+            max_messages (int): The most messages pulled at once
+            root_uri (str): The root url of the Pub/Sub api
+        """
+        self._http = http
+        self._subscription_uri = root_uri + subscription
+        self._max_messages = max_messages
+        self._pulled = collections.deque()
+
+    def get(self, timeout=None):
+        """Pull the next notification
+
+        Pub/Sub holds a pull open for a while when there are no messages, so the wait is not
+        exactly timeout.
+
+        Args:
+            timeout (float): 0 returns straight away when no messages are waiting, otherwise
+                Pub/Sub waits a while for messages
+
+        Returns:
+            Notification: The notification, None if none arrived
+        """
+        if len(self._pulled) == 0:
+            self._pull(return_immediately=timeout is not None and timeout <= 0)
+        if len(self._pulled) == 0:
+            return None
+        return self._pulled.popleft()
+
+    def _pull(self, return_immediately):
+        """Pull and acknowledge a page of messages"""
+        result = self._post(':pull', {'maxMessages': self._max_messages, 'returnImmediately': return_immediately})
+        received = result.get('receivedMessages', [])
+        if len(received) == 0:
+            return
+        for received_message in received:
+            try:
+                self._pulled.append(parse_notification_data(received_message['message']['data']))
+            except (KeyError, TypeError, ValueError) as error:
+                logger.warning('Ignoring a Pub/Sub message which is not a gmail notification: ' + str(error))
+        self._post(':acknowledge', {'ackIds': [received_message['ackId'] for received_message in received]})
+
+    def _post(self, action, body):
+        """Post a json request to the subscription
+
+        Returns:
+            dict: The json response
+
+        Raises:
+            HttpError: The request failed
+        """
+        uri = self._subscription_uri + action
+        response, content = self._http.request(uri, method='POST', body=json.dumps(body),
+                                               headers={'Content-Type': 'application/json'})
+        if int(response.status) >= 300:
+            raise apiclient.errors.HttpError(response, content, uri=uri)
+        return json.loads(content or '{}')
+
+
+class WatchedMailbox(object):
+    """The state of a single mailbox followed by notification
+
+    Attributes:
+        mailbox (str): The mailbox being followed
+        stream (GmailMailStream): The stream reading the mailbox
+        renew_time (float): The time the watch is next renewed
+        resync_time (float): The time the mailbox is next read even without a notification
+    """
+
+    def __init__(self, mailbox, stream, renew_time, resync_time):
+        self.mailbox = mailbox
+        self.stream = stream
+        self.renew_time = renew_time
+        self.resync_time = resync_time
+
+
+class NotificationFollower(object):
+    """Follow many mailboxes, reading each only when a notification says it has new history
+
+    Idle mailboxes cost no requests. Notifications arriving in a burst are coalesced, so each
+    mailbox is read once however many notifications it got. The watch of each mailbox is renewed
+    before it expires, and each mailbox is read every resync interval even without a notification
+    in case notifications were lost. A mailbox which fails to be read or watched does not stop the
+    others being followed.
+    """
+
+    def __init__(self,
+                 handler,
+                 source,
+                 budget=None,
+                 cursor_store=None,
+                 topic_name=None,
+                 label_ids=None,
+                 coalesce_seconds=1.0,
+                 renew_seconds=24 * 60 * 60,
+                 resync_seconds=60 * 60,
+                 histories_per_read=100,
+                 clock=time.time):
+        """Initialize a notification follower
+
+        Args:
+            handler (callable): Called as handler(mailbox, history_id, messages) for each history read
+            source (object): The notification source, with a get(timeout) method returning a
+                Notification or None, e.g. PubSubPullSource or QueueNotificationSource
+            budget (TokenBucket): A request budget shared by all mailboxes. None for no limit
+            cursor_store (CursorStore): Records each cursor once the handler has been called for its histories
+            topic_name (str): Ask gmail to publish notifications for each mailbox to this topic. None
+                when the watches are set up elsewhere
+            label_ids (list of str): Only be notified of changes to messages with these labels
+            coalesce_seconds (float): The longest time spent gathering the notifications already waiting
+                after the first of a burst
+            renew_seconds (float): The number of seconds between renewals of each watch
+            resync_seconds (float): The longest number of seconds a mailbox goes without being read
+            histories_per_read (int): The maximum number of histories read at a time
+            clock (callable): Returns the current time in seconds
+        """
+        self._handler = handler
+        self._source = source
+        self._budget = budget
+        self._cursor_store = cursor_store
+        self._topic_name = topic_name
+        self._label_ids = label_ids
+        self._coalesce_seconds = coalesce_seconds
+        self._renew_seconds = renew_seconds
+        self._resync_seconds = resync_seconds
+        self._histories_per_read = histories_per_read
+        self._clock = clock
+        self._watched = collections.OrderedDict()
+
+    def add(self, mailbox, stream):
+        """Start following a mailbox
+
+        Args:
+            mailbox (str): The mailbox to follow
+            stream (GmailMailStream): The stream reading the mailbox
+        """
+        key = mailbox.lower()
+        assert key not in self._watched, 'mailbox is already followed: ' + mailbox
+        now = self._clock()
+        self._watched[key] = WatchedMailbox(mailbox, stream, now, now)
+
+    @property
+    def watched(self):
+        """list of WatchedMailbox: The state of every followed mailbox in the order they were added"""
+        return list(self._watched.values())
+
+    def run(self, until_idle=False):
+        """Follow the mailboxes
+
+        Args:
+            until_idle (bool): Read every mailbox up to its latest history once and return, without
+                waiting for notifications
+        """
+        try:
+            if until_idle:
+                for watched in self._watched.values():
+                    self._read(watched)
+                return
+            while len(self._watched) > 0:
+                self.process()
+        finally:
+            if self._cursor_store is not None:
+                self._cursor_store.checkpoint()
+
+    def process(self, max_wait=None):
+        """Renew due watches, wait for notifications and read the mailboxes they are for
+
+        Args:
+            max_wait (float): The longest number of seconds to wait for a notification. None waits
+                until the next watch renewal or resync
+
+        Returns:
+            int: The number of mailboxes read
+        """
+        self._renew_due()
+        due_times = [watched.resync_time for watched in self._watched.values()]
+        if self._topic_name is not None:
+            due_times.extend(watched.renew_time for watched in self._watched.values())
+        wait = min(due_times) - self._clock()
+        if max_wait is not None:
+            wait = min(wait, max_wait)
+        pending = self._collect(max(0, wait))
+        now = self._clock()
+        for key, watched in self._watched.items():
+            if key not in pending and watched.resync_time <= now:
+                pending[key] = None
+        read = 0
+        for key, history_id in pending.items():
+            watched = self._watched[key]
+            if history_id is not None and history_id <= watched.stream.history_id:
+                logger.debug('Ignoring notification of history {} already read for {}'.format(
+                    history_id, watched.mailbox))
+                continue
+            self._read(watched)
+            read += 1
+        if self._cursor_store is not None:
+            self._cursor_store.checkpoint_if_due()
+        return read
+
+    def _renew_due(self):
+        """Renew the watches which are due, reading each newly watched mailbox up to date"""
+        if self._topic_name is None:
+            return
+        for watched in self._watched.values():
+            if watched.renew_time <= self._clock():
+                try:
+                    watched.stream.watch(self._topic_name, self._label_ids)
+                except Exception as error:  # noqa: B902 one failing mailbox must not stop the others
+                    # Until the watch is renewed the mailbox is still read every resync interval
+                    watched.renew_time = self._clock() + self._resync_seconds
+                    logger.error('Failed to watch {}, trying again in {} seconds: {}'.format(
+                        watched.mailbox, self._resync_seconds, error))
+                    continue
+                watched.renew_time = self._clock() + self._renew_seconds
+                logger.info('Watching {} for notifications to {}'.format(watched.mailbox, self._topic_name))
+
+    def _collect(self, wait):
+        """Wait for a notification then gather the others of the same burst already waiting
+
+        The others are pulled without waiting, because a Pub/Sub pull allowed to wait holds the
+        request open for a while. Gathering stops once none are waiting or the coalesce time is up.
+
+        Args:
+            wait (float): The longest number of seconds to wait for the first notification
+
+        Returns:
+            dict: The highest notified history id of each followed mailbox notified, keyed by lower case mailbox
+        """
+        pending = collections.OrderedDict()
+        notification = self._source.get(timeout=wait)
+        deadline = self._clock() + self._coalesce_seconds
+        while notification is not None:
+            key = notification.mailbox.lower()
+            if key in self._watched:
+                pending[key] = max(pending.get(key, 0), notification.history_id)
+            else:
+                logger.debug('Ignoring notification for a mailbox which is not followed: ' + notification.mailbox)
+            if self._clock() >= deadline:
+                break
+            notification = self._source.get(timeout=0)
+        return pending
+
+    def _read(self, watched):
+        """Read a mailbox up to its latest history, and schedule its next resync
+
+        A mailbox which fails to be read is logged and read again at its next resync, without
+        holding up the others.
+
+        Args:
+            watched (WatchedMailbox): The mailbox
+        """
+        try:
+            self._read_histories(watched)
+        except Exception as error:  # noqa: B902 one failing mailbox must not stop the others
+            logger.error('Failed to read {}, reading again in {} seconds: {}'.format(
+                watched.mailbox, self._resync_seconds, error))
+        watched.resync_time = self._clock() + self._resync_seconds
+
+    def _read_histories(self, watched):
+        """Read the histories of a mailbox up to its latest history, handing each to the handler
+
+        Args:
+            watched (WatchedMailbox): The mailbox
+        """
+        while True:
+            if self._budget is not None:
+                self._budget.acquire()
+            handled_history_id = watched.stream.history_id
+            histories = watched.stream.read_many(max_histories=self._histories_per_read)
+            if histories is None:
+                break
+            for history_id, messages in histories:
+                if self._budget is not None:
+                    self._budget.consume(len(messages))
+                try:
+                    self._handler(watched.mailbox, history_id, messages)
+                except Exception:  # noqa: B902 the error is re-raised
+                    # The histories the handler did not finish are read again by the next read
+                    watched.stream.acknowledge(handled_history_id)
+                    raise
+                handled_history_id = history_id
+            if self._cursor_store is not None:
+                self._cursor_store.set(watched.mailbox, watched.stream.cursor, histories=len(histories))
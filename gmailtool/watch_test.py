@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""Testing the watch python module
+"""
+
+from gmailtool import fakegmail
+from gmailtool import mailstream
+from gmailtool import quota
+from gmailtool import retry
+from gmailtool import watch
+
+import apiclient.errors
+import apiclient.http
+import base64
+import httplib2
+import json
+import unittest
+
+
+def notification_data(mailbox, history_id):
+    return base64.b64encode(json.dumps({'emailAddress': mailbox, 'historyId': history_id}))
+
+
+class BodyRecordingHttpMockSequence(apiclient.http.HttpMockSequence):
+    """A HttpMockSequence which records the uri and body of each request"""
+
+    def __init__(self, iterable):
+        super(BodyRecordingHttpMockSequence, self).__init__(iterable)
+        self.requests = []
+
+    def request(self, uri, method='GET', body=None, *args, **kwargs):
+        self.requests.append((uri, json.loads(body) if body else None))
+        return super(BodyRecordingHttpMockSequence, self).request(uri, method, body, *args, **kwargs)
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FailingStream(object):
+    """A stand in for GmailMailStream whose reads and watches fail"""
+
+    history_id = 1
+
+    def read_many(self, max_histories=None):
+        raise RuntimeError('403 Forbidden')
+
+    def watch(self, topic_name, label_ids=None):
+        raise RuntimeError('403 Forbidden')
+
+
+class TestQueueNotificationSource(unittest.TestCase):
+    """Testing notifications published in process"""
+
+    def test_get_should_return_published_notifications_in_order(self):
+        source = watch.QueueNotificationSource()
+        source.publish('a@example.adamandpaul.biz', 5)
+        source.publish('b@example.adamandpaul.biz', 6)
+        self.assertEqual(source.get(timeout=0).history_id, 5)
+        self.assertEqual(source.get(timeout=0).mailbox, 'b@example.adamandpaul.biz')
+        self.assertIsNone(source.get(timeout=0))
+        self.assertIsNone(source.get(timeout=0.01))
+
+
+class TestPubSubPullSource(unittest.TestCase):
+    """Testing notifications pulled from Cloud Pub/Sub"""
+
+    def test_pulled_messages_should_be_acknowledged_and_returned(self):
+        http = BodyRecordingHttpMockSequence([
+            ({'status': '200'}, json.dumps({'receivedMessages': [
+                {'ackId': 'ack1', 'message': {'data': notification_data('a@example.adamandpaul.biz', 12)}},
+                {'ackId': 'ack2', 'message': {'data': base64.b64encode('not json')}},
+            ]})),
+            ({'status': '200'}, '{}'),
+            ({'status': '200'}, '{}'),
+        ])
+        source = watch.PubSubPullSource(http, 'projects/test/subscriptions/gmail')
+        notification = source.get()
+        self.assertEqual((notification.mailbox, notification.history_id), ('a@example.adamandpaul.biz', 12))
+        self.assertIsNone(source.get(timeout=0))
+        self.assertEqual(http.requests, [
+            ('https://pubsub.googleapis.com/v1/projects/test/subscriptions/gmail:pull',
+             {'maxMessages': 100, 'returnImmediately': False}),
+            ('https://pubsub.googleapis.com/v1/projects/test/subscriptions/gmail:acknowledge',
+             {'ackIds': ['ack1', 'ack2']}),
+            ('https://pubsub.googleapis.com/v1/projects/test/subscriptions/gmail:pull',
+             {'maxMessages': 100, 'returnImmediately': True}),
+        ])
+
+    def test_failed_pull_should_raise(self):
+        http = apiclient.http.HttpMockSequence([({'status': '403'}, '{"error": {"code": 403}}')])
+        source = watch.PubSubPullSource(http, 'projects/test/subscriptions/gmail')
+        with self.assertRaises(apiclient.errors.HttpError):
+            source.get()
+
+
+class TestNotificationFollower(unittest.TestCase):
+    """Testing mailboxes are only read when notified, once per burst of notifications"""
+
+    def setUp(self):
+        self.source = watch.QueueNotificationSource()
+        self.mailbox = fakegmail.SyntheticMailbox('a@example.adamandpaul.biz', 2,
+                                                  message_size=fakegmail.lognormal_sizes(1024, sigma=0))
+        self.server = fakegmail.FakeGmailServer([self.mailbox], notification_source=self.source).start()
+        self.clock = FakeClock()
+        self.handled = []
+
+        def handler(mailbox, history_id, messages):
+            self.handled.extend(message['subject'] for message in messages)
+
+        self.follower = watch.NotificationFollower(handler,
+                                                   self.source,
+                                                   topic_name='projects/test/topics/gmail',
+                                                   coalesce_seconds=1,
+                                                   renew_seconds=100,
+                                                   resync_seconds=50,
+                                                   clock=self.clock)
+        stream = mailstream.GmailMailStream(httplib2.Http(), self.mailbox.address,
+                                            cursor=json.dumps({'last_history_id': self.mailbox.first_history_id}),
+                                            discovery_cache=self.server.discovery_cache(),
+                                            executor=retry.RequestExecutor(sleep=lambda seconds: None))
+        self.follower.add(self.mailbox.address, stream)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_first_process_should_watch_and_catch_up(self):
+        self.assertEqual(self.follower.process(max_wait=0), 1)
+        self.assertEqual(self.server.watches, {self.mailbox.address: 'projects/test/topics/gmail'})
+        self.assertEqual(self.handled, ['Synthetic message 0', 'Synthetic message 1'])
+
+    def test_idle_mailbox_should_not_be_read(self):
+        self.follower.process(max_wait=0)
+        self.server.reset_stats()
+        self.assertEqual(self.follower.process(max_wait=0), 0)
+        self.assertEqual(self.server.stats['api_calls'], 0)
+
+    def test_burst_of_notifications_should_be_read_once(self):
+        self.follower.process(max_wait=0)
+        self.server.reset_stats()
+        for _ in range(3):
+            self.server.deliver(self.mailbox.address)
+        self.assertEqual(self.follower.process(max_wait=0), 1)
+        self.assertEqual(self.handled[2:], ['Synthetic message 2', 'Synthetic message 3', 'Synthetic message 4'])
+        # One history list returning the new histories and one finding nothing more
+        self.assertEqual(self.server.stats['calls'].get('gmail.users.history.list'), 2)
+
+    def test_coalescing_should_not_wait_and_should_stop_at_the_deadline(self):
+        self.follower.process(max_wait=0)
+        timeouts = []
+        get = self.source.get
+
+        def slow_get(timeout=None):
+            timeouts.append(timeout)
+            self.clock.now += 1
+            return get(timeout=timeout)
+
+        self.source.get = slow_get
+        for _ in range(3):
+            self.server.deliver(self.mailbox.address)
+        self.assertEqual(self.follower.process(max_wait=0), 1)
+        self.assertEqual(timeouts, [0, 0], 'expected a pull without waiting then none once the deadline passed')
+
+    def test_reads_should_wait_for_budget(self):
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            self.clock.now += seconds
+
+        follower = watch.NotificationFollower(lambda *args: None,
+                                              self.source,
+                                              budget=quota.TokenBucket(1, clock=self.clock, sleep=sleep),
+                                              clock=self.clock)
+        follower.add(self.mailbox.address, self.follower.watched[0].stream)
+        follower.process(max_wait=0)
+        # The first read takes the only token and its two messages put the bucket two tokens into debt
+        self.assertEqual(sleeps, [3.0])
+
+    def test_failing_mailbox_should_not_stop_the_others(self):
+        self.follower.add('failing@example.adamandpaul.biz', FailingStream())
+        self.follower.process(max_wait=0)
+        self.assertEqual(self.handled, ['Synthetic message 0', 'Synthetic message 1'])
+        failing = self.follower.watched[1]
+        self.assertEqual(failing.resync_time, self.clock.now + 50)
+        self.assertEqual(failing.renew_time, self.clock.now + 50, 'expected the watch to be tried again at resync')
+        self.server.deliver(self.mailbox.address)
+        self.assertEqual(self.follower.process(max_wait=0), 1)
+        self.assertEqual(self.handled[-1], 'Synthetic message 2')
+
+    def test_stale_and_unknown_notifications_should_be_ignored(self):
+        self.follower.process(max_wait=0)
+        self.server.reset_stats()
+        self.source.publish(self.mailbox.address, self.mailbox.history_id)
+        self.source.publish('other@example.adamandpaul.biz', 99999)
+        self.assertEqual(self.follower.process(max_wait=0), 0)
+        self.assertEqual(self.server.stats['api_calls'], 0)
+
+    def test_mailbox_should_be_resynced_without_notifications(self):
+        self.follower.process(max_wait=0)
+        self.mailbox.deliver(1)
+        self.clock.now += 60
+        self.assertEqual(self.follower.process(max_wait=0), 1)
+        self.assertEqual(self.handled[-1], 'Synthetic message 2')
+
+    def test_watch_should_be_renewed(self):
+        self.follower.process(max_wait=0)
+        self.server.reset_stats()
+        self.clock.now += 150
+        self.follower.process(max_wait=0)
+        self.assertEqual(self.server.stats['calls'].get('gmail.users.watch'), 1)
+
+    def test_until_idle_should_read_once_without_waiting(self):
+        self.follower.run(until_idle=True)
+        self.assertEqual(len(self.handled), 2)